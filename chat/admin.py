@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import ChatMessage, ChatRoom
+from .models import ChatMessage, ChatReadState, ChatRoom
 
 admin.site.register(ChatMessage)
 admin.site.register(ChatRoom)
+admin.site.register(ChatReadState)
@@ -1,42 +1,141 @@
+import asyncio
 import json
+import logging
+import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from .models import ChatRoom, ChatMessage
-from users.models import User
-from django.utils import timezone
+from .persistence import ChatMessageBatcher, time_ordered_uuid
+from .presence import PresenceBroadcaster, get_presence_store, presence_group_name
+from .services import ChatService, message_owner_key
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+logger = logging.getLogger(__name__)
+
+
+def room_group_name(room_id):
+    return f'chat_{room_id}'
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
-        
+        self.room_group_name = room_group_name(self.room_id)
+        self.joined = False
+        # Set before start_presence, which may fail part way; stop_presence undoes what exists
+        self.presence_user_ids = set()
+        self.heartbeat_task = None
+
+        # The sender is always the authenticated user, never an id from the payload
+        self.user = self.scope.get('user')
+        if self.user is None or not self.user.is_authenticated:
+            await self.close(code=4401)
+            return
+
+        # Room and membership are loaded once per connection
+        self.participant_ids = await self.load_participants()
+        if self.participant_ids is None or self.user.id not in self.participant_ids:
+            await self.close(code=4403)
+            return
+
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
-        
+        self.joined = True
+
         await self.accept()
-    
+        # Presence is best effort; chatting still works when the presence store is unreachable
+        try:
+            await self.start_presence()
+        except Exception:
+            logger.warning("Could not start chat presence of user %s", self.user.id)
+
     async def disconnect(self, close_code):
         # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
+        if self.joined:
+            await self.channel_layer.group_discard(
+                self.room_group_name,
+                self.channel_name
+            )
+            await self.stop_presence()
+
+    async def start_presence(self):
+        """Count this socket as the user online, follow the other participants and send who is online"""
+        await self.follow_participants()
+
+        connections = await get_presence_store().add(
+            self.user.id, self.channel_name, settings.CHAT_PRESENCE_TTL_SECONDS
         )
-    
+        if connections == 1:
+            PresenceBroadcaster.for_running_loop().set_online(self.user.id, True)
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
+
+        online = await get_presence_store().online(self.presence_user_ids)
+        await self.send(text_data=json.dumps({
+            'type': 'presence_state',
+            'online_user_ids': sorted(online),
+        }))
+
+    async def stop_presence(self):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        broadcaster = PresenceBroadcaster.for_running_loop()
+        broadcaster.set_typing(self.room_group_name, self.user.id, False)
+        for user_id in self.presence_user_ids:
+            await self.channel_layer.group_discard(presence_group_name(user_id), self.channel_name)
+
+        try:
+            connections = await get_presence_store().remove(self.user.id, self.channel_name)
+        except Exception:
+            logger.warning("Could not remove chat presence of user %s", self.user.id)
+            return
+        if connections == 0:
+            broadcaster.set_online(self.user.id, False)
+
+    async def follow_participants(self):
+        """Subscribe to presence of the room's other participants, as of participant_ids"""
+        wanted = {str(user_id) for user_id in self.participant_ids} - {str(self.user.id)}
+        # Updated group by group, so stop_presence leaves exactly the groups that were joined
+        for user_id in wanted - self.presence_user_ids:
+            await self.channel_layer.group_add(presence_group_name(user_id), self.channel_name)
+            self.presence_user_ids.add(user_id)
+        for user_id in self.presence_user_ids - wanted:
+            await self.channel_layer.group_discard(presence_group_name(user_id), self.channel_name)
+            self.presence_user_ids.discard(user_id)
+
+    async def heartbeat(self):
+        # Keeps this socket's presence entry alive; a worker that dies stops refreshing it
+        while True:
+            await asyncio.sleep(settings.CHAT_PRESENCE_HEARTBEAT_SECONDS)
+            try:
+                await get_presence_store().add(self.user.id, self.channel_name, settings.CHAT_PRESENCE_TTL_SECONDS)
+            except Exception:
+                logger.warning("Could not refresh chat presence of user %s", self.user.id)
+
     # Receive message from WebSocket
     async def receive(self, text_data):
         data = json.loads(text_data)
         message_type = data.get('type', 'chat_message')
-        
+        sender_id = str(self.user.id)
+
         if message_type == 'chat_message':
             message = data['message']
-            sender_id = data['sender_id']
-            
-            # Save message to database
-            message_data = await self.save_message(sender_id, message)
-            
+            # Sending a message ends typing
+            PresenceBroadcaster.for_running_loop().set_typing(self.room_group_name, self.user.id, False)
+
+            if settings.CHAT_BATCHED_PERSISTENCE:
+                # Broadcast now; the row is written with the next batch and acknowledged then
+                message_data = await self.queue_message(message, data.get('message_id'))
+                if message_data is None:
+                    # A resend, already broadcast, or an id that is not this sender's to use
+                    return
+            else:
+                # Save message to database
+                message_data = await self.save_message(message)
+
             # Send message to room group
             await self.channel_layer.group_send(
                 self.room_group_name,
@@ -48,10 +147,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     'message_id': str(message_data['id'])
                 }
             )
+        elif message_type == 'typing':
+            # Coalesced per room before anything is broadcast
+            PresenceBroadcaster.for_running_loop().set_typing(
+                self.room_group_name, self.user.id, bool(data.get('is_typing', True))
+            )
         elif message_type == 'read_messages':
-            sender_id = data['sender_id']
-            await self.mark_messages_as_read(sender_id)
-            
+            await self.mark_messages_as_read()
+
             # Notify other users that messages have been read
             await self.channel_layer.group_send(
                 self.room_group_name,
@@ -60,7 +163,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     'user_id': sender_id,
                 }
             )
-    
+
     # Receive message from room group
     async def chat_message(self, event):
         # Send message to WebSocket
@@ -71,7 +174,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'timestamp': event['timestamp'],
             'message_id': event['message_id']
         }))
-    
+
     # Receive read notification from room group
     async def messages_read(self, event):
         # Send read notification to WebSocket
@@ -79,31 +182,103 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'type': 'messages_read',
             'user_id': event['user_id'],
         }))
-    
+
+    # A followed participant came online or went offline
+    async def presence(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'presence',
+            'user_id': event['user_id'],
+            'online': event['online'],
+        }))
+
+    # Typing changes in this room since the last broadcast
+    async def typing(self, event):
+        events = [change for change in event['events'] if change['user_id'] != str(self.user.id)]
+        if events:
+            await self.send(text_data=json.dumps({
+                'type': 'typing',
+                'events': events,
+            }))
+
+    # Batched persistence wrote (or failed to write) this socket's messages
+    async def messages_persisted(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'messages_persisted',
+            'message_ids': event['message_ids'],
+        }))
+
+    async def messages_not_persisted(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'messages_not_persisted',
+            'message_ids': event['message_ids'],
+        }))
+
+    # Participants were added or removed (see chat.signals)
+    async def membership_changed(self, event):
+        self.participant_ids = await self.load_participants()
+        if self.participant_ids is None or self.user.id not in self.participant_ids:
+            await self.close(code=4403)
+            return
+        await self.follow_participants()
+
     @database_sync_to_async
-    def save_message(self, sender_id, content):
-        sender = User.objects.get(id=sender_id)
-        room = ChatRoom.objects.get(id=self.room_id)
-        message = ChatMessage.objects.create(
-            room=room,
-            sender=sender,
-            content=content
+    def load_participants(self):
+        """Participant ids of the room, or None when the room does not exist or is closed"""
+        try:
+            if not ChatRoom.objects.filter(id=self.room_id, is_active=True).exists():
+                return None
+        except ValidationError:
+            return None
+        return set(ChatRoom.participants.through.objects.filter(
+            chatroom_id=self.room_id
+        ).values_list('user_id', flat=True))
+
+    async def queue_message(self, content, client_message_id=None):
+        """
+        Hand the message to the batcher, keeping a client-supplied UUID so resends are idempotent.
+        Returns None, after acknowledging or rejecting it, when the id is already in use.
+        """
+        try:
+            message_id = uuid.UUID(str(client_message_id)) if client_message_id else None
+        except ValueError:
+            message_id = None
+
+        batcher = ChatMessageBatcher.for_running_loop()
+        if message_id is not None:
+            # A known id is only a resend when it is this sender's message in this room
+            pending = batcher.pending_message(message_id)
+            if pending is not None:
+                owner = message_owner_key(pending.room_id, pending.sender_id)
+            else:
+                owner = await database_sync_to_async(ChatService.message_owner)(message_id)
+            if owner is not None:
+                if owner != message_owner_key(self.room_id, self.user.id):
+                    await self.messages_not_persisted({'message_ids': [str(message_id)]})
+                elif pending is not None:
+                    # Acknowledged with the batch it is already in
+                    batcher.enqueue(pending, self.channel_name)
+                else:
+                    await self.messages_persisted({'message_ids': [str(message_id)]})
+                return None
+        else:
+            message_id = time_ordered_uuid()
+
+        message = ChatMessage(
+            id=message_id,
+            room_id=self.room_id,
+            sender_id=self.user.id,
+            content=content,
+            timestamp=batcher.next_timestamp(self.room_id)
         )
+        batcher.enqueue(message, self.channel_name)
+        return {'id': message.id, 'timestamp': message.timestamp}
+
+    @database_sync_to_async
+    def save_message(self, content):
+        message = ChatService.send_message(self.room_id, self.user.id, content)
         return {'id': message.id, 'timestamp': message.timestamp}
-    
+
     @database_sync_to_async
-    def mark_messages_as_read(self, user_id):
-        user = User.objects.get(id=user_id)
-        room = ChatRoom.objects.get(id=self.room_id)
-        now = timezone.now()
-        
+    def mark_messages_as_read(self):
         # Mark all unread messages sent by others as read
-        ChatMessage.objects.filter(
-            room=room,
-            is_read=False
-        ).exclude(
-            sender=user
-        ).update(
-            is_read=True,
-            read_at=now
-        )
+        ChatService.mark_room_read(self.room_id, self.user.id)
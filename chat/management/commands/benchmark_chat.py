@@ -0,0 +1,110 @@
+import asyncio
+import json
+import time
+import uuid
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from chat.consumers import ChatConsumer
+from chat.models import ChatMessage, ChatRoom
+from users.models import User
+
+
+class SocketClient:
+    """Drives one ChatConsumer instance in-process, as the ASGI server would"""
+
+    def __init__(self, user, room_id):
+        scope = {
+            'type': 'websocket',
+            'path': f'/ws/chat/{room_id}/',
+            'user': user,
+            'url_route': {'args': (), 'kwargs': {'room_id': str(room_id)}},
+        }
+        self.communicator = ApplicationCommunicator(ChatConsumer.as_asgi(), scope)
+
+    async def connect(self):
+        await self.communicator.send_input({'type': 'websocket.connect'})
+        response = await self.communicator.receive_output(timeout=10)
+        if response['type'] != 'websocket.accept':
+            raise RuntimeError(f'Connection refused: {response}')
+
+    async def send(self, payload):
+        await self.communicator.send_input({'type': 'websocket.receive', 'text': json.dumps(payload)})
+
+    async def receive(self):
+        response = await self.communicator.receive_output(timeout=10)
+        return json.loads(response['text'])
+
+    async def close(self):
+        await self.communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await self.communicator.wait(timeout=10)
+
+
+class Command(BaseCommand):
+    help = 'Load test ChatConsumer in one process and report persisted, broadcast messages per second'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000, help='Messages sent by the sender socket')
+        parser.add_argument('--listeners', type=int, default=1,
+                            help='Extra sockets in the room that must receive every message')
+        parser.add_argument('--batched', action='store_true',
+                            help='Use batched persistence (CHAT_BATCHED_PERSISTENCE) and wait for every ack')
+
+    def handle(self, *args, **options):
+        count = max(options['messages'], 1)
+        tag = uuid.uuid4().hex[:8]
+        users = [
+            User.objects.create_user(username=f'chat-bench-{tag}-{i}', email=f'chat-bench-{tag}-{i}@example.com')
+            for i in range(max(options['listeners'], 1) + 1)
+        ]
+        room = ChatRoom.objects.create(name=f'Chat benchmark {tag}')
+        room.participants.add(*users)
+
+        batched = settings.CHAT_BATCHED_PERSISTENCE
+        settings.CHAT_BATCHED_PERSISTENCE = options['batched']
+        try:
+            elapsed, received = asyncio.run(self._run(users, room.id, count, options['batched']))
+            stored = ChatMessage.objects.filter(room=room).count()
+        finally:
+            settings.CHAT_BATCHED_PERSISTENCE = batched
+            # Messages and memberships go with the users and room
+            room.delete()
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        self.stdout.write(
+            f"Database: {connection.vendor}, listeners: {len(users) - 1}, "
+            f"persistence: {'batched' if options['batched'] else 'per message'}, stored: {stored}"
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'{count} messages in {elapsed:.2f}s: {count / elapsed:.0f} messages/s '
+            f'({received} deliveries)'
+        ))
+
+    async def _run(self, users, room_id, count, batched):
+        sender = SocketClient(users[0], room_id)
+        listeners = [SocketClient(user, room_id) for user in users[1:]]
+        for client in [sender] + listeners:
+            await client.connect()
+
+        async def drain(client):
+            # The sender also waits until every message is acknowledged as stored
+            delivered = 0
+            acknowledged = 0 if batched and client is sender else count
+            while delivered < count or acknowledged < count:
+                event = await client.receive()
+                if event['type'] == 'chat_message':
+                    delivered += 1
+                elif event['type'] == 'messages_persisted':
+                    acknowledged += len(event['message_ids'])
+
+        start = time.perf_counter()
+        receivers = [asyncio.ensure_future(drain(client)) for client in [sender] + listeners]
+        for i in range(count):
+            await sender.send({'type': 'chat_message', 'message': f'benchmark message {i}'})
+        await asyncio.gather(*receivers)
+        elapsed = time.perf_counter() - start
+
+        for client in [sender] + listeners:
+            await client.close()
+        return elapsed, count * len(receivers)
@@ -0,0 +1,87 @@
+import json
+import time
+import uuid
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
+from chat.models import ChatMessage, ChatRoom
+from chat.serializers import ChatMessageReadSerializer, ChatMessageSerializer
+from users.models import User
+from users.serializers import UserSerializer
+
+
+class FullUserChatMessageSerializer(ChatMessageSerializer):
+    """Chat messages as serialized before, with the full UserSerializer per sender"""
+    sender_details = UserSerializer(source='sender', read_only=True)
+
+
+class Command(BaseCommand):
+    help = 'Compare serialization time and queries of a page of chat messages, before and after the read path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000, help='Messages in the page')
+        parser.add_argument('--senders', type=int, default=2, help='Distinct senders in the room')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs of each path; the best is reported')
+
+    def handle(self, *args, **options):
+        count = max(options['messages'], 1)
+        tag = uuid.uuid4().hex[:8]
+        users = [
+            User.objects.create_user(username=f'chat-ser-{tag}-{i}', email=f'chat-ser-{tag}-{i}@example.com')
+            for i in range(max(options['senders'], 1))
+        ]
+        room = ChatRoom.objects.create(name=f'Serializer benchmark {tag}')
+        room.participants.add(*users)
+        now = timezone.now()
+        ChatMessage.objects.bulk_create([
+            ChatMessage(room=room, sender=users[i % len(users)], content=f'benchmark message {i}',
+                        timestamp=now + timedelta(microseconds=i))
+            for i in range(count)
+        ])
+
+        try:
+            page = ChatMessage.objects.filter(room=room).order_by('timestamp', 'id')
+            paths = [
+                ('ChatMessageSerializer + UserSerializer',
+                 lambda: FullUserChatMessageSerializer(page[:count], many=True).data),
+                ('ChatMessageSerializer + select_related',
+                 lambda: ChatMessageSerializer(page.select_related('sender')[:count], many=True).data),
+                ('ChatMessageReadSerializer',
+                 lambda: ChatMessageReadSerializer(page[:count]).data),
+            ]
+            results = [(name,) + self._measure(serialize, options['repeat']) for name, serialize in paths]
+
+            # The read path must render exactly what ChatMessageSerializer does
+            same = self._render(paths[1][1]()) == self._render(paths[2][1]())
+        finally:
+            room.delete()
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        self.stdout.write(f'Database: {connection.vendor}, page: {count} messages from {len(users)} senders')
+        baseline = results[0][1]
+        for name, elapsed, queries in results:
+            self.stdout.write(
+                f'{name:<40} {elapsed * 1000:8.1f} ms  {queries:5d} queries  {baseline / elapsed:5.1f}x'
+            )
+        if same:
+            self.stdout.write(self.style.SUCCESS('ChatMessageReadSerializer output matches ChatMessageSerializer'))
+        else:
+            self.stdout.write(self.style.ERROR('ChatMessageReadSerializer output differs from ChatMessageSerializer'))
+
+    @staticmethod
+    def _measure(serialize, repeat):
+        best = None
+        for _ in range(max(repeat, 1)):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                serialize()
+                elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, len(queries)
+
+    @staticmethod
+    def _render(data):
+        return json.loads(json.dumps(data, cls=JSONEncoder))
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.5 on 2026-10-17 04:16
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chatmessage_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='chatmessage',
+            options={'ordering': ['timestamp', 'id']},
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='chatmsg_room_timestamp_idx'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.1.5 on 2026-10-17 04:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_room_state(apps, schema_editor):
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    ChatReadState = apps.get_model('chat', 'ChatReadState')
+
+    for room in ChatRoom.objects.all().iterator():
+        latest = ChatMessage.objects.filter(room=room).order_by('-timestamp', '-id').first()
+        if latest is not None:
+            ChatRoom.objects.filter(pk=room.pk).update(last_message=latest, last_message_at=latest.timestamp)
+
+        states = []
+        for user_id in room.participants.values_list('id', flat=True):
+            unread = ChatMessage.objects.filter(room=room, is_read=False).exclude(sender_id=user_id).count()
+            states.append(ChatReadState(room=room, user_id=user_id, unread_count=unread))
+        ChatReadState.objects.bulk_create(states, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatmessage_room_timestamp_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.chatmessage'),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ChatReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_at', models.DateTimeField(blank=True, null=True)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('room', 'user'), name='chat_read_state_room_user_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill_room_state, migrations.RunPython.noop),
+    ]
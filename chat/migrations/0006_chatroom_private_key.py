@@ -0,0 +1,35 @@
+# Generated by Django 5.1.5 on 2026-10-17 04:19
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_private_keys(apps, schema_editor):
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+
+    # Rooms used to be found by having exactly two participants; the oldest room of each pair keeps the key
+    rooms = ChatRoom.objects.annotate(participant_count=Count('participants')).filter(
+        participant_count=2
+    ).order_by('created_at')
+    seen = set()
+    for room in rooms.iterator():
+        key = ':'.join(sorted(str(user_id) for user_id in room.participants.values_list('id', flat=True)))
+        if key not in seen:
+            seen.add(key)
+            ChatRoom.objects.filter(pk=room.pk).update(private_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_chat_read_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='private_key',
+            field=models.CharField(blank=True, editable=False, max_length=73, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_private_keys, migrations.RunPython.noop),
+    ]
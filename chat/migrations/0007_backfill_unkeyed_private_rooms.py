@@ -0,0 +1,29 @@
+from django.db import migrations
+from django.db.models import Count
+
+
+def backfill_unkeyed_private_rooms(apps, schema_editor):
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+
+    # Two-person rooms created through POST /api/chat/rooms/ after 0006 never got a key; the
+    # oldest room of each pair without a keyed room takes it
+    taken = set(ChatRoom.objects.filter(private_key__isnull=False).values_list('private_key', flat=True))
+    rooms = ChatRoom.objects.filter(private_key__isnull=True).annotate(
+        participant_count=Count('participants')
+    ).filter(participant_count=2).order_by('created_at')
+    for room in rooms.iterator():
+        key = ':'.join(sorted(str(user_id) for user_id in room.participants.values_list('id', flat=True)))
+        if key not in taken:
+            taken.add(key)
+            ChatRoom.objects.filter(pk=room.pk).update(private_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_chatroom_private_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_unkeyed_private_rooms, migrations.RunPython.noop),
+    ]
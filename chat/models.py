@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 import uuid
 from users.models import User
 
@@ -10,15 +11,28 @@ class ChatRoom(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
     
+    # Denormalized by ChatService.record_messages so room lists need no per-room queries
+    last_message = models.ForeignKey('ChatMessage', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    
+    # Set only on one-to-one rooms, so each pair of users has at most one
+    private_key = models.CharField(max_length=73, null=True, blank=True, unique=True, editable=False)
+    
     def __str__(self):
         return f"Chat Room: {self.name or self.id}"
+    
+    @staticmethod
+    def private_key_for(user_id, other_user_id) -> str:
+        """Order-independent key of the private room between two users"""
+        return ':'.join(sorted([str(user_id), str(other_user_id)]))
 
 class ChatMessage(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name="messages")
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name="sent_messages")
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Defaults to now; batched persistence stores the time the message was broadcast
+    timestamp = models.DateTimeField(default=timezone.now)
     is_read = models.BooleanField(default=False)
     read_at = models.DateTimeField(null=True, blank=True)
     
@@ -31,7 +45,26 @@ class ChatMessage(models.Model):
     longitude = models.FloatField(null=True, blank=True)
     
     class Meta:
-        ordering = ['timestamp']
+        ordering = ['timestamp', 'id']
+        indexes = [
+            # Keyset pagination of a room's history (chat.pagination)
+            models.Index(fields=['room', 'timestamp', 'id'], name='chatmsg_room_timestamp_idx'),
+        ]
     
     def __str__(self):
         return f"Message from {self.sender.username} in {self.room}"
+
+class ChatReadState(models.Model):
+    """How far one participant has read a room, with a running count of unread messages"""
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name="read_states")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="chat_read_states")
+    last_read_at = models.DateTimeField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'user'], name='chat_read_state_room_user_uniq'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username} in {self.room}: {self.unread_count} unread"
@@ -0,0 +1,86 @@
+"""
+Keyset pagination of a room's messages on (timestamp, id)
+"""
+import base64
+import uuid
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ChatMessage
+
+
+def encode_cursor(message: ChatMessage) -> str:
+    """Opaque cursor pointing at one message's (timestamp, id) position"""
+    raw = f'{message.timestamp.isoformat()}|{message.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    """(timestamp, id) from a cursor; raises ValueError when it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, message_id = raw.split('|')
+        timestamp = datetime.fromisoformat(timestamp)
+        message_id = uuid.UUID(message_id)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp, dt_timezone.utc)
+    return timestamp, message_id
+
+
+class MessagePage:
+    """
+    One page of a room's messages in chronological order. Without a cursor the newest page
+    is returned; `before` walks back through history and `after` fetches newer messages.
+    Each page is a range scan on the (room, timestamp, id) index, so its cost does not
+    grow with the length of the conversation.
+    """
+
+    def __init__(self, queryset, before=None, after=None, page_size=None):
+        if before and after:
+            raise ValueError('Use either before or after, not both')
+
+        default_size = getattr(settings, 'CHAT_MESSAGES_PAGE_SIZE', 50)
+        max_size = getattr(settings, 'CHAT_MESSAGES_MAX_PAGE_SIZE', 200)
+        try:
+            size = int(page_size) if page_size else default_size
+        except (TypeError, ValueError):
+            raise ValueError('page_size must be an integer')
+        self.page_size = max(1, min(size, max_size))
+
+        self.after = after
+        if after:
+            timestamp, message_id = decode_cursor(after)
+            rows = list(queryset.filter(
+                Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+            ).order_by('timestamp', 'id')[:self.page_size + 1])
+            self.has_newer = len(rows) > self.page_size
+            self.messages = rows[:self.page_size]
+            # Reaching an `after` page means older messages exist
+            self.has_older = True
+        else:
+            if before:
+                timestamp, message_id = decode_cursor(before)
+                queryset = queryset.filter(
+                    Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+                )
+            rows = list(queryset.order_by('-timestamp', '-id')[:self.page_size + 1])
+            self.has_older = len(rows) > self.page_size
+            self.messages = rows[:self.page_size][::-1]
+            self.has_newer = bool(before)
+
+    def metadata(self) -> dict:
+        first = self.messages[0] if self.messages else None
+        last = self.messages[-1] if self.messages else None
+        return {
+            'page_size': self.page_size,
+            'has_older': self.has_older,
+            'has_newer': self.has_newer,
+            'before': encode_cursor(first) if first and self.has_older else None,
+            # Always set when possible so clients can poll for new messages
+            'after': encode_cursor(last) if last else self.after,
+        }
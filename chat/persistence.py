@@ -0,0 +1,124 @@
+"""
+Batched write-behind persistence for chat messages
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+import weakref
+from collections import defaultdict
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+
+from .models import ChatMessage
+from .services import ChatService, message_owner_key
+
+logger = logging.getLogger(__name__)
+
+
+def time_ordered_uuid() -> uuid.UUID:
+    """UUID whose leading 48 bits are the Unix time in milliseconds (UUIDv7 layout), so ids sort by creation"""
+    value = (int(time.time() * 1000) & ((1 << 48) - 1)) << 80
+    value |= int.from_bytes(os.urandom(10), 'big') & ((1 << 80) - 1)
+    value = (value & ~(0xF << 76)) | (0x7 << 76)  # version 7
+    value = (value & ~(0x3 << 62)) | (0x2 << 62)  # RFC 4122 variant
+    return uuid.UUID(int=value)
+
+
+class ChatMessageBatcher:
+    """
+    Collects messages that were already broadcast and writes them with one bulk_create every
+    CHAT_PERSIST_FLUSH_MS milliseconds or CHAT_PERSIST_BATCH_SIZE messages. Timestamps are
+    strictly increasing per room within a worker, so (timestamp, id) order matches broadcast
+    order. Once a batch is written, each sender socket gets a messages_persisted event listing
+    its message ids; clients resend anything never acknowledged, and a resent id is ignored.
+    Ids found stored for another room or sender are reported as messages_not_persisted.
+    """
+
+    _batchers = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def for_running_loop(cls) -> 'ChatMessageBatcher':
+        loop = asyncio.get_running_loop()
+        batcher = cls._batchers.get(loop)
+        if batcher is None:
+            batcher = cls._batchers[loop] = cls()
+        return batcher
+
+    def __init__(self):
+        self.pending = []
+        # message id -> queued message, so a resend before the flush is recognised
+        self.pending_ids = {}
+        self.flush_task = None
+        self.last_timestamps = {}
+
+    def next_timestamp(self, room_id):
+        now = timezone.now()
+        last = self.last_timestamps.get(room_id)
+        if last is not None and now <= last:
+            now = last + timedelta(microseconds=1)
+        self.last_timestamps[room_id] = now
+        return now
+
+    def pending_message(self, message_id):
+        """The queued, not yet written message with this id, if any"""
+        return self.pending_ids.get(message_id)
+
+    def enqueue(self, message: ChatMessage, reply_channel: str) -> None:
+        """Queue a message for the next batch; queueing a pending message again only adds an acknowledgement"""
+        self.pending_ids.setdefault(message.id, message)
+        self.pending.append((message, reply_channel))
+        if len(self.pending) >= getattr(settings, 'CHAT_PERSIST_BATCH_SIZE', 200):
+            asyncio.ensure_future(self.flush())
+        elif self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(getattr(settings, 'CHAT_PERSIST_FLUSH_MS', 20) / 1000)
+        # Messages queued while this batch is being written schedule a flush of their own
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        written, self.pending_ids = self.pending_ids, {}
+        messages = list(written.values())
+        if not batch:
+            return
+
+        try:
+            _, conflicts = await self._write(messages)
+        except Exception:
+            logger.exception("Failed to persist %d chat messages", len(messages))
+            conflicts = messages
+        else:
+            if conflicts:
+                logger.warning("Rejected %d chat messages whose ids belong to another room or sender", len(conflicts))
+        rejected = {message.id for message in conflicts}
+
+        acknowledgements = defaultdict(list)
+        for message, reply_channel in batch:
+            # Another sender may have queued the same id first; only the first one is written
+            stored = message.id not in rejected and message_owner_key(message.room_id, message.sender_id) == \
+                message_owner_key(written[message.id].room_id, written[message.id].sender_id)
+            event_type = 'messages_persisted' if stored else 'messages_not_persisted'
+            acknowledgements[(reply_channel, event_type)].append(str(message.id))
+
+        channel_layer = get_channel_layer()
+        for (reply_channel, event_type), message_ids in acknowledgements.items():
+            try:
+                await channel_layer.send(reply_channel, {'type': event_type, 'message_ids': message_ids})
+            except Exception:
+                # The sender may have disconnected or its queue may be full; it will resend
+                logger.warning("Could not acknowledge %d chat messages", len(message_ids))
+
+    @staticmethod
+    @database_sync_to_async
+    def _write(messages):
+        # Resent messages keep their id; ones already stored are skipped and not counted again
+        return ChatService.save_messages(messages)
@@ -0,0 +1,227 @@
+"""
+Online presence and typing indicators for chat sockets
+"""
+import asyncio
+import binascii
+import logging
+import time
+import weakref
+from collections import defaultdict
+from typing import Dict, Iterable, Set
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+
+def presence_group_name(user_id):
+    """Group of the sockets that want to know when this user comes online or goes offline"""
+    return f'presence_{user_id}'
+
+
+class MemoryPresenceStore:
+    """Connections per user in this process; matches the in-memory channel layer"""
+
+    def __init__(self):
+        self.connections: Dict[str, Dict[str, float]] = defaultdict(dict)
+
+    def _live(self, user_id) -> Dict[str, float]:
+        now = time.time()
+        connections = self.connections.get(str(user_id), {})
+        for channel_name in [name for name, expires in connections.items() if expires <= now]:
+            del connections[channel_name]
+        return connections
+
+    async def add(self, user_id, channel_name: str, ttl: int) -> int:
+        """Register or refresh one socket; returns the user's live connection count"""
+        connections = self._live(user_id)
+        connections[channel_name] = time.time() + ttl
+        self.connections[str(user_id)] = connections
+        return len(connections)
+
+    async def remove(self, user_id, channel_name: str) -> int:
+        connections = self._live(user_id)
+        connections.pop(channel_name, None)
+        if not connections:
+            self.connections.pop(str(user_id), None)
+        return len(connections)
+
+    async def online(self, user_ids: Iterable) -> Set[str]:
+        return {str(user_id) for user_id in user_ids if self._live(user_id)}
+
+
+class RedisPresenceStore:
+    """
+    Connections per user as a Redis sorted set of channel names scored by expiry, on the
+    servers of the channel layer. Sockets refresh their entry every heartbeat, so the
+    connections of a worker that died without disconnecting expire on their own.
+    """
+
+    def __init__(self, hosts, prefix: str):
+        self.hosts = hosts
+        self.prefix = prefix
+        # redis.asyncio clients are bound to the event loop that created them
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self, key: str):
+        from redis import asyncio as aioredis
+
+        loop = asyncio.get_running_loop()
+        clients = self._clients.get(loop)
+        if clients is None:
+            clients = self._clients[loop] = {}
+        index = binascii.crc32(key.encode()) % len(self.hosts)
+        if index not in clients:
+            host = self.hosts[index]
+            if isinstance(host, str):
+                clients[index] = aioredis.Redis.from_url(host)
+            else:
+                clients[index] = aioredis.Redis(host=host[0], port=host[1])
+        return clients[index]
+
+    def _key(self, user_id) -> str:
+        return f'{self.prefix}:presence:{user_id}'
+
+    async def add(self, user_id, channel_name: str, ttl: int) -> int:
+        key = self._key(user_id)
+        now = time.time()
+        async with self._client(key).pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zadd(key, {channel_name: now + ttl})
+            pipe.expire(key, ttl)
+            pipe.zcard(key)
+            results = await pipe.execute()
+        return results[-1]
+
+    async def remove(self, user_id, channel_name: str) -> int:
+        key = self._key(user_id)
+        async with self._client(key).pipeline(transaction=True) as pipe:
+            pipe.zrem(key, channel_name)
+            pipe.zremrangebyscore(key, '-inf', time.time())
+            pipe.zcard(key)
+            results = await pipe.execute()
+        return results[-1]
+
+    async def online(self, user_ids: Iterable) -> Set[str]:
+        now = time.time()
+        online = set()
+        for user_id in user_ids:
+            key = self._key(user_id)
+            if await self._client(key).zcount(key, now, '+inf'):
+                online.add(str(user_id))
+        return online
+
+
+_store = None
+
+
+def get_presence_store():
+    """Presence store matching CHANNEL_LAYER_BACKEND: Redis when the layer is, else this process"""
+    global _store
+    if _store is None:
+        if getattr(settings, 'CHANNEL_LAYER_BACKEND', 'memory') == 'memory':
+            _store = MemoryPresenceStore()
+        else:
+            _store = RedisPresenceStore(settings.CHANNEL_LAYER_HOSTS, settings.CHANNEL_LAYERS['default']
+                                        .get('CONFIG', {}).get('prefix', 'imarket'))
+    return _store
+
+
+@receiver(setting_changed)
+def reset_presence_store(setting, **kwargs):
+    # The store follows the channel layer settings, so pick it again when they change
+    global _store
+    if setting in ('CHANNEL_LAYER_BACKEND', 'CHANNEL_LAYER_HOSTS', 'CHANNEL_LAYERS'):
+        _store = None
+
+
+class PresenceBroadcaster:
+    """
+    Coalesces presence and typing changes before they reach the channel layer. Changes are
+    held for CHAT_PRESENCE_BROADCAST_MS; a user who reconnects within that window, or
+    toggles typing back, produces no event at all. Each room gets at most one typing
+    broadcast per window, listing every change since the last one, and a user who keeps
+    typing is re-announced only every CHAT_TYPING_REFRESH_SECONDS.
+    """
+
+    _broadcasters = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def for_running_loop(cls) -> 'PresenceBroadcaster':
+        loop = asyncio.get_running_loop()
+        broadcaster = cls._broadcasters.get(loop)
+        if broadcaster is None:
+            broadcaster = cls._broadcasters[loop] = cls()
+        return broadcaster
+
+    def __init__(self):
+        # user id -> (state before the first pending change, latest state)
+        self.pending_status = {}
+        # room group -> {user id: is typing}
+        self.pending_typing = defaultdict(dict)
+        # (room group, user id) -> (is typing, monotonic time it was last broadcast)
+        self.typing_sent = {}
+        self.flush_task = None
+
+    def set_online(self, user_id, online: bool) -> None:
+        user_id = str(user_id)
+        before = self.pending_status[user_id][0] if user_id in self.pending_status else not online
+        self.pending_status[user_id] = (before, online)
+        self._schedule()
+
+    def set_typing(self, group_name: str, user_id, is_typing: bool) -> None:
+        user_id = str(user_id)
+        # Nothing new to say, unless a pending change is being undone
+        if not self._typing_news(group_name, user_id, is_typing, time.monotonic()) \
+                and user_id not in self.pending_typing.get(group_name, {}):
+            return
+        self.pending_typing[group_name][user_id] = is_typing
+        self._schedule()
+
+    def _typing_news(self, group_name: str, user_id: str, is_typing: bool, now: float) -> bool:
+        """Whether the room has not heard this yet, or a still-typing user is due a refresh"""
+        sent = self.typing_sent.get((group_name, user_id))
+        if is_typing != (sent is not None):
+            return True
+        return is_typing and now - sent[1] >= getattr(settings, 'CHAT_TYPING_REFRESH_SECONDS', 3)
+
+    def _schedule(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(getattr(settings, 'CHAT_PRESENCE_BROADCAST_MS', 250) / 1000)
+        await self.flush()
+
+    async def flush(self):
+        statuses, self.pending_status = self.pending_status, {}
+        typing, self.pending_typing = self.pending_typing, defaultdict(dict)
+        channel_layer = get_channel_layer()
+        now = time.monotonic()
+
+        sends = []
+        for user_id, (before, online) in statuses.items():
+            if before != online:
+                sends.append((presence_group_name(user_id), {'type': 'presence', 'user_id': user_id, 'online': online}))
+
+        for group_name, changes in typing.items():
+            events = []
+            for user_id, is_typing in changes.items():
+                if not self._typing_news(group_name, user_id, is_typing, now):
+                    continue
+                events.append({'user_id': user_id, 'is_typing': is_typing})
+                if is_typing:
+                    self.typing_sent[(group_name, user_id)] = (True, now)
+                else:
+                    self.typing_sent.pop((group_name, user_id), None)
+            if events:
+                sends.append((group_name, {'type': 'typing', 'events': events}))
+
+        for group_name, event in sends:
+            try:
+                await channel_layer.group_send(group_name, event)
+            except Exception:
+                logger.warning("Could not broadcast %s to %s", event['type'], group_name)
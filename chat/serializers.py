@@ -1,18 +1,83 @@
 from rest_framework import serializers
-from .models import ChatRoom, ChatMessage
-from users.serializers import UserSerializer
+from .models import ChatRoom, ChatMessage, ChatReadState
+from users.models import User
+
+# The user fields shown next to chat messages and room participants
+CHAT_USER_FIELDS = ['id', 'username', 'first_name', 'last_name', 'profile_picture', 'role']
+
+CHAT_MESSAGE_FIELDS = ['id', 'room', 'sender', 'sender_details', 'content', 'timestamp',
+                       'is_read', 'read_at', 'attachment', 'attachment_type', 'latitude', 'longitude']
+
+
+class ChatUserSerializer(serializers.ModelSerializer):
+    """Compact read-only projection of a user in chat"""
+    
+    class Meta:
+        model = User
+        fields = CHAT_USER_FIELDS
+        read_only_fields = CHAT_USER_FIELDS
+
 
 class ChatMessageSerializer(serializers.ModelSerializer):
-    sender_details = UserSerializer(source='sender', read_only=True)
+    sender_details = ChatUserSerializer(source='sender', read_only=True)
     
     class Meta:
         model = ChatMessage
-        fields = ['id', 'room', 'sender', 'sender_details', 'content', 'timestamp', 
-                  'is_read', 'read_at', 'attachment', 'attachment_type', 'latitude', 'longitude']
+        fields = CHAT_MESSAGE_FIELDS
         read_only_fields = ['id', 'timestamp', 'read_at']
 
+
+class ChatMessageReadSerializer:
+    """
+    Read-only fast path producing the same output as ChatMessageSerializer for pages of
+    messages. Senders are loaded once per page as a values() projection of CHAT_USER_FIELDS
+    instead of a full user row per message, and fields are rendered by hand.
+    Accepts ChatMessage instances or dicts from ChatMessage.objects.values().
+    """
+    
+    timestamp_field = serializers.DateTimeField()
+    
+    def __init__(self, messages, context=None):
+        self.messages = list(messages)
+        self.request = (context or {}).get('request')
+    
+    @property
+    def data(self):
+        rows = [message if isinstance(message, dict) else message.__dict__ for message in self.messages]
+        senders = self._senders({row['sender_id'] for row in rows})
+        to_datetime = self.timestamp_field.to_representation
+        return [{
+            'id': str(row['id']),
+            'room': str(row['room_id']),
+            'sender': str(row['sender_id']),
+            'sender_details': senders.get(row['sender_id']),
+            'content': row['content'],
+            'timestamp': to_datetime(row['timestamp']),
+            'is_read': row['is_read'],
+            'read_at': to_datetime(row['read_at']) if row['read_at'] else None,
+            'attachment': self._file_url(ChatMessage, 'attachment', row['attachment']),
+            'attachment_type': row['attachment_type'],
+            'latitude': row['latitude'],
+            'longitude': row['longitude'],
+        } for row in rows]
+    
+    def _senders(self, sender_ids):
+        senders = {}
+        for user in User.objects.filter(id__in=sender_ids).values(*CHAT_USER_FIELDS):
+            user['profile_picture'] = self._file_url(User, 'profile_picture', user['profile_picture'])
+            senders[user['id']] = {**user, 'id': str(user['id'])}
+        return senders
+    
+    def _file_url(self, model, field_name, name):
+        # Model instances hold a FieldFile, values() rows the stored name
+        name = getattr(name, 'name', name)
+        if not name:
+            return None
+        url = model._meta.get_field(field_name).storage.url(name)
+        return self.request.build_absolute_uri(url) if self.request is not None else url
+
 class ChatRoomSerializer(serializers.ModelSerializer):
-    participants_details = UserSerializer(source='participants', many=True, read_only=True)
+    participants_details = ChatUserSerializer(source='participants', many=True, read_only=True)
     last_message = serializers.SerializerMethodField()
     unread_count = serializers.SerializerMethodField()
     
@@ -23,12 +88,16 @@ class ChatRoomSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at', 'updated_at']
     
     def get_last_message(self, obj):
-        last_msg = obj.messages.order_by('-timestamp').first()
-        if last_msg:
-            return ChatMessageSerializer(last_msg).data
+        # Maintained by ChatService; select_related('last_message__sender') avoids a query
+        if obj.last_message_id:
+            return ChatMessageSerializer(obj.last_message).data
         return None
     
     def get_unread_count(self, obj):
         user = self.context.get('request').user
-        return obj.messages.filter(is_read=False).exclude(sender=user).count()
+        # ChatRoomViewSet prefetches the viewer's read state as viewer_read_states
+        states = getattr(obj, 'viewer_read_states', None)
+        if states is None:
+            states = ChatReadState.objects.filter(room=obj, user=user)
+        return next((state.unread_count for state in states), 0)
 
@@ -0,0 +1,157 @@
+"""
+Room-level chat state kept in step with messages: private-room keys, last-message pointers and read state
+"""
+import uuid
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import ChatMessage, ChatReadState, ChatRoom
+
+
+def message_owner_key(room_id, sender_id) -> Tuple[uuid.UUID, str]:
+    """Comparable (room, sender) of a message, whatever form the ids were given in"""
+    return uuid.UUID(str(room_id)), str(sender_id)
+
+
+class ChatService:
+    """Service class for writing messages and read receipts together with the counters they affect"""
+
+    @staticmethod
+    def get_or_create_private_room(user, other_user) -> Tuple[ChatRoom, bool]:
+        """The one-to-one room of two users by its unique key, created with both participants if missing"""
+        key = ChatRoom.private_key_for(user.id, other_user.id)
+        room = ChatRoom.objects.filter(private_key=key).first()
+        if room is not None:
+            return room, False
+
+        # The unique key makes concurrent creators converge: the loser's insert fails and it reads the winner's room
+        with transaction.atomic():
+            room, created = ChatRoom.objects.get_or_create(
+                private_key=key, defaults={'name': f"Chat with {other_user.username}"}
+            )
+            if created:
+                room.participants.add(user, other_user)
+        return room, created
+
+    @staticmethod
+    def sync_private_keys(room_ids: Iterable) -> None:
+        """Key rooms that now have exactly two participants, and unkey rooms that no longer do"""
+        for room_id in room_ids:
+            participant_ids = list(ChatRoom.participants.through.objects.filter(
+                chatroom_id=room_id
+            ).values_list('user_id', flat=True)[:3])
+            key = ChatRoom.private_key_for(*participant_ids) if len(participant_ids) == 2 else None
+            room = ChatRoom.objects.filter(id=room_id)
+            if key is None:
+                room.exclude(private_key=None).update(private_key=None)
+                continue
+            # The pair may already have a private room; that one keeps the key
+            try:
+                with transaction.atomic():
+                    if not ChatRoom.objects.filter(private_key=key).exists():
+                        room.update(private_key=key)
+            except IntegrityError:
+                pass
+
+    @staticmethod
+    def send_message(room_id, sender_id, content: str, **fields) -> ChatMessage:
+        """Create one message and update its room's pointers and unread counters atomically"""
+        with transaction.atomic():
+            message = ChatMessage.objects.create(room_id=room_id, sender_id=sender_id, content=content, **fields)
+            ChatService.record_messages([message])
+        return message
+
+    @staticmethod
+    def save_messages(messages: List[ChatMessage]) -> Tuple[List[ChatMessage], List[ChatMessage]]:
+        """
+        Bulk insert messages and record the new ones. An id already stored for the same room
+        and sender is a resend and is skipped; one stored for another room or sender is a
+        conflict and is not written. Returns (new messages, conflicting messages).
+        """
+        with transaction.atomic():
+            # Resent messages keep their id and must not be counted twice
+            existing = {
+                message_id: message_owner_key(room_id, sender_id)
+                for message_id, room_id, sender_id in ChatMessage.objects.filter(
+                    id__in=[message.id for message in messages]
+                ).values_list('id', 'room_id', 'sender_id')
+            }
+            new_messages = []
+            conflicts = []
+            for message in messages:
+                owner = existing.get(message.id)
+                if owner is None:
+                    new_messages.append(message)
+                elif owner != message_owner_key(message.room_id, message.sender_id):
+                    conflicts.append(message)
+            ChatMessage.objects.bulk_create(new_messages, ignore_conflicts=True)
+            ChatService.record_messages(new_messages)
+        return new_messages, conflicts
+
+    @staticmethod
+    def message_owner(message_id) -> Optional[Tuple[uuid.UUID, str]]:
+        """message_owner_key of a stored message, or None when the id is unused"""
+        owner = ChatMessage.objects.filter(id=message_id).values_list('room_id', 'sender_id').first()
+        return message_owner_key(*owner) if owner else None
+
+    @staticmethod
+    def record_messages(messages: Iterable[ChatMessage]) -> None:
+        """Advance last_message and bump other participants' unread counts for stored messages"""
+        latest = {}
+        sent = Counter()
+        for message in messages:
+            current = latest.get(message.room_id)
+            if current is None or (message.timestamp, str(message.id)) > (current.timestamp, str(current.id)):
+                latest[message.room_id] = message
+            sent[(message.room_id, message.sender_id)] += 1
+
+        for room_id, message in latest.items():
+            # Conditional, so a late or concurrent writer never moves the pointer backwards
+            ChatRoom.objects.filter(id=room_id).filter(
+                Q(last_message_at__isnull=True) | Q(last_message_at__lte=message.timestamp)
+            ).update(last_message=message, last_message_at=message.timestamp)
+
+        for (room_id, sender_id), count in sent.items():
+            ChatReadState.objects.filter(room_id=room_id).exclude(user_id=sender_id).update(
+                unread_count=F('unread_count') + count
+            )
+
+    @staticmethod
+    def mark_room_read(room_id, user_id) -> int:
+        """Mark messages from others as read for this user and reset their counter; returns messages updated"""
+        now = timezone.now()
+        with transaction.atomic():
+            updated = ChatMessage.objects.filter(
+                room_id=room_id,
+                is_read=False
+            ).exclude(
+                sender_id=user_id
+            ).update(
+                is_read=True,
+                read_at=now
+            )
+            ChatReadState.objects.update_or_create(
+                room_id=room_id, user_id=user_id,
+                defaults={'unread_count': 0, 'last_read_at': now}
+            )
+        return updated
+
+    @staticmethod
+    def add_read_states(room_id, user_ids: Iterable) -> None:
+        """Start read state for new participants; earlier messages count as already read"""
+        ChatReadState.objects.bulk_create(
+            [ChatReadState(room_id=room_id, user_id=user_id, last_read_at=timezone.now()) for user_id in user_ids],
+            ignore_conflicts=True
+        )
+
+    @staticmethod
+    def remove_read_states(room_id, user_ids: Iterable = None) -> None:
+        """Drop read state of participants who left (all of them when user_ids is None)"""
+        states = ChatReadState.objects.filter(room_id=room_id)
+        if user_ids is not None:
+            states = states.filter(user_id__in=list(user_ids))
+        states.delete()
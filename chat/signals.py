@@ -0,0 +1,75 @@
+"""
+Signal handlers keeping read state and connected chat sockets in step with room membership
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save
+from django.dispatch import receiver
+from .consumers import room_group_name
+from .models import ChatReadState, ChatRoom
+from .services import ChatService
+
+
+def notify_membership_changed(room_ids):
+    """Have every socket in the rooms reload its cached participant set"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    for room_id in room_ids:
+        async_to_sync(channel_layer.group_send)(room_group_name(room_id), {'type': 'membership_changed'})
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # user.chat_rooms.clear() does not say which rooms it left, so note them first
+        instance._cleared_room_ids = list(instance.chat_rooms.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    # room.participants.add(user) passes the room; user.chat_rooms.add(room) passes room ids
+    if reverse:
+        room_ids = list(pk_set or getattr(instance, '_cleared_room_ids', []))
+    else:
+        room_ids = [instance.pk]
+    transaction.on_commit(lambda: notify_membership_changed(room_ids))
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def sync_read_states(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_clear':
+        if reverse:
+            ChatReadState.objects.filter(user_id=instance.pk).delete()
+        else:
+            ChatService.remove_read_states(instance.pk)
+        return
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+
+    update = ChatService.add_read_states if action == 'post_add' else ChatService.remove_read_states
+    if reverse:
+        for room_id in pk_set:
+            update(room_id, [instance.pk])
+    else:
+        update(instance.pk, pk_set)
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def sync_private_keys(sender, instance, action, reverse, pk_set, **kwargs):
+    """Two-person rooms are private rooms, however they were created"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        room_ids = pk_set or getattr(instance, '_cleared_room_ids', [])
+    else:
+        room_ids = [instance.pk]
+    ChatService.sync_private_keys(room_ids)
+
+
+@receiver(post_save, sender=ChatRoom)
+def room_saved(sender, instance, created, **kwargs):
+    # Closing a room disconnects its sockets
+    if not created and not instance.is_active:
+        transaction.on_commit(lambda: notify_membership_changed([instance.pk]))
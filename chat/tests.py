@@ -1,3 +1,751 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import os
+import runpy
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users.models import User
+from .models import ChatMessage, ChatReadState, ChatRoom
+from .pagination import decode_cursor
+from .persistence import time_ordered_uuid
+from .presence import MemoryPresenceStore, RedisPresenceStore, get_presence_store
+from .serializers import ChatMessageReadSerializer, ChatMessageSerializer
+from .services import ChatService, message_owner_key
+
+
+def make_user(name, role=User.ROLE_USER):
+    return User.objects.create_user(username=name, email=f'{name}@example.com', password='pass', role=role)
+
+
+def chat_socket(room_id, user=None):
+    from iMarket.asgi import application
+
+    query = f'?token={AccessToken.for_user(user)}' if user is not None else ''
+    return WebsocketCommunicator(application, f'/ws/chat/{room_id}/{query}')
+
+
+async def connected_socket(test, room_id, user):
+    communicator = chat_socket(room_id, user)
+    connected, _ = await communicator.connect()
+    test.assertTrue(connected)
+    return communicator
+
+
+class FakeRedis:
+    """
+    In-process stand-in for one Redis server, covering the sorted-set commands and the Lua
+    scripts that channels_redis and RedisPresenceStore run
+    """
+
+    def __init__(self):
+        self.sorted_sets = defaultdict(dict)
+
+    @staticmethod
+    def _key(key):
+        return key.decode() if isinstance(key, bytes) else key
+
+    def _members(self, key):
+        return self.sorted_sets[self._key(key)]
+
+    def _in_range(self, score, low, high):
+        return float(low) <= score <= float(high)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def __getattr__(self, command):
+        run = getattr(self, f'cmd_{command}')
+
+        async def call(*args, **kwargs):
+            return run(*args, **kwargs)
+        return call
+
+    def cmd_zadd(self, key, mapping):
+        members = self._members(key)
+        for member, score in mapping.items():
+            members[member.encode() if isinstance(member, str) else member] = float(score)
+        return len(mapping)
+
+    def cmd_zrem(self, key, *members):
+        return sum(self._members(key).pop(m.encode() if isinstance(m, str) else m, None) is not None
+                   for m in members)
+
+    def cmd_zremrangebyscore(self, key, min, max):
+        members = self._members(key)
+        expired = [member for member, score in members.items() if self._in_range(score, min, max)]
+        for member in expired:
+            del members[member]
+        return len(expired)
+
+    def cmd_zcount(self, key, min, max):
+        return sum(1 for score in self._members(key).values() if self._in_range(score, min, max))
+
+    def cmd_zcard(self, key):
+        return len(self._members(key))
+
+    def cmd_zrange(self, key, start, end):
+        ordered = sorted(self._members(key), key=self._members(key).get)
+        return ordered[start:None if end == -1 else end + 1]
+
+    def cmd_zpopmin(self, key):
+        members = self._members(key)
+        if not members:
+            return []
+        member = min(members, key=members.get)
+        return [(member, members.pop(member))]
+
+    def cmd_expire(self, key, seconds):
+        return True
+
+    async def bzpopmin(self, key, timeout=0):
+        deadline = time.monotonic() + timeout
+        while True:
+            popped = self.cmd_zpopmin(key)
+            if popped:
+                return (key, *popped[0])
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(0.005)
+
+    async def eval(self, script, numkeys, *args):
+        keys, argv = args[:numkeys], args[numkeys:]
+        if 'backed_up' in script:
+            # Put messages a cancelled receive had taken back on the channel
+            channel, backup = argv
+            self._members(channel).update(self._members(backup))
+            self.sorted_sets.pop(self._key(backup), None)
+        elif 'over_capacity' in script:
+            # group_send: one message per channel key unless the channel is full
+            messages, capacities, now = argv[:len(keys)], argv[len(keys):2 * len(keys)], argv[-2]
+            over_capacity = 0
+            for key, message, capacity in zip(keys, messages, capacities):
+                if self.cmd_zcard(key) < int(capacity):
+                    self.cmd_zadd(key, {message: now})
+                else:
+                    over_capacity += 1
+            return over_capacity
+        else:
+            raise NotImplementedError(script)
+
+    async def close(self, close_connection_pool=None):
+        pass
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def __getattr__(self, command):
+        return lambda *args, **kwargs: self.commands.append((getattr(self.redis, f'cmd_{command}'), args, kwargs))
+
+    async def execute(self):
+        return [run(*args, **kwargs) for run, args, kwargs in self.commands]
+
+
+def channel_layer_settings(**environ):
+    """The channel layer settings iMarket/settings.py derives from these environment variables"""
+    with mock.patch.dict(os.environ, environ):
+        values = runpy.run_path(str(settings.BASE_DIR / 'iMarket' / 'settings.py'))
+    return {name: values[name] for name in ('CHANNEL_LAYER_BACKEND', 'CHANNEL_LAYER_HOSTS', 'CHANNEL_LAYERS')}
+
+
+class FakeRedisServers:
+    """Route the channel layer and presence store to FakeRedis servers, one per host URL"""
+
+    def __init__(self, test):
+        self.servers = defaultdict(FakeRedis)
+        for patcher in (
+            mock.patch('redis.asyncio.Redis.from_url', side_effect=lambda url: self.servers[url]),
+            mock.patch.object(RedisChannelLayer, 'connection',
+                              lambda layer, index: self.servers[layer.hosts[index]['address']]),
+        ):
+            patcher.start()
+            test.addCleanup(patcher.stop)
+
+
+class PrivateRoomTests(TestCase):
+    def setUp(self):
+        self.seller = make_user('seller', User.ROLE_SELLER)
+        self.buyer = make_user('buyer')
+        self.client = APIClient()
+
+    def test_posted_two_person_room_is_the_private_room(self):
+        self.client.force_authenticate(self.buyer)
+        response = self.client.post('/api/chat/rooms/', {'name': 'Hello', 'participants': [str(self.seller.id)]},
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+        room = ChatRoom.objects.get(id=response.data['id'])
+        self.assertEqual(room.private_key, ChatRoom.private_key_for(self.seller.id, self.buyer.id))
+
+        # The seller's inbox lists it, and opening the conversation reuses it
+        self.client.force_authenticate(self.seller)
+        inbox = self.client.get('/api/chat/seller/messages/conversations/').data['results']
+        self.assertEqual([entry['room_id'] for entry in inbox], [room.id])
+        conversation = self.client.get(f'/api/chat/seller/messages/{self.buyer.id}/user_conversation/')
+        self.assertEqual(conversation.data['room']['id'], str(room.id))
+        self.assertEqual(ChatRoom.objects.count(), 1)
+
+    def test_key_follows_membership(self):
+        room = ChatRoom.objects.create(name='Group')
+        room.participants.add(self.seller)
+        self.assertIsNone(ChatRoom.objects.get(id=room.id).private_key)
+        room.participants.add(self.buyer)
+        self.assertIsNotNone(ChatRoom.objects.get(id=room.id).private_key)
+        room.participants.add(make_user('third'))
+        self.assertIsNone(ChatRoom.objects.get(id=room.id).private_key)
+
+    def test_existing_private_room_keeps_the_key(self):
+        private, created = ChatService.get_or_create_private_room(self.buyer, self.seller)
+        self.assertTrue(created)
+        other = ChatRoom.objects.create(name='Second')
+        other.participants.add(self.buyer, self.seller)
+        self.assertIsNone(ChatRoom.objects.get(id=other.id).private_key)
+        self.assertEqual(ChatService.get_or_create_private_room(self.seller, self.buyer), (private, False))
+
+
+class ConversationListTests(TestCase):
+    def setUp(self):
+        self.seller = make_user('seller', User.ROLE_SELLER)
+        self.buyers = [make_user(f'buyer{i}') for i in range(4)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.seller)
+
+    def private_room(self, buyer, *messages):
+        room, _ = ChatService.get_or_create_private_room(buyer, self.seller)
+        for sender, minutes in messages:
+            ChatService.send_message(room.id, sender.id, f'at {minutes}',
+                                     timestamp=timezone.now() + timedelta(minutes=minutes))
+        return room
+
+    def conversations(self, **params):
+        return self.client.get('/api/chat/seller/messages/conversations/', params).data
+
+    def test_most_recent_first_in_a_fixed_number_of_queries(self):
+        quiet = self.private_room(self.buyers[0])
+        older = self.private_room(self.buyers[1], (self.buyers[1], 1))
+        newer = self.private_room(self.buyers[2], (self.buyers[2], 2), (self.buyers[2], 3), (self.seller, 4))
+        group = ChatRoom.objects.create(name='Group')
+        group.participants.add(self.seller, self.buyers[0], self.buyers[1])
+        ChatService.send_message(group.id, self.buyers[0].id, 'group')
+
+        with self.assertNumQueries(3):
+            results = self.conversations()['results']
+        self.assertEqual([entry['room_id'] for entry in results], [newer.id, older.id, quiet.id])
+        self.assertEqual([entry['unread_count'] for entry in results], [2, 1, 0])
+        self.assertEqual(results[0]['last_message']['content'], 'at 4')
+        self.assertIsNone(results[2]['last_message'])
+
+        self.private_room(self.buyers[3], (self.buyers[3], 5))
+        with self.assertNumQueries(3):
+            page = self.conversations(page_size=2)
+        self.assertEqual([entry['user']['username'] for entry in page['results']], ['buyer3', 'buyer2'])
+        self.assertTrue(page['has_more'])
+
+    def test_unkeyed_two_person_rooms_are_listed(self):
+        keyed = self.private_room(self.buyers[0], (self.buyers[0], 1))
+        second = ChatRoom.objects.create(name='Second')
+        second.participants.add(self.buyers[0], self.seller)
+        self.assertIsNone(ChatRoom.objects.get(id=second.id).private_key)
+        ChatService.send_message(second.id, self.buyers[0].id, 'later', timestamp=timezone.now() + timedelta(minutes=2))
+
+        results = self.conversations()['results']
+        self.assertEqual([entry['room_id'] for entry in results], [second.id, keyed.id])
+        self.assertEqual(results[0]['user']['id'], self.buyers[0].id)
+
+
+class ChatConsumerAccessTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.room = ChatRoom.objects.create(name='Room')
+        self.room.participants.add(self.alice, self.bob)
+
+    async def assertRefused(self, room_id, user, code):
+        connected, close_code = await chat_socket(room_id, user).connect()
+        self.assertEqual((connected, close_code), (False, code))
+
+    async def test_anonymous_socket_is_refused(self):
+        await self.assertRefused(self.room.id, None, 4401)
+
+    async def test_non_member_and_unknown_rooms_are_refused(self):
+        await self.assertRefused(self.room.id, await database_sync_to_async(make_user)('mallory'), 4403)
+        await self.assertRefused('not-a-room-id', self.alice, 4403)
+        await self.assertRefused('00000000-0000-0000-0000-000000000000', self.alice, 4403)
+
+        self.room.is_active = False
+        await database_sync_to_async(self.room.save)()
+        await self.assertRefused(self.room.id, self.alice, 4403)
+
+    async def test_sender_is_the_authenticated_user(self):
+        alice = await connected_socket(self, self.room.id, self.alice)
+        await alice.receive_json_from()
+        await alice.send_json_to({'type': 'chat_message', 'message': 'hi', 'sender_id': str(self.bob.id)})
+        message = await alice.receive_json_from()
+        self.assertEqual(message['sender_id'], str(self.alice.id))
+        self.assertTrue(await database_sync_to_async(
+            ChatMessage.objects.filter(sender=self.alice, content='hi').exists
+        )())
+        await alice.disconnect()
+
+    async def test_removed_participant_is_disconnected(self):
+        alice = await connected_socket(self, self.room.id, self.alice)
+        bob = await connected_socket(self, self.room.id, self.bob)
+        await alice.receive_json_from()
+        await bob.receive_json_from()
+
+        await database_sync_to_async(self.room.participants.remove)(self.bob)
+        self.assertEqual(await bob.receive_output(), {'type': 'websocket.close', 'code': 4403})
+
+        # Those still in the room stay connected
+        await alice.send_json_to({'type': 'chat_message', 'message': 'still here'})
+        while (message := await alice.receive_json_from())['type'] != 'chat_message':
+            pass
+        self.assertEqual(message['message'], 'still here')
+        await alice.disconnect()
+
+
+@override_settings(CHAT_PRESENCE_BROADCAST_MS=10)
+class ChatPresenceTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.room = ChatRoom.objects.create(name='Room')
+        self.room.participants.add(self.alice, self.bob)
+
+    async def test_presence_state_and_online_events(self):
+        alice = await connected_socket(self, self.room.id, self.alice)
+        self.assertEqual(await alice.receive_json_from(), {'type': 'presence_state', 'online_user_ids': []})
+
+        bob = await connected_socket(self, self.room.id, self.bob)
+        self.assertEqual(await bob.receive_json_from(),
+                         {'type': 'presence_state', 'online_user_ids': [str(self.alice.id)]})
+        self.assertEqual(await alice.receive_json_from(),
+                         {'type': 'presence', 'user_id': str(self.bob.id), 'online': True})
+
+        await bob.disconnect()
+        self.assertEqual(await alice.receive_json_from(),
+                         {'type': 'presence', 'user_id': str(self.bob.id), 'online': False})
+        await alice.disconnect()
+
+    async def test_typing_is_coalesced(self):
+        alice = await connected_socket(self, self.room.id, self.alice)
+        bob = await connected_socket(self, self.room.id, self.bob)
+        await alice.receive_json_from()
+        await alice.receive_json_from()
+        await bob.receive_json_from()
+
+        for _ in range(10):
+            await bob.send_json_to({'type': 'typing', 'is_typing': True})
+        self.assertEqual(await alice.receive_json_from(),
+                         {'type': 'typing', 'events': [{'user_id': str(self.bob.id), 'is_typing': True}]})
+        self.assertTrue(await alice.receive_nothing(timeout=0.1))
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_unavailable_presence_store_does_not_break_chat(self):
+        store = mock.Mock()
+        store.add = mock.AsyncMock(side_effect=ConnectionError)
+        store.remove = mock.AsyncMock(side_effect=ConnectionError)
+        with mock.patch('chat.consumers.get_presence_store', return_value=store), \
+                self.assertLogs('chat.consumers', 'WARNING') as logs:
+            alice = await connected_socket(self, self.room.id, self.alice)
+            await alice.send_json_to({'type': 'chat_message', 'message': 'still here'})
+            message = await alice.receive_json_from()
+            self.assertEqual((message['type'], message['message']), ('chat_message', 'still here'))
+            await alice.disconnect()
+        self.assertEqual(len(logs.output), 2)
+
+
+class PresenceStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.servers = FakeRedisServers(self).servers
+        self.store = RedisPresenceStore(['redis://one', 'redis://two'], 'test')
+
+    async def test_connections_are_counted_per_user(self):
+        self.assertEqual(await self.store.add('alice', 'socket-1', 60), 1)
+        self.assertEqual(await self.store.add('alice', 'socket-2', 60), 2)
+        self.assertEqual(await self.store.add('alice', 'socket-2', 60), 2)
+        self.assertEqual(await self.store.add('bob', 'socket-3', 60), 1)
+        self.assertEqual(await self.store.online(['alice', 'bob', 'carol']), {'alice', 'bob'})
+
+        self.assertEqual(await self.store.remove('alice', 'socket-1'), 1)
+        self.assertEqual(await self.store.remove('alice', 'socket-2'), 0)
+        self.assertEqual(await self.store.online(['alice', 'bob']), {'bob'})
+
+    async def test_expired_connections_are_not_online(self):
+        await self.store.add('alice', 'dead-worker', -1)
+        self.assertEqual(await self.store.online(['alice']), set())
+        self.assertEqual(await self.store.add('alice', 'socket-1', 60), 1)
+
+    async def test_keys_are_prefixed_and_spread_over_hosts(self):
+        for user_id in range(20):
+            await self.store.add(user_id, 'socket', 60)
+        self.assertEqual(set(self.servers), {'redis://one', 'redis://two'})
+        keys = [key for server in self.servers.values() for key in server.sorted_sets]
+        self.assertEqual(sorted(keys), sorted(f'test:presence:{user_id}' for user_id in range(20)))
+
+    def test_store_follows_channel_layer_settings(self):
+        self.assertIsInstance(get_presence_store(), MemoryPresenceStore)
+        redis_layer = {'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer', 'CONFIG': {'prefix': 'other'}}}
+        with override_settings(CHANNEL_LAYER_BACKEND='redis', CHANNEL_LAYER_HOSTS=['redis://one'],
+                               CHANNEL_LAYERS=redis_layer):
+            store = get_presence_store()
+            self.assertIsInstance(store, RedisPresenceStore)
+            self.assertEqual((store.hosts, store.prefix), (['redis://one'], 'other'))
+        self.assertIsInstance(get_presence_store(), MemoryPresenceStore)
+
+
+REDIS_ENVIRON = {
+    'CHANNEL_LAYER_BACKEND': 'redis',
+    'REDIS_URLS': 'redis://shard-a:6379/0, redis://shard-b:6379/0',
+    'CHANNEL_LAYER_CAPACITY': '50',
+    'CHANNEL_LAYER_EXPIRY_SECONDS': '30',
+    'CHANNEL_LAYER_GROUP_EXPIRY_SECONDS': '600',
+}
+
+
+class RedisChannelLayerConfigTests(SimpleTestCase):
+    def test_redis_layer_from_environment(self):
+        layers = channel_layer_settings(**REDIS_ENVIRON)['CHANNEL_LAYERS']
+        self.assertEqual(layers['default']['BACKEND'], 'channels_redis.core.RedisChannelLayer')
+        self.assertEqual(layers['default']['CONFIG'], {
+            'hosts': ['redis://shard-a:6379/0', 'redis://shard-b:6379/0'],
+            'prefix': 'imarket',
+            'capacity': 50,
+            'expiry': 30,
+            'group_expiry': 600,
+        })
+
+        # Groups are spread over both shards
+        layer = RedisChannelLayer(**layers['default']['CONFIG'])
+        self.assertEqual(layer.ring_size, 2)
+        self.assertEqual({layer.consistent_hash(f'chat_{i}') for i in range(50)}, {0, 1})
+
+    def test_single_host_and_unknown_backend(self):
+        config = channel_layer_settings(CHANNEL_LAYER_BACKEND='redis', REDIS_URLS='', REDIS_HOST='cache',
+                                        REDIS_PORT='6380')['CHANNEL_LAYERS']['default']['CONFIG']
+        self.assertEqual(config['hosts'], [('cache', 6380)])
+        with self.assertRaises(ImproperlyConfigured):
+            channel_layer_settings(CHANNEL_LAYER_BACKEND='rabbitmq')
+
+
+@override_settings(CHAT_PRESENCE_BROADCAST_MS=10, **channel_layer_settings(**REDIS_ENVIRON))
+class RedisChatFlowTests(TransactionTestCase):
+    """The chat flow with the Redis channel layer and presence store, against in-process fake servers"""
+
+    def setUp(self):
+        self.servers = FakeRedisServers(self).servers
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.room = ChatRoom.objects.create(name='Room')
+        self.room.participants.add(self.alice, self.bob)
+
+    async def test_chat_and_presence_go_through_redis(self):
+        self.assertIsInstance(get_channel_layer(), RedisChannelLayer)
+        self.assertIsInstance(get_presence_store(), RedisPresenceStore)
+
+        alice = await connected_socket(self, self.room.id, self.alice)
+        self.assertEqual(await alice.receive_json_from(), {'type': 'presence_state', 'online_user_ids': []})
+        bob = await connected_socket(self, self.room.id, self.bob)
+        self.assertEqual(await bob.receive_json_from(),
+                         {'type': 'presence_state', 'online_user_ids': [str(self.alice.id)]})
+        self.assertEqual(await alice.receive_json_from(),
+                         {'type': 'presence', 'user_id': str(self.bob.id), 'online': True})
+
+        await bob.send_json_to({'type': 'chat_message', 'message': 'over redis'})
+        for socket in (alice, bob):
+            # Bob may also hear Alice's own online event, depending on when the broadcaster flushed
+            while (message := await socket.receive_json_from())['type'] == 'presence':
+                pass
+            self.assertEqual((message['type'], message['message']), ('chat_message', 'over redis'))
+
+        keys = {key for server in self.servers.values() for key in server.sorted_sets}
+        self.assertIn(f'imarket:group:chat_{self.room.id}', keys)
+        self.assertIn(f'imarket:presence:{self.alice.id}', keys)
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_group_send_reaches_another_worker(self):
+        # Two layers sharing the servers stand for two ASGI worker processes
+        config = settings.CHANNEL_LAYERS['default']['CONFIG']
+        worker_a, worker_b = RedisChannelLayer(**config), RedisChannelLayer(**config)
+        channel = await worker_b.new_channel()
+        await worker_a.group_add('chat_shared', channel)
+        await worker_a.group_send('chat_shared', {'type': 'chat_message', 'message': 'hello'})
+        self.assertEqual(await worker_b.receive(channel), {'type': 'chat_message', 'message': 'hello'})
+
+
+@override_settings(CHAT_MESSAGES_PAGE_SIZE=4, CHAT_MESSAGES_MAX_PAGE_SIZE=6)
+class MessagePaginationTests(TestCase):
+    def setUp(self):
+        self.user = make_user('alice')
+        self.room = ChatRoom.objects.create(name='Room')
+        self.room.participants.add(self.user)
+        start = timezone.now()
+        # Pairs of messages share a timestamp, so ids decide the order within each pair
+        self.messages = ChatMessage.objects.bulk_create([
+            ChatMessage(room=self.room, sender=self.user, content=str(i), timestamp=start + timedelta(seconds=i // 2))
+            for i in range(10)
+        ])
+        self.ordered = [str(m.id) for m in ChatMessage.objects.filter(room=self.room).order_by('timestamp', 'id')]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def page(self, **params):
+        response = self.client.get('/api/chat/messages/room_messages/', {'room_id': self.room.id, **params})
+        self.assertEqual(response.status_code, 200, response.data)
+        return [message['id'] for message in response.data['results']], response.data
+
+    def test_walking_back_visits_every_message_once(self):
+        ids, page = self.page()
+        self.assertEqual(ids, self.ordered[-4:])
+        self.assertEqual((page['has_older'], page['has_newer']), (True, False))
+        seen = ids
+        while page['before']:
+            ids, page = self.page(before=page['before'])
+            self.assertTrue(page['has_newer'])
+            seen = ids + seen
+        self.assertEqual(seen, self.ordered)
+        self.assertFalse(page['has_older'])
+
+    def test_after_fetches_newer_messages_across_a_shared_timestamp(self):
+        ids, page = self.page(before=self.page()[1]['before'])
+        ids, page = self.page(after=page['after'])
+        self.assertEqual(ids, self.ordered[-4:])
+        self.assertEqual((page['has_older'], page['has_newer']), (True, False))
+
+        # Nothing newer yet: the cursor is kept so the client can keep polling
+        ids, polled = self.page(after=page['after'])
+        self.assertEqual((ids, polled['after']), ([], page['after']))
+
+    def test_page_size_is_clamped(self):
+        self.assertEqual(len(self.page(page_size=100)[0]), 6)
+        self.assertEqual(len(self.page(page_size=0)[0]), 1)
+        self.assertEqual(len(self.page(page_size=-3)[0]), 1)
+
+    def test_bad_parameters_are_rejected(self):
+        cursor = self.page()[1]['before']
+        for params in ({'before': 'not-a-cursor'}, {'after': 'Zm9v'}, {'page_size': 'ten'},
+                       {'before': cursor, 'after': cursor}):
+            response = self.client.get('/api/chat/messages/room_messages/', {'room_id': self.room.id, **params})
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_naive_cursor_timestamp_is_utc(self):
+        message = ChatMessage.objects.get(id=self.ordered[0])
+        raw = f'{message.timestamp.replace(tzinfo=None).isoformat()}|{message.id}'
+        cursor = base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+        self.assertEqual(decode_cursor(cursor), (message.timestamp, message.id))
+
+    def test_empty_room(self):
+        self.room.messages.all().delete()
+        ids, page = self.page()
+        self.assertEqual(ids, [])
+        self.assertEqual((page['before'], page['after'], page['has_older']), (None, None, False))
+
+
+class MessageReadSerializerTests(TestCase):
+    def setUp(self):
+        alice, bob = make_user('alice'), make_user('bob', User.ROLE_SELLER)
+        bob.first_name = 'Bob'
+        bob.profile_picture = 'profile_pictures/bob.png'
+        bob.save()
+        room = ChatRoom.objects.create(name='Room')
+        now = timezone.now()
+        ChatService.send_message(room.id, alice.id, 'plain', timestamp=now)
+        ChatService.send_message(room.id, bob.id, 'photo', timestamp=now + timedelta(seconds=1),
+                                 attachment='chat_attachments/photo.jpg', attachment_type='image/jpeg',
+                                 is_read=True, read_at=now + timedelta(seconds=2))
+        ChatService.send_message(room.id, make_user('carol').id, 'here', timestamp=now + timedelta(seconds=3),
+                                 latitude=6.4525, longitude=3.395)
+        self.request = APIRequestFactory().get('/api/chat/messages/')
+
+    def rendered(self, data):
+        return json.loads(JSONRenderer().render(data))
+
+    def test_matches_the_model_serializer(self):
+        messages = list(ChatMessage.objects.select_related('sender'))
+        for context in ({}, {'request': self.request}):
+            expected = self.rendered(ChatMessageSerializer(messages, many=True, context=context).data)
+            self.assertEqual(self.rendered(ChatMessageReadSerializer(messages, context=context).data), expected)
+            self.assertEqual(self.rendered(ChatMessageReadSerializer(ChatMessage.objects.values(),
+                                                                     context=context).data), expected)
+        self.assertTrue(expected[1]['attachment'].startswith('http://testserver/media/'))
+        self.assertTrue(expected[1]['sender_details']['profile_picture'].endswith('/media/profile_pictures/bob.png'))
+
+    def test_senders_are_loaded_in_one_query(self):
+        messages = list(ChatMessage.objects.all())
+        with self.assertNumQueries(1):
+            ChatMessageReadSerializer(messages, context={'request': self.request}).data
+
+
+@override_settings(CHAT_BATCHED_PERSISTENCE=True, CHAT_PERSIST_FLUSH_MS=10)
+class BatchedPersistenceTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.room = ChatRoom.objects.create(name='Room')
+        self.room.participants.add(self.alice)
+
+    async def receive_until(self, communicator, event_type):
+        while (event := await communicator.receive_json_from())['type'] != event_type:
+            pass
+        return event
+
+    def stored(self):
+        return list(ChatMessage.objects.filter(room=self.room).order_by('timestamp', 'id').values_list('id', 'content'))
+
+    async def test_messages_are_written_in_order_and_acknowledged(self):
+        alice = await connected_socket(self, self.room.id, self.alice)
+        ids = [uuid.uuid4() for _ in range(5)]
+        for i, message_id in enumerate(ids):
+            await alice.send_json_to({'type': 'chat_message', 'message': str(i), 'message_id': str(message_id)})
+
+        acknowledged = []
+        while len(acknowledged) < len(ids):
+            acknowledged += (await self.receive_until(alice, 'messages_persisted'))['message_ids']
+        self.assertEqual(acknowledged, [str(message_id) for message_id in ids])
+        self.assertEqual(await database_sync_to_async(self.stored)(), [(m, str(i)) for i, m in enumerate(ids)])
+
+        # A resend after a lost acknowledgement is acknowledged again but stored once
+        await alice.send_json_to({'type': 'chat_message', 'message': '0', 'message_id': str(ids[0])})
+        self.assertEqual((await self.receive_until(alice, 'messages_persisted'))['message_ids'], [str(ids[0])])
+        self.assertEqual(len(await database_sync_to_async(self.stored)()), 5)
+        await alice.disconnect()
+
+    async def test_failed_write_is_reported_to_the_sender(self):
+        alice = await connected_socket(self, self.room.id, self.alice)
+        with mock.patch('chat.persistence.ChatService.save_messages', side_effect=RuntimeError), \
+                self.assertLogs('chat.persistence', 'ERROR'):
+            await alice.send_json_to({'type': 'chat_message', 'message': 'lost', 'message_id': str(uuid.uuid4())})
+            event = await self.receive_until(alice, 'messages_not_persisted')
+        self.assertEqual(len(event['message_ids']), 1)
+        self.assertEqual(await database_sync_to_async(self.stored)(), [])
+        await alice.disconnect()
+
+    def test_generated_ids_sort_by_creation_time(self):
+        first = time_ordered_uuid()
+        time.sleep(0.002)
+        second = time_ordered_uuid()
+        self.assertEqual((first.version, first.variant), (7, uuid.RFC_4122))
+        self.assertLess(first, second)
+
+    async def test_id_of_another_rooms_message_is_rejected(self):
+        bob = await database_sync_to_async(make_user)('bob')
+        other_room = await database_sync_to_async(ChatRoom.objects.create)(name='Other')
+        taken = await database_sync_to_async(ChatService.send_message)(other_room.id, bob.id, 'original')
+
+        alice = await connected_socket(self, self.room.id, self.alice)
+        await alice.receive_json_from()
+        await alice.send_json_to({'type': 'chat_message', 'message': 'hijack', 'message_id': str(taken.id)})
+        self.assertEqual(await alice.receive_json_from(),
+                         {'type': 'messages_not_persisted', 'message_ids': [str(taken.id)]})
+        self.assertTrue(await alice.receive_nothing(timeout=0.1))
+        stored = await database_sync_to_async(ChatMessage.objects.get)(id=taken.id)
+        self.assertEqual((stored.room_id, stored.content), (other_room.id, 'original'))
+        await alice.disconnect()
+
+    async def test_resend_is_not_broadcast_again(self):
+        bob = await database_sync_to_async(make_user)('bob')
+        await database_sync_to_async(self.room.participants.add)(bob)
+        alice = await connected_socket(self, self.room.id, self.alice)
+        listener = await connected_socket(self, self.room.id, bob)
+
+        message_id = str(uuid.uuid4())
+        # Twice before the flush, then once more after it
+        for _ in range(2):
+            await alice.send_json_to({'type': 'chat_message', 'message': 'once', 'message_id': message_id})
+        acknowledged = (await self.receive_until(alice, 'messages_persisted'))['message_ids']
+        await alice.send_json_to({'type': 'chat_message', 'message': 'once', 'message_id': message_id})
+        acknowledged += (await self.receive_until(alice, 'messages_persisted'))['message_ids']
+        self.assertEqual(acknowledged, [message_id] * 3)
+
+        received = []
+        while not await listener.receive_nothing(timeout=0.1):
+            received.append(await listener.receive_json_from())
+        self.assertEqual([event['message_id'] for event in received if event['type'] == 'chat_message'], [message_id])
+        self.assertEqual(len(await database_sync_to_async(self.stored)()), 1)
+        await alice.disconnect()
+        await listener.disconnect()
+
+
+class SaveMessagesTests(TestCase):
+    def test_only_same_room_and_sender_is_a_resend(self):
+        alice, bob = make_user('alice'), make_user('bob')
+        room = ChatRoom.objects.create(name='Room')
+        stored = ChatService.send_message(room.id, alice.id, 'first')
+
+        resend = ChatMessage(id=stored.id, room_id=str(room.id).upper(), sender_id=alice.id, content='first')
+        forged = ChatMessage(id=stored.id, room_id=room.id, sender_id=bob.id, content='forged')
+        fresh = ChatMessage(room_id=room.id, sender_id=bob.id, content='new')
+        self.assertEqual(ChatService.save_messages([resend, forged, fresh]), ([fresh], [forged]))
+        self.assertEqual(ChatService.message_owner(stored.id), message_owner_key(room.id, alice.id))
+        self.assertEqual(ChatMessage.objects.get(id=stored.id).content, 'first')
+
+
+class ReadStateTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        self.room = ChatRoom.objects.create(name='Room')
+        self.room.participants.add(self.alice, self.bob)
+
+    def unread(self, user):
+        return ChatReadState.objects.get(room=self.room, user=user).unread_count
+
+    def test_own_messages_count_only_for_the_others(self):
+        ChatService.send_message(self.room.id, self.alice.id, 'one')
+        ChatService.save_messages([ChatMessage(room_id=self.room.id, sender_id=self.alice.id, content='two')])
+        self.assertEqual(self.unread(self.alice), 0)
+        self.assertEqual(self.unread(self.bob), 2)
+
+    def test_mark_read_resets_the_count(self):
+        ChatService.send_message(self.room.id, self.alice.id, 'one')
+        ChatService.send_message(self.room.id, self.bob.id, 'two')
+        self.assertEqual(ChatService.mark_room_read(self.room.id, self.bob.id), 1)
+        self.assertEqual(self.unread(self.bob), 0)
+        self.assertEqual(self.unread(self.alice), 1)
+        self.assertTrue(ChatMessage.objects.get(content='one').is_read)
+
+    def test_late_message_does_not_move_last_message_back(self):
+        latest = ChatService.send_message(self.room.id, self.alice.id, 'latest')
+        late = ChatMessage(room_id=self.room.id, sender_id=self.bob.id, content='late',
+                           timestamp=latest.timestamp - timedelta(seconds=5))
+        ChatService.save_messages([late])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message_id, latest.id)
+        self.assertEqual(self.room.last_message_at, latest.timestamp)
+        # Still counted as unread, only the pointer stays put
+        self.assertEqual(self.unread(self.alice), 1)
+
+    def test_new_participant_gets_a_read_state(self):
+        ChatService.send_message(self.room.id, self.alice.id, 'before')
+        carol = make_user('carol')
+        self.room.participants.add(carol)
+        self.assertEqual(self.unread(carol), 0)
+        ChatService.send_message(self.room.id, self.alice.id, 'after')
+        self.assertEqual(self.unread(carol), 1)
+
+        self.room.participants.remove(carol)
+        self.assertFalse(ChatReadState.objects.filter(room=self.room, user=carol).exists())
@@ -2,11 +2,15 @@ from django.shortcuts import render, get_object_or_404
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from .models import ChatRoom, ChatMessage
-from .serializers import ChatRoomSerializer, ChatMessageSerializer
+from .models import ChatRoom, ChatMessage, ChatReadState
+from .serializers import ChatRoomSerializer, ChatMessageSerializer, ChatMessageReadSerializer
+from .pagination import MessagePage
+from .services import ChatService
 from users.models import User
-from django.db.models import Q
-from django.utils import timezone
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Prefetch, Q, Subquery, UUIDField
+from django.db.models.functions import Coalesce
 import uuid
 
 # Import seller permission from markets app
@@ -17,7 +21,16 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
     
     def get_queryset(self):
-        return ChatRoom.objects.filter(participants=self.request.user, is_active=True)
+        # Last message and the viewer's read state come with the rooms, not per room
+        return ChatRoom.objects.filter(
+            participants=self.request.user, is_active=True
+        ).select_related(
+            'last_message__sender'
+        ).prefetch_related(
+            'participants',
+            Prefetch('read_states', queryset=ChatReadState.objects.filter(user=self.request.user),
+                     to_attr='viewer_read_states')
+        )
     
     def perform_create(self, serializer):
         # Create a chat room and add the current user as a participant
@@ -47,21 +60,11 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
         except User.DoesNotExist:
             return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
         
-        # Check if a private room already exists between these users
-        rooms = ChatRoom.objects.filter(participants=request.user).filter(participants=other_user)
-        
-        # Filter to rooms with exactly 2 participants
-        for room in rooms:
-            if room.participants.count() == 2:
-                serializer = self.get_serializer(room, context={'request': request})
-                return Response(serializer.data)
-        
-        # Create a new private room if one doesn't exist
-        room = ChatRoom.objects.create(name=f"Chat with {other_user.username}")
-        room.participants.add(request.user, other_user)
+        # One indexed lookup on the pair's private key; created if it does not exist yet
+        room, created = ChatService.get_or_create_private_room(request.user, other_user)
         
         serializer = self.get_serializer(room, context={'request': request})
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
 
 class ChatMessageViewSet(viewsets.ModelViewSet):
     serializer_class = ChatMessageSerializer
@@ -75,11 +78,13 @@ class ChatMessageViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         room_id = self.request.data.get('room')
         room = get_object_or_404(ChatRoom, id=room_id, participants=self.request.user)
-        serializer.save(sender=self.request.user, room=room)
+        with transaction.atomic():
+            message = serializer.save(sender=self.request.user, room=room)
+            ChatService.record_messages([message])
     
     @action(detail=False, methods=['get'])
     def room_messages(self, request):
-        """Get all messages for a specific room"""
+        """Get a page of messages for a specific room (before/after cursors, page_size)"""
         room_id = request.query_params.get('room_id')
         
         if not room_id:
@@ -92,9 +97,19 @@ class ChatMessageViewSet(viewsets.ModelViewSet):
             return Response({"error": "Room not found or you don't have access"}, 
                            status=status.HTTP_404_NOT_FOUND)
         
-        messages = ChatMessage.objects.filter(room=room).order_by('timestamp')
-        serializer = self.get_serializer(messages, many=True)
-        return Response(serializer.data)
+        try:
+            page = MessagePage(
+                ChatMessage.objects.filter(room=room),
+                before=request.query_params.get('before'),
+                after=request.query_params.get('after'),
+                page_size=request.query_params.get('page_size')
+            )
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # Senders are loaded once for the page by the read serializer
+        serializer = ChatMessageReadSerializer(page.messages, context={'request': request})
+        return Response({'results': serializer.data, **page.metadata()})
     
     @action(detail=False, methods=['post'])
     def mark_as_read(self, request):
@@ -112,15 +127,7 @@ class ChatMessageViewSet(viewsets.ModelViewSet):
                            status=status.HTTP_404_NOT_FOUND)
         
         # Mark messages from others as read
-        ChatMessage.objects.filter(
-            room=room, 
-            is_read=False
-        ).exclude(
-            sender=request.user
-        ).update(
-            is_read=True,
-            read_at=timezone.now()
-        )
+        ChatService.mark_room_read(room.id, request.user.id)
         
         return Response({"status": "Messages marked as read"}, status=status.HTTP_200_OK)
 
@@ -131,56 +138,81 @@ class SellerMessagesViewSet(viewsets.ViewSet):
     
     @action(detail=False, methods=['get'])
     def conversations(self, request):
-        """Get all conversations initiated by users for this seller"""
+        """Get a page of conversations initiated by users for this seller, most recent first"""
         seller = request.user
         
-        # Get chat rooms where this seller is a participant
-        chat_rooms = ChatRoom.objects.filter(participants=seller)
+        try:
+            page = max(int(request.query_params.get('page', 1)), 1)
+            page_size = int(request.query_params.get('page_size', settings.CHAT_CONVERSATIONS_PAGE_SIZE))
+        except ValueError:
+            return Response({"error": "page and page_size must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+        page_size = max(1, min(page_size, settings.CHAT_CONVERSATIONS_MAX_PAGE_SIZE))
+        offset = (page - 1) * page_size
+        
+        memberships = ChatRoom.participants.through.objects
+        read_state = ChatReadState.objects.filter(room=OuterRef('pk'), user_id=seller.id)
+        
+        # Two-person rooms of this seller, annotated, sorted and sliced in a single query;
+        # the latest message and unread count are the denormalized ones kept by ChatService.
+        # Counted rather than filtered on private_key: a pair's later rooms have no key
+        rooms = list(
+            ChatRoom.objects.filter(
+                id__in=memberships.filter(user_id=seller.id).values('chatroom_id')
+            ).annotate(
+                participant_count=Subquery(
+                    memberships.filter(chatroom_id=OuterRef('pk')).values('chatroom_id').annotate(
+                        total=Count('pk')
+                    ).values('total')[:1]
+                ),
+                other_user_id=Subquery(
+                    memberships.filter(chatroom_id=OuterRef('pk')).exclude(user_id=seller.id).values('user_id')[:1],
+                    output_field=UUIDField()
+                ),
+                unread_count=Coalesce(Subquery(read_state.values('unread_count')[:1]), 0)
+            ).filter(
+                participant_count=2
+            ).order_by(
+                F('last_message_at').desc(nulls_last=True), '-created_at'
+            ).values(
+                'id', 'other_user_id', 'last_message_id', 'unread_count'
+            )[offset:offset + page_size + 1]
+        )
+        has_more = len(rooms) > page_size
+        rooms = rooms[:page_size]
         
-        # Only get rooms with exactly 2 participants (private chats)
-        private_rooms = []
-        for room in chat_rooms:
-            if room.participants.count() == 2:
-                private_rooms.append(room)
+        # The other participants and latest messages of the page, one query each
+        users = User.objects.in_bulk([room['other_user_id'] for room in rooms])
+        messages = ChatMessage.objects.select_related('sender').in_bulk(
+            [room['last_message_id'] for room in rooms if room['last_message_id']]
+        )
         
-        # Serialize the rooms with additional info about the other participant
         result = []
-        for room in private_rooms:
-            # Get the other participant (not the seller)
-            other_user = room.participants.exclude(id=seller.id).first()
-            
-            if other_user:
-                # Get the latest message
-                latest_message = ChatMessage.objects.filter(room=room).order_by('-timestamp').first()
-                
-                # Count unread messages
-                unread_count = ChatMessage.objects.filter(
-                    room=room,
-                    sender=other_user,
-                    is_read=False
-                ).count()
-                
-                result.append({
-                    'room_id': room.id,
-                    'user': {
-                        'id': other_user.id,
-                        'username': other_user.username,
-                        'first_name': other_user.first_name,
-                        'last_name': other_user.last_name,
-                        'profile_picture': request.build_absolute_uri(other_user.profile_picture.url) if other_user.profile_picture else None
-                    },
-                    'last_message': ChatMessageSerializer(latest_message).data if latest_message else None,
-                    'unread_count': unread_count
-                })
-        
-        # Sort by latest message time
-        result.sort(key=lambda x: x.get('last_message', {}).get('timestamp', ''), reverse=True)
+        for room in rooms:
+            other_user = users[room['other_user_id']]
+            latest_message = messages.get(room['last_message_id'])
+            result.append({
+                'room_id': room['id'],
+                'user': {
+                    'id': other_user.id,
+                    'username': other_user.username,
+                    'first_name': other_user.first_name,
+                    'last_name': other_user.last_name,
+                    'profile_picture': request.build_absolute_uri(other_user.profile_picture.url) if other_user.profile_picture else None
+                },
+                'last_message': ChatMessageSerializer(latest_message).data if latest_message else None,
+                'unread_count': room['unread_count']
+            })
         
-        return Response(result)
+        return Response({
+            'results': result,
+            'page': page,
+            'page_size': page_size,
+            'has_more': has_more
+        })
     
     @action(detail=True, methods=['get'])
     def user_conversation(self, request, pk=None):
-        """Get conversation with a specific user"""
+        """Get conversation with a specific user, one page of messages at a time"""
         seller = request.user
         
         try:
@@ -188,40 +220,30 @@ class SellerMessagesViewSet(viewsets.ViewSet):
         except User.DoesNotExist:
             return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
         
-        # Find a chat room between these users, or create one
-        chat_rooms = ChatRoom.objects.filter(participants=seller).filter(participants=user)
-        
-        # Filter to rooms with exactly 2 participants
-        room = None
-        for candidate in chat_rooms:
-            if candidate.participants.count() == 2:
-                room = candidate
-                break
-        
-        # Create a new room if one doesn't exist
-        if room is None:
-            room = ChatRoom.objects.create(name=f"Chat with {user.username}")
-            room.participants.add(seller, user)
+        # Find the private room between these users, or create one
+        room, _ = ChatService.get_or_create_private_room(seller, user)
         
-        # Get all messages
-        messages = ChatMessage.objects.filter(room=room).order_by('timestamp')
+        # Get one page of messages
+        try:
+            page = MessagePage(
+                ChatMessage.objects.filter(room=room),
+                before=request.query_params.get('before'),
+                after=request.query_params.get('after'),
+                page_size=request.query_params.get('page_size')
+            )
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
         # Mark messages as read
-        ChatMessage.objects.filter(
-            room=room, 
-            sender=user,
-            is_read=False
-        ).update(
-            is_read=True,
-            read_at=timezone.now()
-        )
+        ChatService.mark_room_read(room.id, seller.id)
         
-        room_data = ChatRoomSerializer(room).data
-        messages_data = ChatMessageSerializer(messages, many=True).data
+        room_data = ChatRoomSerializer(room, context={'request': request}).data
+        messages_data = ChatMessageReadSerializer(page.messages).data
         
         return Response({
             'room': room_data,
             'messages': messages_data,
+            'pagination': page.metadata(),
             'user': {
                 'id': user.id,
                 'username': user.username,
@@ -244,26 +266,10 @@ class SellerMessagesViewSet(viewsets.ViewSet):
         except User.DoesNotExist:
             return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
         
-        # Find a chat room between these users, or create one
-        chat_rooms = ChatRoom.objects.filter(participants=seller).filter(participants=user)
-        
-        # Filter to rooms with exactly 2 participants
-        room = None
-        for candidate in chat_rooms:
-            if candidate.participants.count() == 2:
-                room = candidate
-                break
-        
-        # Create a new room if one doesn't exist
-        if room is None:
-            room = ChatRoom.objects.create(name=f"Chat with {user.username}")
-            room.participants.add(seller, user)
+        # Find the private room between these users, or create one
+        room, _ = ChatService.get_or_create_private_room(seller, user)
         
         # Create the message
-        message = ChatMessage.objects.create(
-            room=room,
-            sender=seller,
-            content=content
-        )
+        message = ChatService.send_message(room.id, seller.id, content)
         
         return Response(ChatMessageSerializer(message).data)
@@ -8,18 +8,40 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
 import os
+from asgiref.sync import sync_to_async
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-import chat.routing
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iMarket.settings')
 
+# Set up Django before importing consumers, which import models
+django_asgi_app = get_asgi_application()
+
+import chat.routing  # noqa: E402
+import markets.routing  # noqa: E402
+from markets.location_writer import LocationWriteBuffer  # noqa: E402
+from users.ws_auth import JWTAuthMiddlewareStack  # noqa: E402
+
+
+async def lifespan(scope, receive, send):
+    """Flush buffered location writes when the server shuts the application down"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await sync_to_async(LocationWriteBuffer.shutdown, thread_sensitive=False)()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "http": django_asgi_app,
+    "lifespan": lifespan,
+    "websocket": JWTAuthMiddlewareStack(
         URLRouter(
-            chat.routing.websocket_urlpatterns
+            chat.routing.websocket_urlpatterns +
+            markets.routing.websocket_urlpatterns
         )
     ),
 })
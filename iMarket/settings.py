@@ -8,6 +8,7 @@ from pathlib import Path
 import os
 from datetime import timedelta
 from dotenv import load_dotenv
+from django.core.exceptions import ImproperlyConfigured
 import dj_database_url
 
 # Load environment variables from .env file
@@ -91,6 +92,14 @@ if os.getenv("RENDER_BUILD") == "true" or not os.getenv("DATABASE_URL"):
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / "db.sqlite3",
+            # Writers wait up to 20s for the lock instead of failing as locked
+            'OPTIONS': {
+                'timeout': 20,
+            },
+            # A file rather than shared-cache memory, so concurrent test writers wait for the lock too
+            'TEST': {
+                'NAME': BASE_DIR / "test_db.sqlite3",
+            },
         }
     }
 else:
@@ -189,16 +198,82 @@ SIMPLE_JWT = {
 # Channels configuration for WebSockets
 ASGI_APPLICATION = 'iMarket.asgi.application'
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-        # For production, use Redis:
-        # 'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        # 'CONFIG': {
-        #     "hosts": [(os.getenv("REDIS_HOST", "127.0.0.1"), int(os.getenv("REDIS_PORT", "6379")))],
-        # },
-    },
-}
+# Channel layer. The in-memory layer only reaches sockets in the same process, so any
+# deployment with more than one ASGI worker must use Redis:
+#   memory        - single process; also what the test suite runs against
+#   redis         - channels_redis core layer; several REDIS_URLS shard channels and groups
+#   redis_pubsub  - channels_redis pub/sub layer; lower latency group fan-out, no capacity limits
+CHANNEL_LAYER_BACKEND = os.getenv('CHANNEL_LAYER_BACKEND', 'memory')
+
+if os.getenv('REDIS_URLS'):
+    CHANNEL_LAYER_HOSTS = [url.strip() for url in os.getenv('REDIS_URLS').split(',') if url.strip()]
+else:
+    CHANNEL_LAYER_HOSTS = [(os.getenv('REDIS_HOST', '127.0.0.1'), int(os.getenv('REDIS_PORT', '6379')))]
+
+if CHANNEL_LAYER_BACKEND == 'memory':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+elif CHANNEL_LAYER_BACKEND == 'redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': CHANNEL_LAYER_HOSTS,
+                'prefix': os.getenv('CHANNEL_LAYER_PREFIX', 'imarket'),
+                # Messages queued per channel before sends fail, and how long they wait
+                'capacity': int(os.getenv('CHANNEL_LAYER_CAPACITY', '1000')),
+                'expiry': int(os.getenv('CHANNEL_LAYER_EXPIRY_SECONDS', '60')),
+                # Sockets that vanish without a disconnect drop out of groups after this
+                'group_expiry': int(os.getenv('CHANNEL_LAYER_GROUP_EXPIRY_SECONDS', '86400')),
+            },
+        },
+    }
+elif CHANNEL_LAYER_BACKEND == 'redis_pubsub':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.pubsub.RedisPubSubChannelLayer',
+            'CONFIG': {
+                'hosts': CHANNEL_LAYER_HOSTS,
+                'prefix': os.getenv('CHANNEL_LAYER_PREFIX', 'imarket'),
+            },
+        },
+    }
+else:
+    raise ImproperlyConfigured(
+        f"CHANNEL_LAYER_BACKEND must be 'memory', 'redis' or 'redis_pubsub', not {CHANNEL_LAYER_BACKEND!r}"
+    )
+
+# Cache. The navigation caches (shop index, routing graph, geofences, market boundaries) live
+# in each worker and are invalidated through version tokens kept here, so with more than one
+# worker the cache must be shared:
+#   locmem  - this process only; tokens expire after NAVIGATION_CACHE_LOCAL_TTL_SECONDS, which
+#             bounds how long other workers can serve stale navigation data
+#   redis   - shared by every worker; a save invalidates all of them at once
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'locmem')
+
+if CACHE_BACKEND == 'locmem':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+elif CACHE_BACKEND == 'redis':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv(
+                'REDIS_CACHE_URL',
+                f"redis://{os.getenv('REDIS_HOST', '127.0.0.1')}:{os.getenv('REDIS_PORT', '6379')}/1"
+            ),
+        },
+    }
+else:
+    raise ImproperlyConfigured(f"CACHE_BACKEND must be 'locmem' or 'redis', not {CACHE_BACKEND!r}")
+
+NAVIGATION_CACHE_LOCAL_TTL_SECONDS = int(os.getenv('NAVIGATION_CACHE_LOCAL_TTL_SECONDS', '30'))
 
 # Email Configuration
 # For development, use console backend to avoid email setup issues
@@ -227,3 +302,44 @@ OUTDOOR_NAVIGATION_ENABLED = os.getenv('OUTDOOR_NAVIGATION_ENABLED', 'True') ==
 # JWT Token Configuration
 JWT_ACCESS_TOKEN_LIFETIME_MINUTES = int(os.getenv('JWT_ACCESS_TOKEN_LIFETIME_MINUTES', '60'))
 JWT_REFRESH_TOKEN_LIFETIME_DAYS = int(os.getenv('JWT_REFRESH_TOKEN_LIFETIME_DAYS', '7'))
+
+# Location history write-behind buffer (rows are flushed by a background thread)
+LOCATION_WRITE_BEHIND_ENABLED = os.getenv('LOCATION_WRITE_BEHIND_ENABLED', 'False') == 'True'
+LOCATION_WRITE_BEHIND_BATCH_SIZE = int(os.getenv('LOCATION_WRITE_BEHIND_BATCH_SIZE', '200'))
+LOCATION_WRITE_BEHIND_FLUSH_MS = int(os.getenv('LOCATION_WRITE_BEHIND_FLUSH_MS', '500'))
+LOCATION_WRITE_BEHIND_MAX_PENDING = int(os.getenv('LOCATION_WRITE_BEHIND_MAX_PENDING', '10000'))
+
+# Location history retention (see the compact_locations management command)
+LOCATION_HISTORY_RETENTION_DAYS = int(os.getenv('LOCATION_HISTORY_RETENTION_DAYS', '90'))
+LOCATION_HISTORY_COMPACT_AFTER_DAYS = int(os.getenv('LOCATION_HISTORY_COMPACT_AFTER_DAYS', '1'))
+LOCATION_HISTORY_TOLERANCE_METERS = float(os.getenv('LOCATION_HISTORY_TOLERANCE_METERS', '5'))
+# On PostgreSQL the table can be partitioned by day (see the partition_locations command);
+# daily partitions are created this many days ahead
+LOCATION_HISTORY_PARTITION_DAYS_AHEAD = int(os.getenv('LOCATION_HISTORY_PARTITION_DAYS_AHEAD', '7'))
+
+# Chat persistence: when batched, messages are broadcast first and written with bulk_create
+CHAT_BATCHED_PERSISTENCE = os.getenv('CHAT_BATCHED_PERSISTENCE', 'False') == 'True'
+CHAT_PERSIST_FLUSH_MS = int(os.getenv('CHAT_PERSIST_FLUSH_MS', '20'))
+CHAT_PERSIST_BATCH_SIZE = int(os.getenv('CHAT_PERSIST_BATCH_SIZE', '200'))
+
+# Chat history pages (room_messages, user_conversation)
+CHAT_MESSAGES_PAGE_SIZE = int(os.getenv('CHAT_MESSAGES_PAGE_SIZE', '50'))
+CHAT_MESSAGES_MAX_PAGE_SIZE = int(os.getenv('CHAT_MESSAGES_MAX_PAGE_SIZE', '200'))
+
+# Seller inbox pages (conversations)
+CHAT_CONVERSATIONS_PAGE_SIZE = int(os.getenv('CHAT_CONVERSATIONS_PAGE_SIZE', '20'))
+CHAT_CONVERSATIONS_MAX_PAGE_SIZE = int(os.getenv('CHAT_CONVERSATIONS_MAX_PAGE_SIZE', '100'))
+
+# Chat presence: sockets refresh their entry every heartbeat and expire after the TTL;
+# presence and typing changes are coalesced for CHAT_PRESENCE_BROADCAST_MS before broadcast
+CHAT_PRESENCE_TTL_SECONDS = int(os.getenv('CHAT_PRESENCE_TTL_SECONDS', '60'))
+CHAT_PRESENCE_HEARTBEAT_SECONDS = int(os.getenv('CHAT_PRESENCE_HEARTBEAT_SECONDS', '20'))
+CHAT_PRESENCE_BROADCAST_MS = int(os.getenv('CHAT_PRESENCE_BROADCAST_MS', '250'))
+CHAT_TYPING_REFRESH_SECONDS = int(os.getenv('CHAT_TYPING_REFRESH_SECONDS', '3'))
+
+# Stock taken for a pending order returns to the product if it is not confirmed in time
+# (see the release_expired_reservations management command)
+STOCK_RESERVATION_TTL_MINUTES = int(os.getenv('STOCK_RESERVATION_TTL_MINUTES', '30'))
+
+# Basket lines accepted by one cart checkout (POST /api/orders/checkout/)
+CART_CHECKOUT_MAX_ITEMS = int(os.getenv('CART_CHECKOUT_MAX_ITEMS', '200'))
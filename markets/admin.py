@@ -1,8 +1,8 @@
 from django.contrib import admin
 from .models import (
-    Market, Category, Product, Order, OrderItem, 
+    Market, Category, Product, Order, OrderItem, StockReservation,
     SellerAnalytics, SellerWallet, WalletTransaction,
-    Shop, NavigationRoute, GeofenceZone, UserLocation, NavigationSession
+    Shop, NavigationRoute, GeofenceZone, UserLocation, CurrentUserLocation, NavigationSession
 )
 
 @admin.register(Market)
@@ -37,6 +37,13 @@ class OrderItemAdmin(admin.ModelAdmin):
     list_display = ['order', 'product', 'quantity', 'price_at_time_of_order']
     search_fields = ['order__id', 'product__name']
 
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ['order', 'product', 'quantity', 'status', 'expires_at']
+    list_filter = ['status']
+    search_fields = ['order__id', 'product__name']
+    readonly_fields = ['created_at', 'updated_at']
+
 @admin.register(SellerAnalytics)
 class SellerAnalyticsAdmin(admin.ModelAdmin):
     list_display = ['seller', 'total_orders', 'completed_orders', 'updated_at']
@@ -83,6 +90,12 @@ class UserLocationAdmin(admin.ModelAdmin):
     search_fields = ['user__username', 'market__name']
     readonly_fields = ['timestamp']
 
+@admin.register(CurrentUserLocation)
+class CurrentUserLocationAdmin(admin.ModelAdmin):
+    list_display = ['user', 'market', 'latitude', 'longitude', 'is_indoor', 'timestamp']
+    list_filter = ['is_indoor', 'market']
+    search_fields = ['user__username', 'market__name']
+
 @admin.register(NavigationSession)
 class NavigationSessionAdmin(admin.ModelAdmin):
     list_display = ['user', 'destination_shop', 'status', 'started_at']
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class MarketsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'markets'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .location_writer import LocationWriteBuffer
+
+        if LocationWriteBuffer.enabled():
+            LocationWriteBuffer.install_signal_handlers()
@@ -0,0 +1,39 @@
+"""
+Version tokens for invalidating process-local navigation caches
+"""
+import uuid
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+
+def _version_key(namespace: str, key: str) -> str:
+    return f"markets:{namespace}:version:{key}"
+
+
+def _token_timeout():
+    """
+    Tokens in a shared cache live until bumped. A per-process cache only sees the bumps of
+    its own worker, so there tokens expire and every worker re-checks within the TTL.
+    """
+    if isinstance(caches['default'], (LocMemCache, DummyCache)):
+        return settings.NAVIGATION_CACHE_LOCAL_TTL_SECONDS
+    return None
+
+
+def get_version(namespace: str, key: str) -> str:
+    """Return the current version token for a cached structure, creating one if missing"""
+    cache_key = _version_key(namespace, key)
+    version = cache.get(cache_key)
+    if version is None:
+        # Another worker may have created the token first, so re-read after add()
+        cache.add(cache_key, uuid.uuid4().hex, _token_timeout())
+        version = cache.get(cache_key)
+    # A cache backend that stores nothing (DummyCache) must never report a cache hit
+    return version or uuid.uuid4().hex
+
+
+def bump_version(namespace: str, key: str) -> None:
+    """Invalidate every cached copy of a structure that shares this cache"""
+    cache.set(_version_key(namespace, key), uuid.uuid4().hex, _token_timeout())
@@ -0,0 +1,66 @@
+"""
+Turning a buyer's basket into orders, items and stock reservations in one transaction
+"""
+from collections import defaultdict
+from typing import Dict, List
+
+from django.db import transaction
+
+from .models import Order, OrderItem, Product
+from .stock_reservations import StockReservationService
+
+
+class UnknownProducts(Exception):
+    """Basket lines refer to products that do not exist"""
+
+    def __init__(self, product_ids: List):
+        self.product_ids = product_ids
+        super().__init__(f"Products not found: {', '.join(str(product_id) for product_id in product_ids)}")
+
+
+class CheckoutService:
+    """Service class for placing orders from basket lines"""
+
+    @staticmethod
+    def place_orders(buyer, lines: List[Dict], buyer_note: str = '', seller=None) -> List[Order]:
+        """
+        Create orders from [{'product': id, 'quantity': n}, ...]: one per product seller, in the
+        order sellers first appear, or a single order for `seller` when given. Products are
+        loaded with one query, orders and items are inserted with one bulk_create each, and
+        stock is reserved for all of them; InsufficientStock or UnknownProducts roll back everything.
+        """
+        with transaction.atomic():
+            products = Product.objects.only('id', 'seller_id', 'name', 'description', 'price').in_bulk(
+                [line['product'] for line in lines]
+            )
+            missing = [line['product'] for line in lines if line['product'] not in products]
+            if missing:
+                raise UnknownProducts(missing)
+
+            # Build every order and item in memory, in basket order, and total them before writing
+            orders = {}
+            items = defaultdict(list)
+            for line in lines:
+                product = products[line['product']]
+                seller_id = seller.id if seller is not None else product.seller_id
+                if seller_id not in orders:
+                    orders[seller_id] = Order(buyer=buyer, seller_id=seller_id, buyer_note=buyer_note)
+                order = orders[seller_id]
+                items[seller_id].append(OrderItem(
+                    order=order,
+                    product=product,
+                    quantity=line['quantity'],
+                    price_at_time_of_order=product.price,
+                    product_name=product.name,
+                    product_description=product.description
+                ))
+            for seller_id, order in orders.items():
+                order.total_amount = sum(item.subtotal for item in items[seller_id])
+
+            Order.objects.bulk_create(orders.values())
+            OrderItem.objects.bulk_create([item for seller_items in items.values() for item in seller_items])
+            StockReservationService.reserve_orders(
+                [(order, items[seller_id]) for seller_id, order in orders.items()]
+            )
+
+        return list(orders.values())
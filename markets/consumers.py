@@ -0,0 +1,189 @@
+import json
+import time
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+from .models import NavigationSession
+from .navigation_utils import NavigationService
+from .route_progress import RouteProgressTracker
+
+# Progress is written back to NavigationSession at most this often while navigating
+CHECKPOINT_INTERVAL_SECONDS = 15
+
+# Minimum time between automatic reroutes when the user keeps leaving the route
+REROUTE_COOLDOWN_SECONDS = 10
+
+
+class NavigationConsumer(AsyncWebsocketConsumer):
+    """Streams position fixes for one navigation session and pushes progress back"""
+
+    async def connect(self):
+        self.session_id = self.scope['url_route']['kwargs']['session_id']
+        self.session = None
+
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close(code=4401)
+            return
+
+        self.session = await self.load_session(user.id)
+        if self.session is None:
+            await self.close(code=4404)
+            return
+
+        self.tracker = RouteProgressTracker.for_session(self.session)
+        self.progress = None
+        self.off_route = False
+        self.dirty = False
+        self.last_checkpoint = time.monotonic()
+        self.last_reroute = None
+
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if self.session is not None and self.dirty:
+            await self.checkpoint()
+
+    # Receive message from WebSocket
+    async def receive(self, text_data):
+        try:
+            data = json.loads(text_data)
+        except ValueError:
+            await self.send_error('Invalid JSON')
+            return
+
+        message_type = data.get('type', 'location_update')
+
+        if message_type == 'location_update':
+            try:
+                latitude = float(data['latitude'])
+                longitude = float(data['longitude'])
+            except (KeyError, TypeError, ValueError):
+                await self.send_error('latitude and longitude are required')
+                return
+            await self.handle_location(latitude, longitude)
+
+        elif message_type == 'status':
+            status = data.get('status')
+            if status not in ('active', 'paused', 'cancelled', 'completed'):
+                await self.send_error('Invalid status')
+                return
+            await self.set_status(status)
+
+        else:
+            await self.send_error(f'Unknown message type: {message_type}')
+
+    async def handle_location(self, latitude, longitude):
+        if self.session.status != 'active':
+            await self.send_error(f'Navigation session is {self.session.status}')
+            return
+
+        self.progress = self.tracker.update(latitude, longitude)
+        self.dirty = True
+
+        # Only the transition onto or off the route is an event
+        if self.progress['off_route'] != self.off_route:
+            self.off_route = self.progress['off_route']
+            await self.send(text_data=json.dumps({
+                'type': 'off_route' if self.off_route else 'on_route',
+                'distance_from_route_meters': self.progress['distance_from_route_meters'],
+            }))
+            if self.off_route and await self.reroute(latitude, longitude):
+                return
+
+        await self.send(text_data=json.dumps({'type': 'progress', **self.progress}))
+
+        if self.progress['arrived']:
+            await self.set_status('completed')
+        elif time.monotonic() - self.last_checkpoint >= CHECKPOINT_INTERVAL_SECONDS:
+            await self.checkpoint()
+
+    async def reroute(self, latitude, longitude):
+        """Replace the route from the current position; returns False when no new route was sent"""
+        now = time.monotonic()
+        if self.last_reroute is not None and now - self.last_reroute < REROUTE_COOLDOWN_SECONDS:
+            return False
+        self.last_reroute = now
+
+        route_data = await self.calculate_route(latitude, longitude)
+        if not route_data or 'error' in route_data or not route_data.get('coordinates'):
+            return False
+
+        # Shop routes end at the shop, so their end point is the destination
+        destination = None if self.session.destination_shop_id else self.tracker.destination
+        self.session.route_coordinates = route_data['coordinates']
+        self.session.selected_route_id = None
+        self.tracker = RouteProgressTracker(route_data['coordinates'], destination, route_data.get('instructions'))
+        self.off_route = False
+        self.progress = self.tracker.update(latitude, longitude)
+        self.dirty = True
+        await self.checkpoint()
+
+        await self.send(text_data=json.dumps({'type': 'reroute', 'route': route_data}, default=str))
+        await self.send(text_data=json.dumps({'type': 'progress', **self.progress}))
+        return True
+
+    async def set_status(self, status):
+        self.session.status = status
+        if status == 'completed' and self.session.completed_at is None:
+            self.session.completed_at = timezone.now()
+        self.dirty = True
+        await self.checkpoint()
+
+        await self.send(text_data=json.dumps({
+            'type': 'status',
+            'status': status,
+            'completed_at': self.session.completed_at.isoformat() if self.session.completed_at else None,
+        }))
+
+    async def checkpoint(self):
+        if self.progress is not None:
+            self.session.current_step_index = self.progress['current_step_index']
+            self.session.distance_remaining_meters = self.progress['distance_remaining_meters']
+            self.session.estimated_time_remaining_seconds = self.progress['estimated_time_remaining_seconds']
+        await self.save_session()
+        self.dirty = False
+        self.last_checkpoint = time.monotonic()
+
+    async def send_error(self, error):
+        await self.send(text_data=json.dumps({'type': 'error', 'error': error}))
+
+    @database_sync_to_async
+    def load_session(self, user_id):
+        """The user's active or paused session, or None when it does not exist (or the id is not a UUID)"""
+        try:
+            return NavigationSession.objects.select_related('selected_route').filter(
+                id=self.session_id, user_id=user_id, status__in=['active', 'paused']
+            ).first()
+        except ValidationError:
+            return None
+
+    @database_sync_to_async
+    def save_session(self):
+        NavigationSession.objects.filter(id=self.session.id).update(
+            status=self.session.status,
+            current_step_index=self.session.current_step_index,
+            distance_remaining_meters=self.session.distance_remaining_meters,
+            estimated_time_remaining_seconds=self.session.estimated_time_remaining_seconds,
+            completed_at=self.session.completed_at,
+            route_coordinates=self.session.route_coordinates,
+            selected_route_id=self.session.selected_route_id,
+        )
+
+    @database_sync_to_async
+    def calculate_route(self, latitude, longitude):
+        if self.session.destination_shop_id:
+            return NavigationService.calculate_route_to_shop(
+                latitude, longitude, str(self.session.destination_shop_id), self.session.navigation_mode
+            )
+        if self.tracker.destination is None:
+            return None
+
+        destination_lat, destination_lon = self.tracker.destination
+        return {
+            'distance_meters': NavigationService.calculate_distance(
+                latitude, longitude, destination_lat, destination_lon
+            ),
+            'coordinates': [[longitude, latitude], [destination_lon, destination_lat]],
+        }
@@ -0,0 +1,142 @@
+"""
+Batched haversine distance calculations over packed coordinate arrays
+"""
+import math
+from array import array
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is listed in requirements.txt
+    np = None
+
+EARTH_RADIUS_METERS = 6371000
+METERS_PER_DEGREE_LAT = EARTH_RADIUS_METERS * math.pi / 180
+
+# Bounding boxes are a prefilter only, so err on the side of including extra candidates
+BOUNDING_BOX_PADDING = 1.01
+
+
+def haversine_meters(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two coordinates in meters"""
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    delta_lat = math.radians(lat2 - lat1)
+    delta_lon = math.radians(lon2 - lon1)
+
+    a = (math.sin(delta_lat / 2) ** 2 +
+         math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(delta_lon / 2) ** 2)
+    return EARTH_RADIUS_METERS * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def bounding_box(latitude: float, longitude: float,
+                 radius_meters: float) -> Tuple[float, float, Optional[float], Optional[float]]:
+    """
+    Latitude/longitude box enclosing a search radius, as (min_lat, max_lat, min_lon, max_lon).
+    The longitude bounds are None when the box reaches a pole or wraps the antimeridian.
+    """
+    radius_meters = radius_meters * BOUNDING_BOX_PADDING
+    lat_delta = radius_meters / METERS_PER_DEGREE_LAT
+    min_lat = max(latitude - lat_delta, -90.0)
+    max_lat = min(latitude + lat_delta, 90.0)
+
+    # Longitude degrees shrink toward the poles, so widen using the box edge nearest a pole
+    widest_lat = max(abs(min_lat), abs(max_lat))
+    cos_lat = math.cos(math.radians(widest_lat))
+    if cos_lat <= 1e-9:
+        return min_lat, max_lat, None, None
+
+    lon_delta = radius_meters / (METERS_PER_DEGREE_LAT * cos_lat)
+    min_lon = longitude - lon_delta
+    max_lon = longitude + lon_delta
+    if min_lon < -180.0 or max_lon > 180.0:
+        return min_lat, max_lat, None, None
+
+    return min_lat, max_lat, min_lon, max_lon
+
+
+class CoordinateArray:
+    """Latitudes and longitudes packed into contiguous float arrays"""
+
+    def __init__(self, latitudes: Sequence[float], longitudes: Sequence[float]):
+        if len(latitudes) != len(longitudes):
+            raise ValueError("latitudes and longitudes must have the same length")
+
+        if np is not None:
+            self.latitudes = np.asarray(latitudes, dtype=np.float64)
+            self.longitudes = np.asarray(longitudes, dtype=np.float64)
+            # Radian forms are reused by every query against this array
+            self._lat_rad = np.radians(self.latitudes)
+            self._lon_rad = np.radians(self.longitudes)
+            self._cos_lat = np.cos(self._lat_rad)
+        else:
+            self.latitudes = array('d', latitudes)
+            self.longitudes = array('d', longitudes)
+
+    def __len__(self) -> int:
+        return len(self.latitudes)
+
+    @classmethod
+    def from_objects(cls, objects: Iterable, lat_attr: str = 'latitude', lon_attr: str = 'longitude') -> 'CoordinateArray':
+        """Build an array from model instances (or anything with coordinate attributes)"""
+        latitudes = []
+        longitudes = []
+        for obj in objects:
+            latitudes.append(getattr(obj, lat_attr))
+            longitudes.append(getattr(obj, lon_attr))
+        return cls(latitudes, longitudes)
+
+    @classmethod
+    def from_pairs(cls, pairs: Iterable[Tuple[float, float]]) -> 'CoordinateArray':
+        """Build an array from (latitude, longitude) tuples, e.g. a values_list() result"""
+        latitudes = []
+        longitudes = []
+        for latitude, longitude in pairs:
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+        return cls(latitudes, longitudes)
+
+    def distances_from(self, latitude: float, longitude: float):
+        """Distances in meters from one point to every coordinate, in a single pass"""
+        if np is not None:
+            lat_rad = math.radians(latitude)
+            lon_rad = math.radians(longitude)
+            sin_dlat = np.sin((self._lat_rad - lat_rad) / 2)
+            sin_dlon = np.sin((self._lon_rad - lon_rad) / 2)
+            a = sin_dlat * sin_dlat + math.cos(lat_rad) * self._cos_lat * sin_dlon * sin_dlon
+            return EARTH_RADIUS_METERS * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+        return array('d', (
+            haversine_meters(latitude, longitude, lat, lon)
+            for lat, lon in zip(self.latitudes, self.longitudes)
+        ))
+
+    def sorted_by_distance(self, latitude: float, longitude: float,
+                           max_distance_meters: Optional[float] = None) -> Tuple[List[float], List[int]]:
+        """Return (distances, order) where order lists indexes nearest first, optionally capped"""
+        distances = self.distances_from(latitude, longitude)
+
+        if np is not None:
+            if max_distance_meters is not None:
+                candidates = np.flatnonzero(distances <= max_distance_meters)
+                order = candidates[np.argsort(distances[candidates], kind='stable')]
+            else:
+                order = np.argsort(distances, kind='stable')
+            return distances.tolist(), order.tolist()
+
+        order = sorted(range(len(distances)), key=distances.__getitem__)
+        if max_distance_meters is not None:
+            order = [i for i in order if distances[i] <= max_distance_meters]
+        return list(distances), order
+
+    def nearest(self, latitude: float, longitude: float) -> Tuple[Optional[int], float]:
+        """Index of and distance to the closest coordinate, or (None, inf) when empty"""
+        if not len(self):
+            return None, float('inf')
+
+        distances = self.distances_from(latitude, longitude)
+        if np is not None:
+            index = int(np.argmin(distances))
+        else:
+            index = min(range(len(distances)), key=distances.__getitem__)
+        return index, float(distances[index])
@@ -0,0 +1,236 @@
+"""
+Prepared geofence polygons and a per-market zone index for point-in-zone lookups
+"""
+import math
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .cache_versions import get_version, bump_version
+from .distance_engine import bounding_box, haversine_meters
+from .models import GeofenceZone, Market
+
+# ~110m per cell; zones are bucketed into every cell their bounding box touches
+ZONE_CELL_DEGREES = 0.001
+
+# Zones spanning more cells than this are checked on every lookup instead of being bucketed
+MAX_CELLS_PER_ZONE = 256
+
+VERSION_NAMESPACE = 'geofence_index'
+
+BOUNDARY_VERSION_NAMESPACE = 'market_boundary'
+
+# Parsed market boundaries kept per process; least recently used markets are evicted first
+MARKET_BOUNDARY_CACHE_SIZE = 512
+# Prepared zone indexes kept per process, evicted the same way
+GEOFENCE_INDEX_CACHE_SIZE = 256
+
+
+class PreparedPolygon:
+    """
+    Polygon parsed once into a flat [lat0, lon0, lat1, lon1, ...] array with its bounding box.
+    Vertices are stored as [latitude, longitude] pairs (or latitude/longitude dicts).
+    """
+
+    def __init__(self, coords: array):
+        self.coords = coords
+        self.size = len(coords) // 2
+        latitudes = coords[0::2]
+        longitudes = coords[1::2]
+        self.bbox = (min(latitudes), max(latitudes), min(longitudes), max(longitudes))
+
+    @classmethod
+    def from_coordinates(cls, points) -> Optional['PreparedPolygon']:
+        """Parse boundary JSON, returning None when it does not describe a polygon"""
+        if not isinstance(points, list):
+            return None
+
+        coords = array('d')
+        try:
+            for point in points:
+                if isinstance(point, dict):
+                    coords.append(float(point['latitude']))
+                    coords.append(float(point['longitude']))
+                else:
+                    coords.append(float(point[0]))
+                    coords.append(float(point[1]))
+        except (KeyError, IndexError, TypeError, ValueError):
+            return None
+
+        # A closing vertex that repeats the first one adds nothing to ray casting
+        if len(coords) >= 4 and coords[0] == coords[-2] and coords[1] == coords[-1]:
+            del coords[-2:]
+        if len(coords) < 6:
+            return None
+        return cls(coords)
+
+    def contains(self, latitude: float, longitude: float) -> bool:
+        """Ray casting test, rejecting points outside the bounding box first"""
+        min_lat, max_lat, min_lon, max_lon = self.bbox
+        if latitude < min_lat or latitude > max_lat or longitude < min_lon or longitude > max_lon:
+            return False
+
+        coords = self.coords
+        inside = False
+        j = 2 * (self.size - 1)
+        for i in range(0, 2 * self.size, 2):
+            lat_i = coords[i]
+            lat_j = coords[j]
+            if (lat_i > latitude) != (lat_j > latitude):
+                lon_i = coords[i + 1]
+                crossing = lon_i + (latitude - lat_i) * (coords[j + 1] - lon_i) / (lat_j - lat_i)
+                if longitude < crossing:
+                    inside = not inside
+            j = i
+        return inside
+
+    def area(self) -> float:
+        """Shoelace area in squared degrees, only meaningful for ranking polygons"""
+        coords = self.coords
+        total = 0.0
+        j = 2 * (self.size - 1)
+        for i in range(0, 2 * self.size, 2):
+            total += coords[j + 1] * coords[i] - coords[i + 1] * coords[j]
+            j = i
+        return abs(total) / 2
+
+
+class PreparedZone:
+    """A geofence zone with its boundary polygon, or its radius circle when it has no polygon"""
+
+    def __init__(self, zone: GeofenceZone):
+        self.zone = zone
+        self.polygon = PreparedPolygon.from_coordinates(zone.boundary_coordinates)
+        if self.polygon is not None:
+            self.bbox = self.polygon.bbox
+            self.area = self.polygon.area()
+        else:
+            min_lat, max_lat, min_lon, max_lon = bounding_box(
+                zone.center_latitude, zone.center_longitude, zone.radius_meters
+            )
+            self.bbox = (min_lat, max_lat,
+                         min_lon if min_lon is not None else -180.0,
+                         max_lon if max_lon is not None else 180.0)
+            self.area = (max_lat - min_lat) * (self.bbox[3] - self.bbox[2])
+
+    def contains(self, latitude: float, longitude: float) -> bool:
+        if self.polygon is not None:
+            return self.polygon.contains(latitude, longitude)
+        distance = haversine_meters(latitude, longitude, self.zone.center_latitude, self.zone.center_longitude)
+        return distance <= self.zone.radius_meters
+
+
+class GeofenceIndex:
+    """Grid of zone bounding boxes for one market; only zones bucketed in the query cell are tested"""
+
+    def __init__(self, market_id: str, zones: Iterable[GeofenceZone], cell_degrees: float = ZONE_CELL_DEGREES):
+        self.market_id = market_id
+        self.cell_degrees = cell_degrees
+        self.cells: Dict[Tuple[int, int], List[PreparedZone]] = {}
+        self.large: List[PreparedZone] = []
+        # Entrance zones, the origins of precomputed routes
+        self.entrances: List[GeofenceZone] = []
+        self.size = 0
+
+        for zone in zones:
+            prepared = PreparedZone(zone)
+            if zone.zone_type == 'entrance':
+                self.entrances.append(zone)
+            min_lat, max_lat, min_lon, max_lon = prepared.bbox
+            min_row, min_col = self._cell(min_lat, min_lon)
+            max_row, max_col = self._cell(max_lat, max_lon)
+            self.size += 1
+
+            if (max_row - min_row + 1) * (max_col - min_col + 1) > MAX_CELLS_PER_ZONE:
+                self.large.append(prepared)
+                continue
+            for r in range(min_row, max_row + 1):
+                for c in range(min_col, max_col + 1):
+                    self.cells.setdefault((r, c), []).append(prepared)
+
+    def _cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return (int(math.floor(latitude / self.cell_degrees)),
+                int(math.floor(longitude / self.cell_degrees)))
+
+    def zones_at(self, latitude: float, longitude: float, floor_level: Optional[int] = None) -> List[GeofenceZone]:
+        """Every zone containing the point, smallest first; floor_level limits to zones on that floor"""
+        candidates = self.cells.get(self._cell(latitude, longitude), [])
+        if self.large:
+            candidates = candidates + self.large
+
+        matches = [
+            prepared for prepared in candidates
+            if (floor_level is None or prepared.zone.floor_level == floor_level)
+            and prepared.contains(latitude, longitude)
+        ]
+        matches.sort(key=lambda prepared: prepared.area)
+        return [prepared.zone for prepared in matches]
+
+
+class GeofenceRegistry:
+    """Process-local LRU of per-market geofence indexes, invalidated through version tokens"""
+
+    _indexes: 'OrderedDict[str, Tuple[str, GeofenceIndex]]' = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def for_market(cls, market_id: str) -> GeofenceIndex:
+        market_id = str(market_id)
+        version = get_version(VERSION_NAMESPACE, market_id)
+
+        with cls._lock:
+            cached = cls._indexes.get(market_id)
+            if cached and cached[0] == version:
+                cls._indexes.move_to_end(market_id)
+                return cached[1]
+
+        index = GeofenceIndex(market_id, GeofenceZone.objects.filter(market_id=market_id))
+        with cls._lock:
+            cls._indexes[market_id] = (version, index)
+            cls._indexes.move_to_end(market_id)
+            while len(cls._indexes) > GEOFENCE_INDEX_CACHE_SIZE:
+                cls._indexes.popitem(last=False)
+        return index
+
+    @classmethod
+    def invalidate(cls, market_id: str) -> None:
+        market_id = str(market_id)
+        with cls._lock:
+            cls._indexes.pop(market_id, None)
+        bump_version(VERSION_NAMESPACE, market_id)
+
+
+class MarketBoundaryCache:
+    """Process-local LRU of parsed market boundary polygons, invalidated through version tokens"""
+
+    _boundaries: 'OrderedDict[str, Tuple[str, Optional[PreparedPolygon]]]' = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def for_market(cls, market_id: str) -> Optional[PreparedPolygon]:
+        """The market's boundary polygon, or None when the market has none (or does not exist)"""
+        market_id = str(market_id)
+        version = get_version(BOUNDARY_VERSION_NAMESPACE, market_id)
+
+        with cls._lock:
+            cached = cls._boundaries.get(market_id)
+            if cached and cached[0] == version:
+                cls._boundaries.move_to_end(market_id)
+                return cached[1]
+
+        boundary = Market.objects.filter(id=market_id).values_list('boundary_coordinates', flat=True).first()
+        polygon = PreparedPolygon.from_coordinates(boundary)
+        with cls._lock:
+            cls._boundaries[market_id] = (version, polygon)
+            cls._boundaries.move_to_end(market_id)
+            while len(cls._boundaries) > MARKET_BOUNDARY_CACHE_SIZE:
+                cls._boundaries.popitem(last=False)
+        return polygon
+
+    @classmethod
+    def invalidate(cls, market_id: str) -> None:
+        market_id = str(market_id)
+        with cls._lock:
+            cls._boundaries.pop(market_id, None)
+        bump_version(BOUNDARY_VERSION_NAMESPACE, market_id)
@@ -0,0 +1,140 @@
+"""
+Downsampling and retention for UserLocation history
+"""
+import math
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+
+from django.db import transaction
+
+from .distance_engine import METERS_PER_DEGREE_LAT
+from .models import UserLocation
+
+# A pause longer than this starts a new track; the points either side are both kept
+TRACK_GAP_SECONDS = 300
+
+DELETE_BATCH_SIZE = 1000
+
+HISTORY_FIELDS = (
+    'id', 'market_id', 'latitude', 'longitude', 'floor_level',
+    'current_shop_id', 'current_zone_id', 'timestamp',
+)
+
+
+def douglas_peucker(points: Sequence[Tuple[float, float]], tolerance: float) -> List[int]:
+    """Indexes of the points kept when simplifying a polyline of planar (x, y) points"""
+    count = len(points)
+    if count < 3:
+        return list(range(count))
+
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay = points[first]
+        dx = points[last][0] - ax
+        dy = points[last][1] - ay
+        length_sq = dx * dx + dy * dy
+
+        farthest = None
+        max_distance = tolerance
+        for i in range(first + 1, last):
+            px = points[i][0] - ax
+            py = points[i][1] - ay
+            if length_sq:
+                t = max(0.0, min(1.0, (px * dx + py * dy) / length_sq))
+                px -= t * dx
+                py -= t * dy
+            distance = math.hypot(px, py)
+            if distance > max_distance:
+                farthest, max_distance = i, distance
+
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+
+    return [i for i, kept in enumerate(keep) if kept]
+
+
+class LocationHistoryCompactor:
+    """Thins old location tracks and enforces the retention window"""
+
+    def __init__(self, tolerance_meters: float, dry_run: bool = False):
+        self.tolerance_meters = tolerance_meters
+        self.dry_run = dry_run
+
+    def compact(self, before: datetime, since: Optional[datetime] = None) -> Tuple[int, int]:
+        """
+        Douglas-Peucker simplify each user's track between since and before.
+        Tracks are split at pauses and at market, floor, shop and zone changes, so the
+        context a user moved through survives compaction. Returns (examined, removed).
+        """
+        history = UserLocation.objects.filter(timestamp__lt=before)
+        if since is not None:
+            history = history.filter(timestamp__gte=since)
+
+        examined = removed = 0
+        user_ids = history.order_by().values_list('user_id', flat=True).distinct()
+        for user_id in list(user_ids):
+            rows = list(history.filter(user_id=user_id).order_by('timestamp').values_list(*HISTORY_FIELDS))
+            examined += len(rows)
+
+            redundant = []
+            track = []
+            for row in rows:
+                if track and not self._same_track(track[-1], row):
+                    redundant.extend(self._redundant_points(track))
+                    track = []
+                track.append(row)
+            redundant.extend(self._redundant_points(track))
+
+            removed += len(redundant)
+            if not self.dry_run:
+                self._delete_ids(redundant)
+
+        return examined, removed
+
+    def apply_retention(self, before: datetime) -> int:
+        """Delete history older than the retention cutoff in bounded batches"""
+        expired = UserLocation.objects.filter(timestamp__lt=before)
+        if self.dry_run:
+            return expired.count()
+
+        removed = 0
+        while True:
+            ids = list(expired.values_list('id', flat=True)[:DELETE_BATCH_SIZE])
+            if not ids:
+                return removed
+            self._delete_ids(ids)
+            removed += len(ids)
+
+    @staticmethod
+    def _same_track(previous: tuple, row: tuple) -> bool:
+        # Compare market, floor, shop and zone, then the time gap
+        if previous[1] != row[1] or previous[4:7] != row[4:7]:
+            return False
+        return (row[7] - previous[7]).total_seconds() <= TRACK_GAP_SECONDS
+
+    def _redundant_points(self, track: List[tuple]) -> List:
+        if len(track) < 3:
+            return []
+
+        # Equirectangular projection around the track start is plenty at market scale
+        origin_lat = track[0][2]
+        origin_lon = track[0][3]
+        lon_scale = METERS_PER_DEGREE_LAT * math.cos(math.radians(origin_lat))
+        points = [
+            ((row[3] - origin_lon) * lon_scale, (row[2] - origin_lat) * METERS_PER_DEGREE_LAT)
+            for row in track
+        ]
+
+        kept = set(douglas_peucker(points, self.tolerance_meters))
+        return [row[0] for i, row in enumerate(track) if i not in kept]
+
+    @staticmethod
+    def _delete_ids(ids: List) -> None:
+        for start in range(0, len(ids), DELETE_BATCH_SIZE):
+            with transaction.atomic():
+                UserLocation.objects.filter(id__in=ids[start:start + DELETE_BATCH_SIZE]).delete()
@@ -0,0 +1,157 @@
+"""
+Daily range partitions of the UserLocation history table on PostgreSQL
+"""
+import logging
+import re
+from datetime import date, datetime, time, timedelta, timezone as dt_timezone
+from typing import Iterable, List
+
+from django.db import connections, transaction
+
+from .models import UserLocation
+
+logger = logging.getLogger(__name__)
+
+PARTITION_SUFFIX = re.compile(r'_p(\d{8})$')
+
+
+def partition_name(table: str, day: date) -> str:
+    return f'{table}_p{day:%Y%m%d}'
+
+
+def day_start(day: date) -> datetime:
+    return datetime.combine(day, time.min, tzinfo=dt_timezone.utc)
+
+
+def expired_days(days: Iterable[date], before: datetime) -> List[date]:
+    """Partition days that end at or before the cutoff, so dropping them removes only expired fixes"""
+    return sorted(day for day in days if day_start(day + timedelta(days=1)) <= before)
+
+
+class LocationPartitionManager:
+    """
+    Keeps UserLocation as a table partitioned by day on timestamp, on PostgreSQL only.
+    Inserts and "latest location" reads touch the newest partitions, and retention drops
+    whole days instead of deleting rows. A default partition catches fixes outside the
+    daily ranges. Other databases keep the single table with its (user, timestamp) index
+    and batched retention deletes.
+    """
+
+    def __init__(self, using: str = 'default'):
+        self.connection = connections[using]
+        self.table = UserLocation._meta.db_table
+
+    def supported(self) -> bool:
+        return self.connection.vendor == 'postgresql'
+
+    def quote(self, name: str) -> str:
+        return self.connection.ops.quote_name(name)
+
+    def is_partitioned(self) -> bool:
+        if not self.supported():
+            return False
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [self.table])
+            row = cursor.fetchone()
+        return bool(row) and row[0] == 'p'
+
+    def partition_days(self) -> List[date]:
+        """Days that have a partition, oldest first"""
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = to_regclass(%s)", [self.table]
+            )
+            names = [row[0] for row in cursor.fetchall()]
+        days = []
+        for name in names:
+            match = PARTITION_SUFFIX.search(name)
+            if match:
+                days.append(datetime.strptime(match.group(1), '%Y%m%d').date())
+        return sorted(days)
+
+    def ensure_partitions(self, days_ahead: int, start: date = None) -> int:
+        """Create the daily partitions from start (default today) through days_ahead; returns how many were new"""
+        start = start or datetime.now(dt_timezone.utc).date()
+        existing = set(self.partition_days())
+        created = 0
+        with self.connection.cursor() as cursor:
+            for offset in range((datetime.now(dt_timezone.utc).date() - start).days + days_ahead + 1):
+                day = start + timedelta(days=offset)
+                if day in existing:
+                    continue
+                # DDL takes no parameters; the bounds are generated here, never user input
+                cursor.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self.quote(partition_name(self.table, day))} "
+                    f"PARTITION OF {self.quote(self.table)} "
+                    f"FOR VALUES FROM ('{day_start(day).isoformat()}') "
+                    f"TO ('{day_start(day + timedelta(days=1)).isoformat()}')"
+                )
+                created += 1
+        return created
+
+    def drop_partitions_before(self, before: datetime, dry_run: bool = False) -> List[date]:
+        """Drop the daily partitions holding only fixes older than the cutoff; returns their days"""
+        days = expired_days(self.partition_days(), before)
+        if not dry_run:
+            with self.connection.cursor() as cursor:
+                for day in days:
+                    cursor.execute(f"DROP TABLE IF EXISTS {self.quote(partition_name(self.table, day))}")
+        return days
+
+    def convert(self, days_ahead: int) -> int:
+        """
+        Rebuild the plain table as a partitioned one, copying every row into daily partitions.
+        The primary key becomes (id, timestamp), since PostgreSQL requires unique keys of a
+        partitioned table to include the partition column. Returns the number of rows copied.
+        Takes an exclusive lock on the table for the duration of the copy.
+        """
+        if not self.supported():
+            raise NotImplementedError('Partitioned location history needs PostgreSQL')
+        if self.is_partitioned():
+            return 0
+
+        table = self.quote(self.table)
+        legacy = self.quote(f'{self.table}_unpartitioned')
+        with transaction.atomic(using=self.connection.alias), self.connection.cursor() as cursor:
+            # Recreated on the new table under the same names, so later migrations still find them
+            cursor.execute(
+                "SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE conrelid = to_regclass(%s) AND contype IN ('p', 'f')", [self.table]
+            )
+            constraints = cursor.fetchall()
+            cursor.execute(
+                "SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s "
+                "AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s))",
+                [self.table, self.table]
+            )
+            indexes = [row[0] for row in cursor.fetchall()]
+
+            cursor.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+            cursor.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+            cursor.execute(
+                f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+                f'PARTITION BY RANGE ("timestamp")'
+            )
+            cursor.execute(
+                f"CREATE TABLE {self.quote(f'{self.table}_default')} PARTITION OF {table} DEFAULT"
+            )
+
+            cursor.execute(f'SELECT min("timestamp") FROM {legacy}')
+            oldest = cursor.fetchone()[0]
+            start = oldest.astimezone(dt_timezone.utc).date() if oldest else None
+            self.ensure_partitions(days_ahead, start)
+
+            cursor.execute(f"INSERT INTO {table} SELECT * FROM {legacy}")
+            copied = cursor.rowcount
+            cursor.execute(f"DROP TABLE {legacy}")
+
+            for name, kind, definition in constraints:
+                if kind == 'p':
+                    definition = 'PRIMARY KEY (id, "timestamp")'
+                cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {self.quote(name)} {definition}")
+            for definition in indexes:
+                cursor.execute(definition)
+
+        logger.info("Partitioned %s by day, copying %d rows", self.table, copied)
+        return copied
@@ -0,0 +1,186 @@
+"""
+Write-behind buffer that takes UserLocation inserts off the request path
+"""
+import atexit
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .models import UserLocation
+
+logger = logging.getLogger(__name__)
+
+# Wakes the flush thread up on shutdown
+_STOP = object()
+
+# Stop signals that flush the buffer before the handler installed earlier runs
+SHUTDOWN_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+class LocationWriteBuffer:
+    """
+    Bounded in-process queue of UserLocation rows flushed with bulk_create every
+    LOCATION_WRITE_BEHIND_BATCH_SIZE rows or LOCATION_WRITE_BEHIND_FLUSH_MS milliseconds.
+    When the queue is full the caller writes its rows itself, so memory stays bounded and
+    a slow database pushes back on the request path instead of dropping fixes.
+    """
+
+    _queue: Optional[queue.Queue] = None
+    _lock = threading.Lock()
+    _thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return getattr(settings, 'LOCATION_WRITE_BEHIND_ENABLED', False)
+
+    @classmethod
+    def submit(cls, locations: List[UserLocation]) -> None:
+        """Queue rows for insertion, writing them synchronously when buffering is off or full"""
+        if not cls.enabled():
+            UserLocation.objects.bulk_create(locations)
+            return
+
+        cls._ensure_worker()
+        overflow = []
+        for location in locations:
+            try:
+                cls._queue.put_nowait(location)
+            except queue.Full:
+                overflow.append(location)
+
+        if overflow:
+            logger.warning("Location write buffer full; writing %d rows on the request path", len(overflow))
+            UserLocation.objects.bulk_create(overflow)
+
+    @classmethod
+    def _ensure_worker(cls) -> None:
+        if cls._thread is not None and cls._thread.is_alive():
+            return
+        with cls._lock:
+            if cls._thread is not None and cls._thread.is_alive():
+                return
+            if cls._queue is None:
+                cls._queue = queue.Queue(maxsize=getattr(settings, 'LOCATION_WRITE_BEHIND_MAX_PENDING', 10000))
+                atexit.register(cls.shutdown)
+            cls._thread = threading.Thread(target=cls._run, name='location-writer', daemon=True)
+            cls._thread.start()
+
+    @classmethod
+    def _run(cls) -> None:
+        batch_size = getattr(settings, 'LOCATION_WRITE_BEHIND_BATCH_SIZE', 200)
+        flush_seconds = getattr(settings, 'LOCATION_WRITE_BEHIND_FLUSH_MS', 500) / 1000
+
+        stopping = False
+        while not stopping:
+            item = cls._queue.get()
+            if item is _STOP:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + flush_seconds
+            while len(batch) < batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = cls._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            cls._write(batch)
+
+        # Shutting down: whatever is still queued goes out in final batches
+        cls._write(cls._drain())
+
+    @classmethod
+    def _drain(cls) -> List[UserLocation]:
+        rows = []
+        while True:
+            try:
+                item = cls._queue.get_nowait()
+            except queue.Empty:
+                return rows
+            if item is not _STOP:
+                rows.append(item)
+
+    @staticmethod
+    def _write(rows: List[UserLocation]) -> None:
+        if not rows:
+            return
+        close_old_connections()
+        try:
+            with transaction.atomic():
+                UserLocation.objects.bulk_create(
+                    rows, batch_size=getattr(settings, 'LOCATION_WRITE_BEHIND_BATCH_SIZE', 200)
+                )
+        except Exception:
+            # The bulk insert is atomic, so one bad row rolled back the batch; retry row by row
+            logger.warning("Bulk flush of %d buffered user locations failed; retrying row by row", len(rows))
+            LocationWriteBuffer._write_each(rows)
+        finally:
+            close_old_connections()
+
+    @staticmethod
+    def _write_each(rows: List[UserLocation]) -> None:
+        failed = 0
+        for row in rows:
+            try:
+                with transaction.atomic():
+                    UserLocation.objects.bulk_create([row])
+            except Exception:
+                failed += 1
+                logger.exception("Dropping buffered location of user %s at %s", row.user_id, row.timestamp)
+        if failed:
+            logger.error("Dropped %d of %d buffered user locations", failed, len(rows))
+
+    @classmethod
+    def install_signal_handlers(cls) -> None:
+        """
+        Flush on SIGTERM and SIGINT, then pass the signal on to the previous handler. atexit
+        never runs when a signal's default action kills the process, and only the main
+        thread can install handlers, so this runs from MarketsConfig.ready().
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for signum in SHUTDOWN_SIGNALS:
+            previous = signal.getsignal(signum)
+            if not getattr(previous, 'flushes_locations', False):
+                signal.signal(signum, cls._signal_handler(previous))
+
+    @classmethod
+    def _signal_handler(cls, previous):
+        def handle(signum, frame):
+            cls.shutdown()
+            if callable(previous):
+                previous(signum, frame)
+            elif previous == signal.SIG_DFL:
+                # Re-deliver so the process still ends the way it would have
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        handle.flushes_locations = True
+        return handle
+
+    @classmethod
+    def shutdown(cls, timeout: float = 10.0) -> None:
+        """Flush everything still buffered; runs at interpreter exit, on stop signals and on ASGI shutdown"""
+        thread = cls._thread
+        if cls._queue is None or thread is None or not thread.is_alive():
+            if cls._queue is not None:
+                cls._write(cls._drain())
+            return
+
+        # Blocks if the queue is full, which is fine since the worker is draining it
+        cls._queue.put(_STOP)
+        thread.join(timeout)
@@ -0,0 +1,69 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from markets.distance_engine import CoordinateArray, np
+from markets.navigation_utils import NavigationService
+
+
+class Command(BaseCommand):
+    help = 'Benchmark per-row vs batched haversine distance sorting for shop listings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='100,10000,100000',
+                            help='Comma-separated shop counts to benchmark')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Runs per size; the fastest run is reported')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        repeat = max(options['repeat'], 1)
+        rng = random.Random(42)
+
+        # Roughly the footprint of a large Lagos market
+        origin_lat, origin_lon = 6.4531, 3.3958
+        user_lat, user_lon = origin_lat + 0.001, origin_lon - 0.001
+
+        self.stdout.write(f"Batch engine backend: {'numpy' if np is not None else 'array'}")
+        self.stdout.write(f"{'shops':>8} {'per-row (ms)':>14} {'batched (ms)':>14} {'speedup':>9}")
+
+        for size in sizes:
+            pairs = [
+                (origin_lat + rng.uniform(-0.01, 0.01), origin_lon + rng.uniform(-0.01, 0.01))
+                for _ in range(size)
+            ]
+
+            loop_time = self._best_of(repeat, lambda: self._per_row(pairs, user_lat, user_lon))
+            batch_time = self._best_of(repeat, lambda: self._batched(pairs, user_lat, user_lon))
+
+            loop_order = self._per_row(pairs, user_lat, user_lon)
+            batch_order = self._batched(pairs, user_lat, user_lon)
+            if loop_order != batch_order:
+                self.stdout.write(self.style.WARNING(f'Orderings differ for {size} shops'))
+
+            self.stdout.write(
+                f"{size:>8} {loop_time * 1000:>14.2f} {batch_time * 1000:>14.2f} "
+                f"{loop_time / batch_time if batch_time else float('inf'):>8.1f}x"
+            )
+
+    @staticmethod
+    def _best_of(repeat, func):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    @staticmethod
+    def _per_row(pairs, user_lat, user_lon):
+        """Mirror of the original MarketViewSet.shops loop"""
+        rows = []
+        for index, (lat, lon) in enumerate(pairs):
+            rows.append((NavigationService.calculate_distance(user_lat, user_lon, lat, lon), index))
+        rows.sort(key=lambda row: row[0])
+        return [index for _, index in rows]
+
+    @staticmethod
+    def _batched(pairs, user_lat, user_lon):
+        _, order = CoordinateArray.from_pairs(pairs).sorted_by_distance(user_lat, user_lon)
+        return order
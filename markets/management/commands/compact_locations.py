@@ -0,0 +1,54 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from markets.location_history import LocationHistoryCompactor
+from markets.location_partitions import LocationPartitionManager
+
+
+class Command(BaseCommand):
+    help = 'Downsample old UserLocation tracks and delete history past the retention window'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=settings.LOCATION_HISTORY_COMPACT_AFTER_DAYS,
+                            help='Only compact fixes older than this many days')
+        parser.add_argument('--window-days', type=int, default=1,
+                            help='How many days before the cutoff to compact (0 compacts everything older); '
+                                 'matches a daily schedule so each day is simplified once')
+        parser.add_argument('--retention-days', type=int, default=settings.LOCATION_HISTORY_RETENTION_DAYS,
+                            help='Delete fixes older than this many days (0 keeps everything)')
+        parser.add_argument('--tolerance', type=float, default=settings.LOCATION_HISTORY_TOLERANCE_METERS,
+                            help='Douglas-Peucker tolerance in meters')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be removed')
+
+    def handle(self, *args, **options):
+        if options['older_than_days'] < 0 or options['window_days'] < 0 or options['retention_days'] < 0:
+            raise CommandError('Day counts must not be negative')
+
+        now = timezone.now()
+        compactor = LocationHistoryCompactor(options['tolerance'], dry_run=options['dry_run'])
+        verb = 'Would remove' if options['dry_run'] else 'Removed'
+
+        partitions = LocationPartitionManager()
+        if partitions.is_partitioned():
+            if not options['dry_run']:
+                created = partitions.ensure_partitions(settings.LOCATION_HISTORY_PARTITION_DAYS_AHEAD)
+                self.stdout.write(f'Created {created} daily location partitions')
+            if options['retention_days']:
+                # Whole expired days go at once; the batched delete below handles the rest
+                dropped = partitions.drop_partitions_before(
+                    now - timedelta(days=options['retention_days']), dry_run=options['dry_run']
+                )
+                self.stdout.write(f'{verb} {len(dropped)} daily partitions past the retention window')
+
+        if options['retention_days']:
+            expired = compactor.apply_retention(now - timedelta(days=options['retention_days']))
+            self.stdout.write(f'{verb} {expired} fixes past the {options["retention_days"]}-day retention window')
+
+        before = now - timedelta(days=options['older_than_days'])
+        since = before - timedelta(days=options['window_days']) if options['window_days'] else None
+        examined, removed = compactor.compact(before, since)
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {removed} of {examined} fixes while downsampling tracks '
+            f'(tolerance {options["tolerance"]}m)'
+        ))
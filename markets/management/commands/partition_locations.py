@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from markets.location_partitions import LocationPartitionManager
+
+
+class Command(BaseCommand):
+    help = 'Partition UserLocation history by day on PostgreSQL and create upcoming daily partitions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert', action='store_true',
+                            help='Rebuild the existing table as a partitioned one (locks it while rows are copied)')
+        parser.add_argument('--days-ahead', type=int, default=settings.LOCATION_HISTORY_PARTITION_DAYS_AHEAD,
+                            help='Create daily partitions this many days ahead')
+
+    def handle(self, *args, **options):
+        if options['days_ahead'] < 0:
+            raise CommandError('--days-ahead must not be negative')
+
+        partitions = LocationPartitionManager()
+        if not partitions.supported():
+            self.stdout.write(
+                f'{partitions.connection.vendor} keeps location history in one table indexed on (user, timestamp); '
+                f'compact_locations enforces retention with batched deletes'
+            )
+            return
+
+        if not partitions.is_partitioned():
+            if not options['convert']:
+                raise CommandError('Location history is not partitioned yet; run again with --convert')
+            copied = partitions.convert(options['days_ahead'])
+            self.stdout.write(f'Partitioned location history by day, copying {copied} rows')
+
+        created = partitions.ensure_partitions(options['days_ahead'])
+        self.stdout.write(self.style.SUCCESS(f'Created {created} daily location partitions'))
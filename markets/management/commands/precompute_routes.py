@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from markets.models import Market
+from markets.route_precompute import RoutePrecomputer
+
+
+class Command(BaseCommand):
+    help = 'Precompute shop-to-shop and entrance-to-shop routes into NavigationRoute'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--market', help='Only rebuild routes for this market id')
+        parser.add_argument('--shop', help='Only refresh routes starting or ending at this shop id (requires --market)')
+
+    def handle(self, *args, **options):
+        if options['shop'] and not options['market']:
+            raise CommandError('--shop requires --market')
+
+        markets = Market.objects.all()
+        if options['market']:
+            markets = markets.filter(id=options['market'])
+            if not markets.exists():
+                raise CommandError(f"Market {options['market']} not found")
+
+        for market in markets:
+            precomputer = RoutePrecomputer(market)
+            if not precomputer.enabled:
+                self.stdout.write(f'Skipping {market.name}: no walkway graph in map_data')
+                continue
+
+            if options['shop']:
+                count = precomputer.refresh_shop(options['shop'])
+            else:
+                count = precomputer.rebuild_market()
+            self.stdout.write(self.style.SUCCESS(f'Stored {count} routes for {market.name}'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from markets.stock_reservations import StockReservationService
+
+
+class Command(BaseCommand):
+    help = 'Return stock held by reservations that expired before their order was confirmed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be released')
+
+    def handle(self, *args, **options):
+        released = StockReservationService.release_expired(dry_run=options['dry_run'])
+        verb = 'Would release' if options['dry_run'] else 'Released'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {released} units of expired stock reservations'))
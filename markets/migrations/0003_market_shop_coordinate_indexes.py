@@ -0,0 +1,23 @@
+# Generated by Django 5.1.5 on 2026-10-17 03:59
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0002_market_boundary_coordinates_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='market',
+            index=models.Index(fields=['latitude', 'longitude'], name='market_lat_lon_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shop',
+            index=models.Index(fields=['market', 'latitude', 'longitude'], name='shop_market_lat_lon_idx'),
+        ),
+    ]
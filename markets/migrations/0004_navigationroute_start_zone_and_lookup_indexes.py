@@ -0,0 +1,27 @@
+# Generated by Django 5.1.5 on 2026-10-17 04:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0003_market_shop_coordinate_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='navigationroute',
+            name='start_zone',
+            field=models.ForeignKey(blank=True, help_text='Entrance zone the route starts from (precomputed routes)', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='routes_from', to='markets.geofencezone'),
+        ),
+        migrations.AddIndex(
+            model_name='navigationroute',
+            index=models.Index(fields=['end_shop', 'start_shop'], name='route_end_start_shop_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='navigationroute',
+            index=models.Index(fields=['end_shop', 'start_zone'], name='route_end_start_zone_idx'),
+        ),
+    ]
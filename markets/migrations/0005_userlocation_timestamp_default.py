@@ -0,0 +1,19 @@
+# Generated by Django 5.1.5 on 2026-10-17 04:06
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0004_navigationroute_start_zone_and_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='userlocation',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.5 on 2026-10-17 04:07
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0005_userlocation_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userlocation',
+            index=models.Index(fields=['user', 'timestamp'], name='userloc_user_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userlocation',
+            index=models.Index(fields=['timestamp'], name='userloc_timestamp_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.5 on 2026-10-17 04:08
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0006_userlocation_history_indexes'),
+        ('users', '0003_user_email_verified_user_phone_verified_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CurrentUserLocation',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='current_location', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('accuracy_meters', models.FloatField(blank=True, null=True)),
+                ('indoor_x', models.FloatField(blank=True, null=True)),
+                ('indoor_y', models.FloatField(blank=True, null=True)),
+                ('floor_level', models.IntegerField(blank=True, null=True)),
+                ('is_indoor', models.BooleanField(default=False)),
+                ('timestamp', models.DateTimeField()),
+                ('current_shop', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='markets.shop')),
+                ('current_zone', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='markets.geofencezone')),
+                ('market', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='current_user_locations', to='markets.market')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['market', 'timestamp'], name='curloc_market_timestamp_idx')],
+            },
+        ),
+    ]
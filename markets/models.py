@@ -1,7 +1,22 @@
 from django.db import models
+from django.utils import timezone
 from users.models import User
+from .distance_engine import bounding_box
 import uuid
 
+
+class GeoQuerySet(models.QuerySet):
+    """QuerySet helpers for models with latitude/longitude columns"""
+    
+    def within_bounding_box(self, latitude, longitude, radius_meters):
+        """Cheap indexed prefilter; callers still apply an exact distance check"""
+        min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_meters)
+        queryset = self.filter(latitude__range=(min_lat, max_lat))
+        if min_lon is not None:
+            queryset = queryset.filter(longitude__range=(min_lon, max_lon))
+        return queryset
+
+
 class Market(models.Model):
     """Model representing a physical market location"""
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -37,6 +52,13 @@ class Market(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = GeoQuerySet.as_manager()
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['latitude', 'longitude'], name='market_lat_lon_idx'),
+        ]
+    
     def __str__(self):
         return self.name
 
@@ -150,6 +172,35 @@ class OrderItem(models.Model):
     def subtotal(self):
         return self.quantity * self.price_at_time_of_order
 
+class StockReservation(models.Model):
+    """Stock taken from a product for an order, held until the order is confirmed or cancelled"""
+    STATUS_CHOICES = [
+        ('held', 'Held'),
+        ('confirmed', 'Confirmed'),
+        ('released', 'Released'),
+        ('expired', 'Expired'),
+    ]
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='stock_reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_reservations')
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='held')
+    
+    # Held stock returns to the product after this (see release_expired_reservations)
+    expires_at = models.DateTimeField()
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expires_at'], name='stockres_status_expires_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} for order {self.order_id} ({self.status})"
+
 class SellerAnalytics(models.Model):
     """Track seller analytics"""
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -260,8 +311,13 @@ class Shop(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = GeoQuerySet.as_manager()
+    
     class Meta:
         unique_together = ['market', 'shop_number']
+        indexes = [
+            models.Index(fields=['market', 'latitude', 'longitude'], name='shop_market_lat_lon_idx'),
+        ]
     
     def __str__(self):
         return f"{self.name} - {self.market.name}"
@@ -275,6 +331,10 @@ class NavigationRoute(models.Model):
     # Route endpoints
     start_shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='routes_from', null=True, blank=True)
     end_shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='routes_to', null=True, blank=True)
+    start_zone = models.ForeignKey(
+        'GeofenceZone', on_delete=models.CASCADE, related_name='routes_from', null=True, blank=True,
+        help_text="Entrance zone the route starts from (precomputed routes)"
+    )
     
     # Alternative: coordinate-based routing
     start_latitude = models.FloatField(null=True, blank=True)
@@ -299,6 +359,12 @@ class NavigationRoute(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['end_shop', 'start_shop'], name='route_end_start_shop_idx'),
+            models.Index(fields=['end_shop', 'start_zone'], name='route_end_start_zone_idx'),
+        ]
+    
     def __str__(self):
         if self.start_shop and self.end_shop:
             return f"Route: {self.start_shop.name} → {self.end_shop.name}"
@@ -370,12 +436,53 @@ class UserLocation(models.Model):
     battery_level = models.IntegerField(null=True, blank=True)
     signal_strength = models.IntegerField(null=True, blank=True)
     
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Defaults to now, but batched uploads keep the time each fix was taken on the device
+    timestamp = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        indexes = [
+            # Latest-location and per-user track reads
+            models.Index(fields=['user', 'timestamp'], name='userloc_user_timestamp_idx'),
+            # Retention and compaction sweeps by age
+            models.Index(fields=['timestamp'], name='userloc_timestamp_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} location at {self.timestamp}"
 
 
+class CurrentUserLocation(models.Model):
+    """Latest known position per user, upserted alongside every UserLocation fix"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='current_location')
+    market = models.ForeignKey(Market, on_delete=models.SET_NULL, related_name='current_user_locations', null=True, blank=True)
+    
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    accuracy_meters = models.FloatField(null=True, blank=True)
+    
+    # Indoor positioning
+    indoor_x = models.FloatField(null=True, blank=True)
+    indoor_y = models.FloatField(null=True, blank=True)
+    floor_level = models.IntegerField(null=True, blank=True)
+    
+    # Location context
+    is_indoor = models.BooleanField(default=False)
+    current_shop = models.ForeignKey(Shop, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    current_zone = models.ForeignKey(GeofenceZone, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    
+    # When the fix was taken
+    timestamp = models.DateTimeField()
+    
+    class Meta:
+        indexes = [
+            # Proximity lookups of users currently in a market
+            models.Index(fields=['market', 'timestamp'], name='curloc_market_timestamp_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username} last seen at {self.timestamp}"
+
+
 class NavigationSession(models.Model):
     """Model for tracking active navigation sessions"""
     SESSION_STATUS = [
@@ -5,9 +5,25 @@ import math
 import requests
 from typing import List, Dict, Tuple, Optional
 from django.conf import settings
-from .models import Shop, NavigationRoute, GeofenceZone, UserLocation, Market
+from django.utils import timezone
+from django.db.models import Q
+from .models import Shop, NavigationRoute, GeofenceZone, UserLocation, CurrentUserLocation, Market
+from .spatial_index import ShopIndexRegistry
+from .distance_engine import CoordinateArray
+from .location_writer import LocationWriteBuffer
+from .geofence_engine import GeofenceRegistry, MarketBoundaryCache, PreparedZone
+from .routing_engine import RoutingGraph, RoutingGraphRegistry
 import json
 
+# A user this close to a shop or entrance can reuse routes precomputed from it
+PRECOMPUTED_ROUTE_ORIGIN_METERS = 15
+
+# Columns copied from each new fix onto the user's CurrentUserLocation row
+CURRENT_LOCATION_FIELDS = [
+    'market', 'latitude', 'longitude', 'accuracy_meters', 'indoor_x', 'indoor_y',
+    'floor_level', 'is_indoor', 'current_shop', 'current_zone', 'timestamp',
+]
+
 
 class NavigationService:
     """Service class for handling navigation calculations and routing"""
@@ -32,130 +48,100 @@ class NavigationService:
     @staticmethod
     def find_nearby_shops(latitude: float, longitude: float, market_id: str, radius_meters: int = 100) -> List[Dict]:
         """Find shops within a specified radius of given coordinates"""
-        try:
-            market = Market.objects.get(id=market_id)
-            shops = market.shops.filter(is_active=True, is_verified=True)
-            
-            nearby_shops = []
-            for shop in shops:
-                distance = NavigationService.calculate_distance(
-                    latitude, longitude, shop.latitude, shop.longitude
-                )
-                
-                if distance <= radius_meters:
-                    nearby_shops.append({
-                        'shop': shop,
-                        'distance_meters': round(distance, 2),
-                        'latitude': shop.latitude,
-                        'longitude': shop.longitude,
-                        'name': shop.name,
-                        'shop_number': shop.shop_number,
-                        'floor_level': shop.floor_level
-                    })
-            
-            # Sort by distance
-            nearby_shops.sort(key=lambda x: x['distance_meters'])
-            return nearby_shops
-            
-        except Market.DoesNotExist:
-            return []
+        index = ShopIndexRegistry.for_market(market_id)
+        
+        return [
+            NavigationService._nearby_shop_entry(shop, distance)
+            for distance, shop in index.within_radius(latitude, longitude, radius_meters)
+        ]
+    
+    @staticmethod
+    def find_nearest_shops(latitude: float, longitude: float, market_id: str, limit: int = 1,
+                           max_distance_meters: Optional[float] = None) -> List[Dict]:
+        """Find the closest shops to given coordinates, optionally capped by distance"""
+        index = ShopIndexRegistry.for_market(market_id)
+        
+        return [
+            NavigationService._nearby_shop_entry(shop, distance)
+            for distance, shop in index.nearest(latitude, longitude, limit, max_distance_meters)
+        ]
+    
+    @staticmethod
+    def _nearby_shop_entry(shop: Shop, distance: float) -> Dict:
+        return {
+            'shop': shop,
+            'distance_meters': round(distance, 2),
+            'latitude': shop.latitude,
+            'longitude': shop.longitude,
+            'name': shop.name,
+            'shop_number': shop.shop_number,
+            'floor_level': shop.floor_level
+        }
     
     @staticmethod
     def is_point_in_geofence(latitude: float, longitude: float, geofence_zone: GeofenceZone) -> bool:
         """Check if a point is within a geofenced area"""
         try:
-            # Simple radius-based check
-            distance = NavigationService.calculate_distance(
-                latitude, longitude,
-                geofence_zone.center_latitude, geofence_zone.center_longitude
-            )
-            return distance <= geofence_zone.radius_meters
+            # Boundary polygon when the zone has one, otherwise its radius
+            return PreparedZone(geofence_zone).contains(latitude, longitude)
             
         except Exception:
             return False
     
     @staticmethod
-    def detect_user_zone(latitude: float, longitude: float, market_id: str) -> Optional[GeofenceZone]:
+    def detect_user_zones(latitude: float, longitude: float, market_id: str,
+                          floor_level: Optional[int] = None) -> List[GeofenceZone]:
+        """Detect every geofenced zone a user is in, most specific (smallest) first"""
+        return GeofenceRegistry.for_market(market_id).zones_at(latitude, longitude, floor_level)
+    
+    @staticmethod
+    def detect_user_zone(latitude: float, longitude: float, market_id: str,
+                         floor_level: Optional[int] = None) -> Optional[GeofenceZone]:
         """Detect which geofenced zone a user is currently in"""
-        try:
-            market = Market.objects.get(id=market_id)
-            zones = market.geofence_zones.all()
-            
-            for zone in zones:
-                if NavigationService.is_point_in_geofence(latitude, longitude, zone):
-                    return zone
-            
-            return None
-            
-        except Market.DoesNotExist:
-            return None
+        zones = NavigationService.detect_user_zones(latitude, longitude, market_id, floor_level)
+        return zones[0] if zones else None
     
     @staticmethod
     def is_indoor_location(latitude: float, longitude: float, market_id: str) -> bool:
         """Determine if user location is indoors based on market boundaries"""
-        try:
-            market = Market.objects.get(id=market_id)
-            
-            if not market.boundary_coordinates:
-                return False
-            
-            # Check if point is within market boundaries
-            boundary_points = market.boundary_coordinates
-            if isinstance(boundary_points, list) and len(boundary_points) >= 3:
-                # Simple point-in-polygon check
-                return NavigationService._point_in_polygon(latitude, longitude, boundary_points)
-            
+        boundary = MarketBoundaryCache.for_market(market_id)
+        if boundary is None:
             return False
-            
-        except Market.DoesNotExist:
-            return False
-    
-    @staticmethod
-    def _point_in_polygon(lat: float, lon: float, polygon_coords: List[List[float]]) -> bool:
-        """Check if point is inside polygon using ray casting algorithm"""
-        x, y = lon, lat
-        n = len(polygon_coords)
-        inside = False
-        
-        p1x, p1y = polygon_coords[0]
-        for i in range(1, n + 1):
-            p2x, p2y = polygon_coords[i % n]
-            if y > min(p1y, p2y):
-                if y <= max(p1y, p2y):
-                    if x <= max(p1x, p2x):
-                        if p1y != p2y:
-                            xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
-                        if p1x == p2x or x <= xinters:
-                            inside = not inside
-            p1x, p1y = p2x, p2y
         
-        return inside
+        # Boundary vertices are [latitude, longitude] pairs
+        return boundary.contains(latitude, longitude)
     
     @staticmethod
     def calculate_route_to_shop(start_lat: float, start_lon: float, shop_id: str, navigation_mode: str = 'walking') -> Dict:
         """Calculate route from current location to a specific shop"""
         try:
-            shop = Shop.objects.get(id=shop_id)
+            shop = Shop.objects.select_related('market').get(id=shop_id)
             
             # Check if we have a pre-calculated route
-            existing_route = NavigationRoute.objects.filter(
-                end_shop=shop,
-                start_latitude__isnull=True,
-                start_longitude__isnull=True
-            ).first()
+            existing_route, approach_distance = NavigationService._find_precomputed_route(
+                start_lat, start_lon, shop, navigation_mode
+            )
             
-            if existing_route:
+            if existing_route and approach_distance is not None:
+                # Precomputed from a nearby shop or entrance; just add the walk to its start
+                distance = approach_distance + existing_route.distance_meters
+                route_data = {
+                    'route_id': str(existing_route.id),
+                    'destination': NavigationService._shop_destination(shop),
+                    'distance_meters': round(distance, 2),
+                    'estimated_time_seconds': int(distance / 1.4),  # Average walking speed
+                    'coordinates': [[start_lon, start_lat]] + (existing_route.route_coordinates or []),
+                    'indoor_coordinates': existing_route.indoor_route_coordinates,
+                    'instructions': existing_route.turn_by_turn_instructions,
+                    'landmarks': existing_route.landmarks_on_route,
+                    'is_indoor_route': existing_route.is_indoor_route,
+                    'is_accessible': existing_route.is_accessible_route
+                }
+            elif existing_route:
                 # Use existing route as base and calculate from start point
                 route_data = {
                     'route_id': str(existing_route.id),
-                    'destination': {
-                        'shop_id': str(shop.id),
-                        'name': shop.name,
-                        'latitude': shop.latitude,
-                        'longitude': shop.longitude,
-                        'shop_number': shop.shop_number,
-                        'floor_level': shop.floor_level
-                    },
+                    'destination': NavigationService._shop_destination(shop),
                     'distance_meters': NavigationService.calculate_distance(
                         start_lat, start_lon, shop.latitude, shop.longitude
                     ),
@@ -167,6 +153,10 @@ class NavigationService:
                     'is_accessible': existing_route.is_accessible_route
                 }
             else:
+                # Route over the market's walkway graph when it has a georeferenced one
+                route_data = NavigationService._calculate_graph_route(start_lat, start_lon, shop, navigation_mode)
+            
+            if not route_data:
                 # Calculate new route
                 distance = NavigationService.calculate_distance(
                     start_lat, start_lon, shop.latitude, shop.longitude
@@ -179,21 +169,14 @@ class NavigationService:
                 ]
                 
                 route_data = {
-                    'destination': {
-                        'shop_id': str(shop.id),
-                        'name': shop.name,
-                        'latitude': shop.latitude,
-                        'longitude': shop.longitude,
-                        'shop_number': shop.shop_number,
-                        'floor_level': shop.floor_level
-                    },
+                    'destination': NavigationService._shop_destination(shop),
                     'distance_meters': round(distance, 2),
                     'estimated_time_seconds': int(distance / 1.4),  # Average walking speed
                     'coordinates': route_coordinates,
                     'instructions': NavigationService._generate_basic_instructions(
                         start_lat, start_lon, shop.latitude, shop.longitude, shop.name
                     ),
-                    'is_indoor_route': NavigationService.is_indoor_location(start_lat, start_lon, str(shop.market.id)),
+                    'is_indoor_route': NavigationService.is_indoor_location(start_lat, start_lon, str(shop.market_id)),
                     'is_accessible': shop.is_accessible
                 }
             
@@ -202,6 +185,110 @@ class NavigationService:
         except Shop.DoesNotExist:
             return {'error': 'Shop not found'}
     
+    @staticmethod
+    def _find_precomputed_route(start_lat: float, start_lon: float, shop: Shop,
+                                navigation_mode: str) -> Tuple[Optional[NavigationRoute], Optional[float]]:
+        """
+        Look up a stored route to the shop in one indexed query. Routes precomputed from the
+        shop or entrance the user is standing at win over a generic route to the shop.
+        Returns (route, distance from the user to the route start); the distance is None for
+        a generic route.
+        """
+        market_id = str(shop.market_id)
+        origin_shop = None
+        origin_zone = None
+        approach = {}
+        
+        nearest = NavigationService.find_nearest_shops(
+            start_lat, start_lon, market_id, limit=2, max_distance_meters=PRECOMPUTED_ROUTE_ORIGIN_METERS
+        )
+        nearest = [entry for entry in nearest if entry['shop'].id != shop.id]
+        if nearest:
+            origin_shop = nearest[0]['shop']
+            approach[('shop', origin_shop.id)] = nearest[0]['distance_meters']
+        else:
+            for zone in GeofenceRegistry.for_market(market_id).entrances:
+                distance = NavigationService.calculate_distance(
+                    start_lat, start_lon, zone.center_latitude, zone.center_longitude
+                )
+                if distance <= max(zone.radius_meters, PRECOMPUTED_ROUTE_ORIGIN_METERS) and (
+                        origin_zone is None or distance < approach[('zone', origin_zone.id)]):
+                    origin_zone = zone
+                    approach[('zone', zone.id)] = distance
+        
+        lookup = Q(start_shop__isnull=True, start_zone__isnull=True,
+                   start_latitude__isnull=True, start_longitude__isnull=True)
+        if origin_shop:
+            lookup |= Q(start_shop=origin_shop)
+        if origin_zone:
+            lookup |= Q(start_zone=origin_zone)
+        
+        routes = NavigationRoute.objects.filter(lookup, end_shop=shop)
+        if navigation_mode == 'accessibility':
+            routes = routes.filter(is_accessible_route=True)
+        
+        generic = None
+        for route in routes:
+            if route.start_shop_id or route.start_zone_id:
+                key = ('shop', route.start_shop_id) if route.start_shop_id else ('zone', route.start_zone_id)
+                return route, approach[key]
+            generic = generic or route
+        return generic, None
+    
+    @staticmethod
+    def _shop_destination(shop: Shop) -> Dict:
+        return {
+            'shop_id': str(shop.id),
+            'name': shop.name,
+            'latitude': shop.latitude,
+            'longitude': shop.longitude,
+            'shop_number': shop.shop_number,
+            'floor_level': shop.floor_level
+        }
+    
+    @staticmethod
+    def _shop_graph_point(graph: RoutingGraph, shop: Shop) -> Tuple[float, float, int]:
+        """Position of a shop in the market graph's local plane"""
+        if shop.indoor_x is not None and shop.indoor_y is not None:
+            return shop.indoor_x, shop.indoor_y, shop.indoor_floor
+        x, y = graph.to_local(shop.latitude, shop.longitude)
+        return x, y, shop.indoor_floor
+    
+    @staticmethod
+    def _calculate_graph_route(start_lat: float, start_lon: float, shop: Shop, navigation_mode: str) -> Optional[Dict]:
+        """Route over the market walkway graph, or None when the market has no usable graph"""
+        graph = RoutingGraphRegistry.for_market(shop.market)
+        if graph is None or not graph.is_georeferenced:
+            return None
+        
+        start_x, start_y = graph.to_local(start_lat, start_lon)
+        route = graph.route(
+            (start_x, start_y, 0),
+            NavigationService._shop_graph_point(graph, shop),
+            accessible_only=navigation_mode == 'accessibility'
+        )
+        if route is None:
+            return None
+        
+        coordinates = []
+        for x, y, _ in route['points']:
+            latitude, longitude = graph.to_geo(x, y)
+            coordinates.append([longitude, latitude])
+        
+        distance = route['distance_meters']
+        return {
+            'destination': NavigationService._shop_destination(shop),
+            'distance_meters': round(distance, 2),
+            'estimated_time_seconds': int(distance / 1.4),  # Average walking speed
+            'coordinates': coordinates,
+            'indoor_coordinates': [
+                {'x': round(x, 2), 'y': round(y, 2), 'floor': floor} for x, y, floor in route['points']
+            ],
+            'instructions': graph.instructions(route, shop.name),
+            'is_indoor_route': NavigationService.is_indoor_location(start_lat, start_lon, str(shop.market_id)),
+            'is_accessible': shop.is_accessible
+        }
+    
     @staticmethod
     def _generate_basic_instructions(start_lat: float, start_lon: float, end_lat: float, end_lon: float, destination_name: str) -> List[Dict]:
         """Generate basic turn-by-turn instructions"""
@@ -258,7 +345,10 @@ class NavigationService:
     
     @staticmethod
     def update_user_location(user_id: str, latitude: float, longitude: float, market_id: str = None, **kwargs) -> UserLocation:
-        """Update user's current location and detect context"""
+        """
+        Update user's current location and detect context. With LOCATION_WRITE_BEHIND_ENABLED
+        the returned UserLocation is not saved yet; the write buffer inserts it shortly after.
+        """
         from users.models import User
         
         try:
@@ -276,10 +366,14 @@ class NavigationService:
             
             if market_id:
                 is_indoor = NavigationService.is_indoor_location(latitude, longitude, market_id)
-                current_zone = NavigationService.detect_user_zone(latitude, longitude, market_id)
+                current_zone = NavigationService.detect_user_zone(
+                    latitude, longitude, market_id, kwargs.get('floor_level')
+                )
                 
                 # Check if user is near any shop
-                nearby_shops = NavigationService.find_nearby_shops(latitude, longitude, market_id, 10)
+                nearby_shops = NavigationService.find_nearest_shops(
+                    latitude, longitude, market_id, limit=1, max_distance_meters=10
+                )
                 if nearby_shops:
                     current_shop = nearby_shops[0]['shop']
             
@@ -307,29 +401,114 @@ class NavigationService:
                 except Market.DoesNotExist:
                     pass
             
-            location = UserLocation.objects.create(**location_data)
+            # Persisted by the write-behind buffer; the row is returned before it is inserted
+            location = UserLocation(**location_data)
+            LocationWriteBuffer.submit([location])
+            NavigationService._record_current_location(location)
             return location
             
         except User.DoesNotExist:
             raise ValueError("User not found")
-    
+
+    @staticmethod
+    def update_user_locations_batch(user_id: str, fixes: List[Dict], market_id: str = None) -> UserLocation:
+        """
+        Store a batch of location fixes in one insert. The market's cached boundary, zone and
+        shop indexes are resolved once and every fix is classified against them in memory.
+        Returns the latest fix with its derived context, unsaved while the write buffer holds it.
+        """
+        if not fixes:
+            raise ValueError("No locations provided")
+
+        now = timezone.now()
+        fixes = sorted(fixes, key=lambda fix: fix.get('timestamp') or now)
+        latest = fixes[-1]
+
+        # Detect market if not provided
+        if not market_id:
+            market = NavigationService._detect_nearest_market(latest['latitude'], latest['longitude'])
+            market_id = str(market.id) if market else None
+        elif not Market.objects.filter(id=market_id).exists():
+            market_id = None
+
+        boundary = zone_index = shop_index = None
+        if market_id:
+            boundary = MarketBoundaryCache.for_market(market_id)
+            zone_index = GeofenceRegistry.for_market(market_id)
+            shop_index = ShopIndexRegistry.for_market(market_id)
+
+        locations = []
+        for fix in fixes:
+            latitude = fix['latitude']
+            longitude = fix['longitude']
+            current_zone = None
+            current_shop = None
+
+            if market_id:
+                zones = zone_index.zones_at(latitude, longitude, fix.get('floor_level'))
+                current_zone = zones[0] if zones else None
+                nearby_shops = shop_index.nearest(latitude, longitude, k=1, max_distance_meters=10)
+                current_shop = nearby_shops[0][1] if nearby_shops else None
+
+            locations.append(UserLocation(
+                user_id=user_id,
+                market_id=market_id,
+                latitude=latitude,
+                longitude=longitude,
+                altitude=fix.get('altitude'),
+                accuracy_meters=fix.get('accuracy_meters'),
+                indoor_x=fix.get('indoor_x'),
+                indoor_y=fix.get('indoor_y'),
+                floor_level=fix.get('floor_level'),
+                is_indoor=boundary.contains(latitude, longitude) if boundary else False,
+                current_shop=current_shop,
+                current_zone=current_zone,
+                battery_level=fix.get('battery_level'),
+                signal_strength=fix.get('signal_strength'),
+                timestamp=fix.get('timestamp') or now
+            ))
+
+        LocationWriteBuffer.submit(locations)
+        NavigationService._record_current_location(locations[-1])
+        return locations[-1]
+
+    @staticmethod
+    def _record_current_location(location: UserLocation) -> None:
+        """Store the user's latest position, unless a newer fix is already stored"""
+        values = {
+            CurrentUserLocation._meta.get_field(field).attname: getattr(
+                location, UserLocation._meta.get_field(field).attname
+            )
+            for field in CURRENT_LOCATION_FIELDS
+        }
+        # Batches can arrive late or out of order; an older fix never replaces a newer one
+        newer_or_same = CurrentUserLocation.objects.filter(user_id=location.user_id, timestamp__lte=location.timestamp)
+        if newer_or_same.update(**values):
+            return
+        CurrentUserLocation.objects.bulk_create(
+            [CurrentUserLocation(user_id=location.user_id, **values)], ignore_conflicts=True
+        )
+        # A concurrent first fix may have inserted the row instead; apply ours if it is newer
+        newer_or_same.update(**values)
+
+    @staticmethod
+    def get_current_location(user_id: str) -> Optional[CurrentUserLocation]:
+        """A user's latest known position without scanning their location history"""
+        return CurrentUserLocation.objects.select_related(
+            'market', 'current_shop', 'current_zone'
+        ).filter(user_id=user_id).first()
+
     @staticmethod
     def _detect_nearest_market(latitude: float, longitude: float, max_distance_km: float = 5.0) -> Optional[Market]:
         """Detect the nearest market to given coordinates"""
-        markets = Market.objects.all()
-        nearest_market = None
-        min_distance = float('inf')
+        max_distance_meters = max_distance_km * 1000
+        candidates = list(Market.objects.within_bounding_box(latitude, longitude, max_distance_meters))
         
-        for market in markets:
-            distance = NavigationService.calculate_distance(
-                latitude, longitude, market.latitude, market.longitude
-            )
-            
-            if distance < min_distance and distance <= (max_distance_km * 1000):
-                min_distance = distance
-                nearest_market = market
+        index, distance = CoordinateArray.from_objects(candidates).nearest(latitude, longitude)
+        if index is None or distance > max_distance_meters:
+            return None
         
-        return nearest_market
+        return candidates[index]
 
 
 class ExternalNavigationService:
@@ -381,7 +560,8 @@ class IndoorNavigationService:
     """Service for indoor navigation within markets"""
     
     @staticmethod
-    def calculate_indoor_route(start_x: float, start_y: float, end_x: float, end_y: float, floor: int, market_id: str) -> Dict:
+    def calculate_indoor_route(start_x: float, start_y: float, end_x: float, end_y: float, floor: int, market_id: str,
+                               end_floor: Optional[int] = None, accessible_only: bool = False) -> Dict:
         """Calculate route for indoor navigation using indoor coordinates"""
         try:
             market = Market.objects.get(id=market_id)
@@ -389,6 +569,26 @@ class IndoorNavigationService:
             if not market.indoor_map_enabled:
                 return {'error': 'Indoor navigation not available for this market'}
             
+            if end_floor is None:
+                end_floor = floor
+            
+            graph = RoutingGraphRegistry.for_market(market)
+            route = graph.route((start_x, start_y, floor), (end_x, end_y, end_floor), accessible_only) if graph else None
+            
+            if route is not None:
+                distance = route['distance_meters']
+                return {
+                    'route_points': [{'x': x, 'y': y, 'floor': point_floor} for x, y, point_floor in route['points']],
+                    'distance_meters': round(distance, 2),
+                    'estimated_time_seconds': int(distance / 1.0),  # Slower indoor walking speed
+                    'floor': floor,
+                    'end_floor': end_floor,
+                    'instructions': graph.instructions(route)
+                }
+            
+            if end_floor != floor:
+                return {'error': 'No indoor route found between these floors'}
+            
             # Simple direct indoor route
             route_points = [
                 {'x': start_x, 'y': start_y, 'floor': floor},
@@ -0,0 +1,226 @@
+"""
+Precomputation of shop-to-shop and entrance-to-shop routes into NavigationRoute
+"""
+import logging
+import queue
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+
+from .models import GeofenceZone, Market, NavigationRoute, Shop
+from .routing_engine import RoutingGraph, RoutingGraphRegistry, INACCESSIBLE_KINDS
+
+logger = logging.getLogger(__name__)
+
+WALKING_SPEED_MPS = 1.4
+BULK_CREATE_BATCH_SIZE = 500
+
+
+class RoutePrecomputer:
+    """Many-to-many Dijkstra over a market's walkway graph, one tree per route source"""
+
+    def __init__(self, market: Market):
+        self.market = market
+        self.graph: Optional[RoutingGraph] = RoutingGraphRegistry.for_market(market)
+        self.shops: List[Shop] = []
+        self.entrances: List[GeofenceZone] = []
+        self.snaps: Dict[Tuple[str, str], Dict] = {}
+
+        if self.graph is not None:
+            self.shops = list(Shop.objects.filter(market=market, is_active=True))
+            self.entrances = list(GeofenceZone.objects.filter(market=market, zone_type='entrance'))
+            for shop in self.shops:
+                self._snap('shop', shop)
+            for zone in self.entrances:
+                self._snap('zone', zone)
+
+    @property
+    def enabled(self) -> bool:
+        return self.graph is not None
+
+    def _point(self, kind: str, obj) -> Optional[Tuple[float, float, int]]:
+        if kind == 'shop':
+            if obj.indoor_x is not None and obj.indoor_y is not None:
+                return obj.indoor_x, obj.indoor_y, obj.indoor_floor
+            if not self.graph.is_georeferenced:
+                return None
+            x, y = self.graph.to_local(obj.latitude, obj.longitude)
+            return x, y, obj.indoor_floor
+
+        if not self.graph.is_georeferenced:
+            return None
+        x, y = self.graph.to_local(obj.center_latitude, obj.center_longitude)
+        return x, y, obj.floor_level
+
+    def _snap(self, kind: str, obj) -> Optional[Dict]:
+        key = (kind, str(obj.id))
+        if key not in self.snaps:
+            point = self._point(kind, obj)
+            snap = self.graph.snap(*point) if point else None
+            self.snaps[key] = {'point': point, 'snap': snap} if snap else None
+        return self.snaps[key]
+
+    def _generated_routes(self):
+        """Routes this precomputer stored for the market; hand-authored ones have no start shop or zone"""
+        return NavigationRoute.objects.filter(market=self.market).filter(
+            Q(start_shop__isnull=False) | Q(start_zone__isnull=False)
+        )
+
+    def rebuild_market(self) -> int:
+        """Replace every precomputed route in the market; returns the number stored"""
+        if not self.enabled:
+            return 0
+
+        sources = [('shop', shop) for shop in self.shops] + [('zone', zone) for zone in self.entrances]
+        with transaction.atomic():
+            self._generated_routes().delete()
+
+            pending = []
+            created = 0
+            for kind, source in sources:
+                pending.extend(self._routes_from(kind, source))
+                if len(pending) >= BULK_CREATE_BATCH_SIZE:
+                    NavigationRoute.objects.bulk_create(pending, batch_size=BULK_CREATE_BATCH_SIZE)
+                    created += len(pending)
+                    pending = []
+            NavigationRoute.objects.bulk_create(pending, batch_size=BULK_CREATE_BATCH_SIZE)
+            created += len(pending)
+        return created
+
+    def refresh_shop(self, shop_id: str) -> int:
+        """Recompute only the routes that start or end at one shop"""
+        if not self.enabled:
+            return 0
+
+        shop = next((candidate for candidate in self.shops if str(candidate.id) == str(shop_id)), None)
+        with transaction.atomic():
+            self._generated_routes().filter(Q(start_shop_id=shop_id) | Q(end_shop_id=shop_id)).delete()
+            if shop is None:
+                # Deactivated or moved to another market
+                return 0
+
+            routes = self._routes_from('shop', shop)
+            routes.extend(self._routes_to(shop))
+            NavigationRoute.objects.bulk_create(routes, batch_size=BULK_CREATE_BATCH_SIZE)
+        return len(routes)
+
+    def _routes_from(self, kind: str, source) -> List[NavigationRoute]:
+        """One forward tree from the source answers every shop destination"""
+        origin = self._snap(kind, source)
+        if origin is None:
+            return []
+
+        best, links = self.graph.dijkstra(origin['snap'])
+        routes = []
+        for shop in self.shops:
+            if kind == 'shop' and shop.id == source.id:
+                continue
+            destination = self._snap('shop', shop)
+            if destination is None:
+                continue
+            path = self.graph.path_from_tree(origin['snap'], destination['snap'], best, links)
+            if path is not None:
+                routes.append(self._build(kind, source, shop, origin, destination, path))
+        return routes
+
+    def _routes_to(self, shop: Shop) -> List[NavigationRoute]:
+        """One reverse tree from the shop answers every source that can reach it"""
+        destination = self._snap('shop', shop)
+        if destination is None:
+            return []
+
+        best, links = self.graph.dijkstra(destination['snap'], reverse=True)
+        routes = []
+        sources = [('shop', other) for other in self.shops if other.id != shop.id]
+        sources += [('zone', zone) for zone in self.entrances]
+        for kind, source in sources:
+            origin = self._snap(kind, source)
+            if origin is None:
+                continue
+            path = self.graph.path_from_tree(origin['snap'], destination['snap'], best, links, reverse=True)
+            if path is not None:
+                routes.append(self._build(kind, source, shop, origin, destination, path))
+        return routes
+
+    def _build(self, kind: str, source, shop: Shop, origin: Dict, destination: Dict, path) -> NavigationRoute:
+        _, nodes, edges = path
+        graph = self.graph
+        route = graph.build_route(origin['point'], destination['point'], origin['snap'], destination['snap'], nodes, edges)
+
+        coordinates = []
+        if graph.is_georeferenced:
+            for x, y, _ in route['points']:
+                latitude, longitude = graph.to_geo(x, y)
+                coordinates.append([longitude, latitude])
+
+        distance = route['distance_meters']
+        return NavigationRoute(
+            market=self.market,
+            start_shop=source if kind == 'shop' else None,
+            start_zone=source if kind == 'zone' else None,
+            end_shop=shop,
+            route_coordinates=coordinates,
+            indoor_route_coordinates=[
+                {'x': round(x, 2), 'y': round(y, 2), 'floor': floor} for x, y, floor in route['points']
+            ],
+            distance_meters=round(distance, 2),
+            estimated_walk_time_seconds=int(distance / WALKING_SPEED_MPS),
+            is_indoor_route=True,
+            is_accessible_route=not any(leg['kind'] in INACCESSIBLE_KINDS for leg in route['legs']),
+            turn_by_turn_instructions=graph.instructions(route, shop.name),
+        )
+
+
+class RouteRefreshWorker:
+    """Single background thread that applies incremental route refreshes off the request path"""
+
+    # (market id, shop id), or (market id, None) to rebuild the whole market
+    _queue: 'queue.Queue[Tuple[str, Optional[str]]]' = queue.Queue()
+    _pending = set()
+    _lock = threading.Lock()
+    _thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def schedule_shop_refresh(cls, market_id: str, shop_id: str) -> None:
+        cls._schedule((str(market_id), str(shop_id)))
+
+    @classmethod
+    def schedule_market_rebuild(cls, market_id: str) -> None:
+        """Recompute every route of the market, e.g. after its walkway graph or entrances change"""
+        cls._schedule((str(market_id), None))
+
+    @classmethod
+    def _schedule(cls, job: Tuple[str, Optional[str]]) -> None:
+        with cls._lock:
+            # Several saves of the same shop or market collapse into one refresh
+            if job in cls._pending:
+                return
+            cls._pending.add(job)
+            if cls._thread is None or not cls._thread.is_alive():
+                cls._thread = threading.Thread(target=cls._run, name='route-refresh', daemon=True)
+                cls._thread.start()
+        cls._queue.put(job)
+
+    @classmethod
+    def _run(cls) -> None:
+        while True:
+            job = cls._queue.get()
+            with cls._lock:
+                cls._pending.discard(job)
+            market_id, shop_id = job
+            close_old_connections()
+            try:
+                market = Market.objects.get(id=market_id)
+                if shop_id is None:
+                    RoutePrecomputer(market).rebuild_market()
+                else:
+                    RoutePrecomputer(market).refresh_shop(shop_id)
+            except Market.DoesNotExist:
+                pass
+            except Exception:
+                logger.exception("Failed to refresh precomputed routes for market %s (shop %s)", market_id, shop_id)
+            finally:
+                close_old_connections()
+                cls._queue.task_done()
@@ -0,0 +1,199 @@
+"""
+Progress of a user along a navigation session's route
+"""
+import math
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from .distance_engine import METERS_PER_DEGREE_LAT, haversine_meters
+
+WALKING_SPEED_MPS = 1.4
+
+# Further than this from the matched route position counts as having left the route
+OFF_ROUTE_METERS = 25.0
+
+# Consecutive far fixes needed before reporting off-route, so one noisy GPS fix does not reroute
+OFF_ROUTE_CONFIRMATIONS = 2
+
+# Within this distance of the destination counts as arrived
+ARRIVAL_METERS = 10.0
+
+# How far along the route beyond the last match each fix is searched
+LOOKAHEAD_METERS = 75.0
+
+# Trackers kept per process for sessions updated over HTTP
+TRACKER_CACHE_SIZE = 1024
+
+
+class RouteProgressTracker:
+    """
+    Matches position fixes to a [[longitude, latitude], ...] route polyline.
+    Cumulative segment lengths are computed once; each fix is snapped by searching forward
+    from the previous match, so steady walking costs O(1) per fix. A full scan only runs
+    when the local search finds nothing close, e.g. after a detour.
+    """
+
+    def __init__(self, route_coordinates: Optional[List], destination: Optional[Tuple[float, float]] = None,
+                 instructions: Optional[List[Dict]] = None):
+        # Route coordinates are GeoJSON ordered; keep (latitude, longitude) internally
+        points = [(float(point[1]), float(point[0])) for point in (route_coordinates or [])]
+        if destination is None and points:
+            destination = points[-1]
+        self.destination = destination
+        self.points = points
+
+        if points:
+            self.origin_lat, self.origin_lon = points[0]
+        elif destination is not None:
+            self.origin_lat, self.origin_lon = destination
+        else:
+            self.origin_lat = self.origin_lon = 0.0
+        self.lon_scale = METERS_PER_DEGREE_LAT * math.cos(math.radians(self.origin_lat))
+
+        self.xs = []
+        self.ys = []
+        for latitude, longitude in points:
+            x, y = self._project(latitude, longitude)
+            self.xs.append(x)
+            self.ys.append(y)
+
+        self.cumulative = [0.0]
+        for i in range(1, len(points)):
+            self.cumulative.append(
+                self.cumulative[-1] + math.hypot(self.xs[i] - self.xs[i - 1], self.ys[i] - self.ys[i - 1])
+            )
+        self.total_length = self.cumulative[-1]
+
+        # Route distance at which each instruction step starts
+        self.step_offsets = self._step_offsets(instructions)
+
+        self.segment_index = 0
+        self.far_fixes = 0
+        self.off_route = False
+
+    @classmethod
+    def for_session(cls, session) -> 'RouteProgressTracker':
+        """Tracker for a NavigationSession's route, with step offsets from its selected route"""
+        destination = None
+        if session.destination_latitude is not None and session.destination_longitude is not None:
+            destination = (session.destination_latitude, session.destination_longitude)
+        instructions = session.selected_route.turn_by_turn_instructions if session.selected_route_id else None
+        return cls(session.route_coordinates, destination, instructions)
+
+    def _project(self, latitude: float, longitude: float) -> Tuple[float, float]:
+        """Equirectangular (x, y) meters around the route start; accurate enough at market scale"""
+        return ((longitude - self.origin_lon) * self.lon_scale,
+                (latitude - self.origin_lat) * METERS_PER_DEGREE_LAT)
+
+    def _step_offsets(self, instructions: Optional[List[Dict]]) -> List[float]:
+        offsets = []
+        if not instructions or len(self.points) < 2:
+            return offsets
+
+        segment = 0
+        for step in instructions:
+            coordinates = step.get('coordinates') if isinstance(step, dict) else None
+            if not coordinates or len(coordinates) < 2:
+                return []
+            x, y = self._project(float(coordinates[1]), float(coordinates[0]))
+            # Steps are in route order, so each one is matched at or after the previous
+            segment, along, _ = self._match(x, y, segment, len(self.points) - 1)
+            offsets.append(along)
+        return offsets
+
+    def _match(self, x: float, y: float, first: int, last: int) -> Tuple[int, float, float]:
+        """Closest point on segments first..last-1 as (segment index, route distance, offset)"""
+        best = (first, self.cumulative[first], float('inf'))
+        for i in range(first, last):
+            ax, ay = self.xs[i], self.ys[i]
+            dx = self.xs[i + 1] - ax
+            dy = self.ys[i + 1] - ay
+            length_sq = dx * dx + dy * dy
+            t = 0.0 if not length_sq else max(0.0, min(1.0, ((x - ax) * dx + (y - ay) * dy) / length_sq))
+            distance = math.hypot(ax + t * dx - x, ay + t * dy - y)
+            if distance < best[2]:
+                best = (i, self.cumulative[i] + t * math.sqrt(length_sq), distance)
+        return best
+
+    def _search_window(self) -> int:
+        """Last segment end worth checking ahead of the previous match"""
+        limit = self.cumulative[self.segment_index + 1] + LOOKAHEAD_METERS
+        end = bisect_right(self.cumulative, limit, lo=self.segment_index + 1)
+        return min(max(end, self.segment_index + 2), len(self.points) - 1)
+
+    def update(self, latitude: float, longitude: float) -> Dict:
+        """Progress for a new fix: remaining distance, ETA, step index and route deviation"""
+        if len(self.points) < 2:
+            remaining = haversine_meters(latitude, longitude, *self.destination) if self.destination else 0.0
+            return self._progress(latitude, longitude, remaining, 0, 0.0)
+
+        x, y = self._project(latitude, longitude)
+        # A step back covers fixes that jitter behind the previous match
+        first = max(self.segment_index - 1, 0)
+        segment, along, distance = self._match(x, y, first, self._search_window())
+        if distance > OFF_ROUTE_METERS:
+            segment, along, distance = self._match(x, y, 0, len(self.points) - 1)
+
+        if distance > OFF_ROUTE_METERS:
+            self.far_fixes += 1
+        else:
+            self.far_fixes = 0
+            self.segment_index = segment
+        self.off_route = self.far_fixes >= OFF_ROUTE_CONFIRMATIONS
+
+        # Off the route, count the walk back to the closest route point
+        remaining = self.total_length - along + (distance if self.far_fixes else 0.0)
+
+        step_index = bisect_right(self.step_offsets, along) - 1 if self.step_offsets else segment
+        return self._progress(latitude, longitude, remaining, max(step_index, 0), distance)
+
+    def _progress(self, latitude: float, longitude: float, remaining: float, step_index: int,
+                  distance_from_route: float) -> Dict:
+        arrived = self.destination is not None and (
+            remaining <= ARRIVAL_METERS or haversine_meters(latitude, longitude, *self.destination) <= ARRIVAL_METERS
+        )
+        return {
+            'distance_remaining_meters': round(remaining, 2),
+            'estimated_time_remaining_seconds': int(remaining / WALKING_SPEED_MPS),
+            'current_step_index': step_index,
+            'distance_from_route_meters': round(distance_from_route, 2),
+            'off_route': self.off_route,
+            'arrived': arrived,
+        }
+
+
+class RouteProgressRegistry:
+    """Process-local LRU of trackers for sessions whose fixes arrive over HTTP"""
+
+    _trackers: 'OrderedDict[str, Tuple[tuple, RouteProgressTracker]]' = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def for_session(cls, session) -> RouteProgressTracker:
+        route = session.route_coordinates or []
+        # Cheap fingerprint; rerouting replaces the coordinates and so the tracker
+        key = (len(route), tuple(route[0]) if route else None, tuple(route[-1]) if route else None,
+               session.destination_latitude, session.destination_longitude, session.selected_route_id)
+        session_id = str(session.id)
+
+        with cls._lock:
+            cached = cls._trackers.get(session_id)
+            if cached and cached[0] == key:
+                cls._trackers.move_to_end(session_id)
+                return cached[1]
+
+        tracker = RouteProgressTracker.for_session(session)
+        with cls._lock:
+            cls._trackers[session_id] = (key, tracker)
+            cls._trackers.move_to_end(session_id)
+            while len(cls._trackers) > TRACKER_CACHE_SIZE:
+                cls._trackers.popitem(last=False)
+        return tracker
+
+    @classmethod
+    def discard(cls, session_id: str) -> None:
+        with cls._lock:
+            cls._trackers.pop(str(session_id), None)
+
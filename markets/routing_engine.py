@@ -0,0 +1,649 @@
+"""
+Walkway graph routing for markets
+
+Market.map_data describes the walkable network in local meters, the same plane as
+Shop.indoor_x / Shop.indoor_y / Shop.indoor_floor:
+
+    {
+        "origin": {"latitude": 6.4525, "longitude": 3.3950},   # optional georeference
+        "walkways": [
+            {"id": "aisle-a", "name": "Aisle A", "type": "aisle", "floor": 0,
+             "points": [[0, 0], [0, 40], [25, 40]]}
+        ],
+        "connectors": [
+            {"id": "stairs-1", "type": "stairs",
+             "from": {"x": 25, "y": 40, "floor": 0}, "to": {"x": 25, "y": 44, "floor": 1},
+             "length_meters": 12}
+        ]
+    }
+
+Walkways that share a vertex are joined. With an origin, x points east and y points north,
+which lets outdoor latitude/longitude requests be routed over the same graph.
+"""
+import hashlib
+import heapq
+import json
+import math
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from .cache_versions import get_version, bump_version
+from .distance_engine import METERS_PER_DEGREE_LAT
+
+VERSION_NAMESPACE = 'routing_graph'
+# Compiled graphs kept per process; least recently used markets are evicted first
+ROUTING_GRAPH_CACHE_SIZE = 128
+
+EDGE_KINDS = ('walkway', 'aisle', 'stairs', 'escalator', 'elevator', 'ramp')
+FLOOR_CHANGE_KINDS = {'stairs', 'escalator', 'elevator', 'ramp'}
+INACCESSIBLE_KINDS = {'stairs', 'escalator'}
+
+DEFAULT_FLOOR_HEIGHT_METERS = 4.0
+# Vertices closer than this are treated as the same junction
+SNAP_PRECISION = 2  # decimal places of a meter
+
+STRAIGHT_TOLERANCE_DEGREES = 30
+SLIGHT_TURN_DEGREES = 60
+SHARP_TURN_DEGREES = 135
+SEGMENT_CELL_METERS = 10.0
+# Rings of cells searched around a point before falling back to scanning every occupied cell
+MAX_SNAP_RINGS = 8
+# Points further than this from every walkway are not routed over the graph
+MAX_SNAP_METERS = 200.0
+# Legs shorter than this (e.g. stepping onto a walkway) are folded into the next step
+MIN_INSTRUCTION_METERS = 3.0
+
+
+class RoutingGraph:
+    """Compact adjacency (CSR) graph of walkway vertices compiled from Market.map_data"""
+
+    def __init__(self, node_x: array, node_y: array, node_floor: array, offsets: array,
+                 targets: array, weights: array, kinds: array, edge_names: List[Optional[str]],
+                 origin: Optional[Tuple[float, float]] = None):
+        self.node_x = node_x
+        self.node_y = node_y
+        self.node_floor = node_floor
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+        self.kinds = kinds
+        self.edge_names = edge_names
+        self.origin = origin
+
+        self._reverse = None
+        self._index_segments()
+
+    def __len__(self) -> int:
+        return len(self.node_x)
+
+    @property
+    def is_georeferenced(self) -> bool:
+        return self.origin is not None
+
+    @classmethod
+    def compile(cls, map_data) -> Optional['RoutingGraph']:
+        """Build a graph from map_data, or return None when it has no walkways"""
+        if not isinstance(map_data, dict) or not map_data.get('walkways'):
+            return None
+
+        node_ids: Dict[Tuple[int, float, float], int] = {}
+        node_x = array('d')
+        node_y = array('d')
+        node_floor = array('i')
+        adjacency: List[List[Tuple[int, float, int, int]]] = []
+        edge_names: List[Optional[str]] = []
+
+        def node_for(x, y, floor):
+            key = (int(floor), round(float(x), SNAP_PRECISION), round(float(y), SNAP_PRECISION))
+            node = node_ids.get(key)
+            if node is None:
+                node = len(node_x)
+                node_ids[key] = node
+                node_x.append(key[1])
+                node_y.append(key[2])
+                node_floor.append(key[0])
+                adjacency.append([])
+            return node
+
+        def add_edge(a, b, weight, kind, name, bidirectional=True):
+            if a == b:
+                return
+            kind_index = EDGE_KINDS.index(kind) if kind in EDGE_KINDS else 0
+            edge_names.append(name)
+            name_index = len(edge_names) - 1
+            adjacency[a].append((b, weight, kind_index, name_index))
+            if bidirectional:
+                adjacency[b].append((a, weight, kind_index, name_index))
+
+        for walkway in map_data.get('walkways', []):
+            points = walkway.get('points') or []
+            floor = int(walkway.get('floor', 0))
+            kind = walkway.get('type', 'walkway')
+            name = walkway.get('name') or walkway.get('id')
+            bidirectional = not walkway.get('one_way', False)
+
+            previous = None
+            for point in points:
+                node = node_for(point[0], point[1], floor)
+                if previous is not None:
+                    length = math.hypot(node_x[node] - node_x[previous], node_y[node] - node_y[previous])
+                    add_edge(previous, node, length, kind, name, bidirectional)
+                previous = node
+
+        for connector in map_data.get('connectors', []):
+            start = connector.get('from')
+            end = connector.get('to')
+            if not start or not end:
+                continue
+            a = node_for(start['x'], start['y'], start.get('floor', 0))
+            b = node_for(end['x'], end['y'], end.get('floor', 0))
+            planar = math.hypot(node_x[b] - node_x[a], node_y[b] - node_y[a])
+            climb = abs(node_floor[b] - node_floor[a]) * DEFAULT_FLOOR_HEIGHT_METERS
+            # Weights never drop below the planar distance so the A* heuristic stays admissible
+            weight = max(float(connector.get('length_meters') or 0), planar, math.hypot(planar, climb))
+            add_edge(a, b, weight, connector.get('type', 'stairs'), connector.get('name') or connector.get('id'),
+                     not connector.get('one_way', False))
+
+        if not len(node_x):
+            return None
+
+        offsets = array('i', [0])
+        targets = array('i')
+        weights = array('d')
+        kinds = array('b')
+        names = array('i')
+        for edges in adjacency:
+            for target, weight, kind_index, name_index in edges:
+                targets.append(target)
+                weights.append(weight)
+                kinds.append(kind_index)
+                names.append(name_index)
+            offsets.append(len(targets))
+
+        origin = map_data.get('origin')
+        origin = (float(origin['latitude']), float(origin['longitude'])) if origin else None
+
+        return cls(node_x, node_y, node_floor, offsets, targets, weights, kinds,
+                   [edge_names[i] for i in names], origin)
+
+    # Coordinate conversion -------------------------------------------------
+
+    def to_local(self, latitude: float, longitude: float) -> Tuple[float, float]:
+        """Project latitude/longitude into the graph's local meter plane"""
+        origin_lat, origin_lon = self.origin
+        x = (longitude - origin_lon) * METERS_PER_DEGREE_LAT * math.cos(math.radians(origin_lat))
+        y = (latitude - origin_lat) * METERS_PER_DEGREE_LAT
+        return x, y
+
+    def to_geo(self, x: float, y: float) -> Tuple[float, float]:
+        """Inverse of to_local, returning (latitude, longitude)"""
+        origin_lat, origin_lon = self.origin
+        latitude = origin_lat + y / METERS_PER_DEGREE_LAT
+        longitude = origin_lon + x / (METERS_PER_DEGREE_LAT * math.cos(math.radians(origin_lat)))
+        return latitude, longitude
+
+    # Search ----------------------------------------------------------------
+
+    def _index_segments(self) -> None:
+        """Bucket every walkway segment by floor and grid cell so snapping stays local"""
+        self._segment_cells: Dict[int, Dict[Tuple[int, int], List[Tuple[int, int, int]]]] = {}
+        for node in range(len(self)):
+            floor = self.node_floor[node]
+            for edge in range(self.offsets[node], self.offsets[node + 1]):
+                other = self.targets[edge]
+                # Each two-way segment is stored twice; floor changes are never snap targets
+                if self.node_floor[other] != floor or (other < node and self._has_edge(other, node)):
+                    continue
+                cells = self._segment_cells.setdefault(floor, {})
+                min_col, max_col = sorted((self._cell(self.node_x[node]), self._cell(self.node_x[other])))
+                min_row, max_row = sorted((self._cell(self.node_y[node]), self._cell(self.node_y[other])))
+                for row in range(min_row, max_row + 1):
+                    for col in range(min_col, max_col + 1):
+                        cells.setdefault((row, col), []).append((edge, node, other))
+
+    @staticmethod
+    def _cell(value: float) -> int:
+        return int(math.floor(value / SEGMENT_CELL_METERS))
+
+    def _has_edge(self, source: int, target: int) -> bool:
+        return any(self.targets[edge] == target for edge in range(self.offsets[source], self.offsets[source + 1]))
+
+    def snap(self, x: float, y: float, floor: int, max_offset: float = MAX_SNAP_METERS) -> Optional[Dict]:
+        """
+        Project a point onto the closest walkway segment on its floor (the nearest floor with
+        walkways as a fallback). Returns the projected point, the segment's edge index and the
+        distance along the segment to each end vertex, or None when the point is not finite or
+        is more than max_offset meters from every walkway.
+        """
+        if not self._segment_cells or not (math.isfinite(x) and math.isfinite(y)):
+            return None
+        if floor not in self._segment_cells:
+            floor = min(self._segment_cells, key=lambda candidate: abs(candidate - floor))
+        cells = self._segment_cells[floor]
+
+        row, col = self._cell(y), self._cell(x)
+        max_ring = max(max(abs(r - row), abs(c - col)) for r, c in cells)
+        best = None
+        seen = set()
+        found = False
+        for ring in range(min(max_ring, MAX_SNAP_RINGS) + 1):
+            # Segments first found in this ring are at least (ring - 1) cells away
+            if best is not None and (ring - 1) * SEGMENT_CELL_METERS > best['offset']:
+                found = True
+                break
+            for cell in self._ring_cells(row, col, ring):
+                best = self._closest(x, y, floor, cells.get(cell, ()), seen, best)
+        else:
+            found = max_ring <= MAX_SNAP_RINGS
+
+        if not found:
+            # Far from the walkways the rings are mostly empty; checking every segment is cheaper
+            for segments in cells.values():
+                best = self._closest(x, y, floor, segments, seen, best)
+        if best is None or best['offset'] > max_offset:
+            return None
+        return best
+
+    def _closest(self, x: float, y: float, floor: int, segments, seen: set, best: Optional[Dict]) -> Optional[Dict]:
+        """The nearer of best and the projection onto any not yet seen segment"""
+        for edge, a, b in segments:
+            if edge in seen:
+                continue
+            seen.add(edge)
+            ax, ay = self.node_x[a], self.node_y[a]
+            dx, dy = self.node_x[b] - ax, self.node_y[b] - ay
+            length_squared = dx * dx + dy * dy
+            t = 0.0 if not length_squared else max(0.0, min(1.0, ((x - ax) * dx + (y - ay) * dy) / length_squared))
+            px, py = ax + t * dx, ay + t * dy
+            distance = math.hypot(x - px, y - py)
+            if best is None or distance < best['offset']:
+                segment = math.sqrt(length_squared)
+                best = {
+                    'point': (px, py, floor),
+                    'offset': distance,
+                    'edge': edge,
+                    'links': ((a, t * segment), (b, (1 - t) * segment)),
+                }
+        return best
+
+    @staticmethod
+    def _ring_cells(row: int, col: int, ring: int):
+        if ring == 0:
+            yield row, col
+            return
+        for c in range(col - ring, col + ring + 1):
+            yield row - ring, c
+            yield row + ring, c
+        for r in range(row - ring + 1, row + ring):
+            yield r, col - ring
+            yield r, col + ring
+
+    def shortest_path(self, start_snap: Dict, end_snap: Dict,
+                      accessible_only: bool = False) -> Optional[Tuple[float, List[int], List[int]]]:
+        """
+        A* search between two snapped points, returning (distance, nodes, edge indexes)
+        or None when unreachable. An empty node list means both points share a segment.
+        """
+        node_x, node_y = self.node_x, self.node_y
+        offsets, targets, weights, kinds = self.offsets, self.targets, self.weights, self.kinds
+        blocked = {EDGE_KINDS.index(kind) for kind in INACCESSIBLE_KINDS} if accessible_only else set()
+        goal_x, goal_y, _ = end_snap['point']
+        goal_links = dict(end_snap['links'])
+        goal = -1
+
+        best: Dict[int, float] = {}
+        came_from: Dict[int, Tuple[Optional[int], Optional[int]]] = {}
+        heap = []
+        for node, distance in start_snap['links']:
+            if distance < best.get(node, float('inf')):
+                best[node] = distance
+                came_from[node] = (None, None)
+                heapq.heappush(heap, (distance + math.hypot(node_x[node] - goal_x, node_y[node] - goal_y), distance, node))
+
+        # Both points on one segment: walking straight along it is always a candidate
+        start_nodes = {node for node, _ in start_snap['links']}
+        if start_nodes == set(goal_links):
+            sx, sy, _ = start_snap['point']
+            best[goal] = math.hypot(sx - goal_x, sy - goal_y)
+            came_from[goal] = (None, None)
+            heapq.heappush(heap, (best[goal], best[goal], goal))
+
+        closed = set()
+        while heap:
+            _, cost, node = heapq.heappop(heap)
+            if node == goal:
+                break
+            if node in closed:
+                continue
+            closed.add(node)
+
+            if node in goal_links:
+                total = cost + goal_links[node]
+                if total < best.get(goal, float('inf')):
+                    best[goal] = total
+                    came_from[goal] = (node, None)
+                    heapq.heappush(heap, (total, total, goal))
+
+            for edge in range(offsets[node], offsets[node + 1]):
+                if kinds[edge] in blocked:
+                    continue
+                neighbour = targets[edge]
+                new_cost = cost + weights[edge]
+                if new_cost < best.get(neighbour, float('inf')):
+                    best[neighbour] = new_cost
+                    came_from[neighbour] = (node, edge)
+                    estimate = new_cost + math.hypot(node_x[neighbour] - goal_x, node_y[neighbour] - goal_y)
+                    heapq.heappush(heap, (estimate, new_cost, neighbour))
+        else:
+            return None
+
+        nodes, edges = self.unwind(came_from, came_from[goal][0])
+        return best[goal], nodes, edges
+
+    def _reverse_adjacency(self) -> Tuple[array, array, array]:
+        """Incoming-edge CSR arrays (offsets, source vertices, forward edge indexes), built on first use"""
+        if self._reverse is None:
+            incoming: List[List[Tuple[int, int]]] = [[] for _ in range(len(self))]
+            for node in range(len(self)):
+                for edge in range(self.offsets[node], self.offsets[node + 1]):
+                    incoming[self.targets[edge]].append((node, edge))
+            offsets = array('i', [0])
+            sources = array('i')
+            edges = array('i')
+            for entries in incoming:
+                for source, edge in entries:
+                    sources.append(source)
+                    edges.append(edge)
+                offsets.append(len(sources))
+            self._reverse = (offsets, sources, edges)
+        return self._reverse
+
+    def dijkstra(self, snap: Dict, accessible_only: bool = False,
+                 reverse: bool = False) -> Tuple[Dict[int, float], Dict[int, Tuple[Optional[int], Optional[int]]]]:
+        """
+        Shortest distances from a snapped point to every reachable vertex, or from every
+        vertex to it when reverse=True. Returns (distances, links) where links maps a vertex
+        to (previous vertex, edge) going forward, or (next vertex, edge) in reverse mode.
+        """
+        blocked = {EDGE_KINDS.index(kind) for kind in INACCESSIBLE_KINDS} if accessible_only else set()
+        if reverse:
+            offsets, neighbours, edge_ids = self._reverse_adjacency()
+        else:
+            offsets, neighbours, edge_ids = self.offsets, self.targets, None
+        weights, kinds = self.weights, self.kinds
+
+        best: Dict[int, float] = {}
+        links: Dict[int, Tuple[Optional[int], Optional[int]]] = {}
+        heap = []
+        for node, distance in snap['links']:
+            if distance < best.get(node, float('inf')):
+                best[node] = distance
+                links[node] = (None, None)
+                heapq.heappush(heap, (distance, node))
+
+        while heap:
+            cost, node = heapq.heappop(heap)
+            if cost > best[node]:
+                continue
+            for slot in range(offsets[node], offsets[node + 1]):
+                edge = edge_ids[slot] if reverse else slot
+                if kinds[edge] in blocked:
+                    continue
+                neighbour = neighbours[slot]
+                new_cost = cost + weights[edge]
+                if new_cost < best.get(neighbour, float('inf')):
+                    best[neighbour] = new_cost
+                    links[neighbour] = (node, edge)
+                    heapq.heappush(heap, (new_cost, neighbour))
+        return best, links
+
+    def path_from_tree(self, start_snap: Dict, end_snap: Dict, best: Dict[int, float],
+                       links: Dict[int, Tuple[Optional[int], Optional[int]]],
+                       reverse: bool = False) -> Optional[Tuple[float, List[int], List[int]]]:
+        """
+        Extract one (distance, nodes, edges) path from a dijkstra() result. A forward tree
+        was grown from start_snap; a reverse tree was grown back from end_snap.
+        """
+        open_snap = start_snap if reverse else end_snap
+        candidates = [
+            (best[node] + distance, node) for node, distance in open_snap['links'] if node in best
+        ]
+        direct = None
+        if {node for node, _ in start_snap['links']} == {node for node, _ in end_snap['links']}:
+            sx, sy, _ = start_snap['point']
+            ex, ey, _ = end_snap['point']
+            direct = math.hypot(sx - ex, sy - ey)
+
+        if not candidates:
+            return (direct, [], []) if direct is not None else None
+        distance, node = min(candidates)
+        if direct is not None and direct <= distance:
+            return direct, [], []
+
+        if not reverse:
+            nodes, edges = self.unwind(links, node)
+            return distance, nodes, edges
+
+        nodes = [node]
+        edges = []
+        while True:
+            following, edge = links[nodes[-1]]
+            if following is None:
+                break
+            edges.append(edge)
+            nodes.append(following)
+        return distance, nodes, edges
+
+    @staticmethod
+    def unwind(came_from: Dict[int, Tuple[Optional[int], Optional[int]]],
+               last: Optional[int]) -> Tuple[List[int], List[int]]:
+        """Rebuild the node and edge sequence ending at `last` from a predecessor map"""
+        if last is None:
+            return [], []
+        nodes = [last]
+        edges = []
+        while True:
+            previous, edge = came_from[nodes[-1]]
+            if previous is None:
+                break
+            edges.append(edge)
+            nodes.append(previous)
+        nodes.reverse()
+        edges.reverse()
+        return nodes, edges
+
+    def route(self, start: Tuple[float, float, int], end: Tuple[float, float, int],
+              accessible_only: bool = False) -> Optional[Dict]:
+        """Route between two (x, y, floor) points, including the legs to and from the network"""
+        start_snap = self.snap(*start)
+        end_snap = self.snap(*end)
+        if start_snap is None or end_snap is None:
+            return None
+
+        result = self.shortest_path(start_snap, end_snap, accessible_only)
+        if result is None:
+            return None
+        _, nodes, edges = result
+        return self.build_route(start, end, start_snap, end_snap, nodes, edges)
+
+    def build_route(self, start: Tuple[float, float, int], end: Tuple[float, float, int],
+                    start_snap: Dict, end_snap: Dict, nodes: List[int], edges: List[int]) -> Dict:
+        """Assemble points, legs and total distance for a snapped node path"""
+        points = [(float(start[0]), float(start[1]), int(start[2]))]
+        legs = []
+
+        def add_point(point, kind, name, weight=None):
+            x, y, floor = point
+            px, py, pfloor = points[-1]
+            length = weight if weight is not None else math.hypot(x - px, y - py)
+            if length <= 0 and floor == pfloor:
+                return
+            legs.append({'kind': kind, 'name': name, 'length': length})
+            points.append((x, y, floor))
+
+        def vertex(node):
+            return self.node_x[node], self.node_y[node], self.node_floor[node]
+
+        start_name = self.edge_names[start_snap['edge']]
+        end_name = self.edge_names[end_snap['edge']]
+
+        add_point(start_snap['point'], 'walkway', None)
+        if nodes:
+            add_point(vertex(nodes[0]), EDGE_KINDS[self.kinds[start_snap['edge']]], start_name)
+            for node, edge in zip(nodes[1:], edges):
+                add_point(vertex(node), EDGE_KINDS[self.kinds[edge]], self.edge_names[edge], self.weights[edge])
+        add_point(end_snap['point'], EDGE_KINDS[self.kinds[end_snap['edge']]], end_name)
+        add_point((float(end[0]), float(end[1]), int(end[2])), 'walkway', None)
+
+        return {
+            'points': points,
+            'legs': legs,
+            'distance_meters': sum(leg['length'] for leg in legs),
+        }
+
+    # Instructions ----------------------------------------------------------
+
+    def instructions(self, route: Dict, destination_name: Optional[str] = None) -> List[Dict]:
+        """Merge straight runs into steps and describe turns and floor changes"""
+        points = route['points']
+        legs = route['legs']
+        steps = []
+        current = None
+        previous_heading = None
+        carried = 0.0
+        carried_from = None
+
+        for index, leg in enumerate(legs):
+            (x1, y1, floor1), (x2, y2, floor2) = points[index], points[index + 1]
+
+            if leg['kind'] in FLOOR_CHANGE_KINDS and floor1 != floor2:
+                if current:
+                    steps.append(current)
+                direction = 'up' if floor2 > floor1 else 'down'
+                current = {
+                    'instruction': f"Take the {leg['kind']} {direction} to floor {floor2}",
+                    'distance_meters': carried + leg['length'],
+                    'start': carried_from or (x1, y1, floor1),
+                }
+                carried, carried_from = 0.0, None
+                steps.append(current)
+                current = None
+                previous_heading = None
+                continue
+
+            if leg['length'] < MIN_INSTRUCTION_METERS:
+                if current:
+                    current['distance_meters'] += leg['length']
+                else:
+                    carried += leg['length']
+                    carried_from = carried_from or (x1, y1, floor1)
+                continue
+
+            heading = math.degrees(math.atan2(x2 - x1, y2 - y1)) % 360
+            along = f" along {leg['name']}" if leg['name'] else ''
+
+            if current is None:
+                current = {
+                    'instruction': f"Head {self._cardinal(heading)}{along}",
+                    'distance_meters': carried,
+                    'start': carried_from or (x1, y1, floor1),
+                }
+                carried, carried_from = 0.0, None
+            else:
+                change = (heading - previous_heading + 180) % 360 - 180
+                if abs(change) > STRAIGHT_TOLERANCE_DEGREES:
+                    steps.append(current)
+                    current = {
+                        'instruction': f"{self._turn_phrase(change)}{along}",
+                        'distance_meters': 0.0,
+                        'start': (x1, y1, floor1),
+                    }
+
+            current['distance_meters'] += leg['length']
+            previous_heading = heading
+
+        if current:
+            steps.append(current)
+
+        end_x, end_y, end_floor = points[-1]
+        arrival = f"Arrive at {destination_name}" if destination_name else "You have arrived at your destination"
+        steps.append({'instruction': arrival, 'distance_meters': 0, 'start': (end_x, end_y, end_floor)})
+
+        result = []
+        for number, step in enumerate(steps, start=1):
+            x, y, floor = step['start']
+            distance = round(step['distance_meters'], 2)
+            text = step['instruction']
+            if distance and not text.startswith('Take the'):
+                text = f"{text} for {round(distance, 1)} meters"
+            entry = {
+                'step': number,
+                'instruction': text,
+                'distance_meters': distance,
+                'indoor_coordinates': {'x': round(x, 2), 'y': round(y, 2), 'floor': floor},
+            }
+            if self.is_georeferenced:
+                latitude, longitude = self.to_geo(x, y)
+                entry['coordinates'] = [longitude, latitude]
+            result.append(entry)
+        return result
+
+    @staticmethod
+    def _cardinal(heading: float) -> str:
+        directions = ["north", "northeast", "east", "southeast", "south", "southwest", "west", "northwest"]
+        return directions[round(heading / 45) % 8]
+
+    @staticmethod
+    def _turn_phrase(change: float) -> str:
+        change = (change + 180) % 360 - 180
+        side = 'right' if change > 0 else 'left'
+        magnitude = abs(change)
+        if magnitude <= STRAIGHT_TOLERANCE_DEGREES:
+            return "Continue straight"
+        if magnitude <= SLIGHT_TURN_DEGREES:
+            return f"Bear slightly {side}"
+        if magnitude >= SHARP_TURN_DEGREES:
+            return f"Make a sharp {side}"
+        return f"Turn {side}"
+
+
+def map_data_fingerprint(map_data) -> str:
+    return hashlib.sha1(json.dumps(map_data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class RoutingGraphRegistry:
+    """Process-local cache of compiled market graphs, rebuilt only when map_data changes"""
+
+    _graphs: 'OrderedDict[str, Tuple[str, str, Optional[RoutingGraph]]]' = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def for_market(cls, market) -> Optional[RoutingGraph]:
+        market_id = str(market.id)
+        version = get_version(VERSION_NAMESPACE, market_id)
+
+        with cls._lock:
+            cached = cls._graphs.get(market_id)
+            if cached and cached[0] == version:
+                cls._graphs.move_to_end(market_id)
+                return cached[2]
+
+        # The market was saved since we compiled; only recompile if map_data itself changed
+        fingerprint = map_data_fingerprint(market.map_data)
+        if cached and cached[1] == fingerprint:
+            graph = cached[2]
+        else:
+            graph = RoutingGraph.compile(market.map_data)
+
+        with cls._lock:
+            cls._graphs[market_id] = (version, fingerprint, graph)
+            cls._graphs.move_to_end(market_id)
+            while len(cls._graphs) > ROUTING_GRAPH_CACHE_SIZE:
+                cls._graphs.popitem(last=False)
+        return graph
+
+    @classmethod
+    def invalidate(cls, market_id: str) -> None:
+        bump_version(VERSION_NAMESPACE, str(market_id))
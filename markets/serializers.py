@@ -1,10 +1,15 @@
+import math
+
+from django.conf import settings
 from rest_framework import serializers
 from .models import (
     Market, Shop, NavigationRoute, GeofenceZone, 
-    UserLocation, NavigationSession, Category, Product, 
+    UserLocation, CurrentUserLocation, NavigationSession, Category, Product, 
     ProductImage, Order, OrderItem, SellerAnalytics, 
     SellerWallet, WalletTransaction
 )
+from .checkout import CheckoutService, UnknownProducts
+from .stock_reservations import InsufficientStock
 from users.models import User
 
 
@@ -84,6 +89,21 @@ class UserLocationSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'user_name', 'market_name', 'shop_name', 'zone_name', 'timestamp']
 
 
+class CurrentUserLocationSerializer(serializers.ModelSerializer):
+    """Serializer for CurrentUserLocation model"""
+    market_name = serializers.CharField(source='market.name', read_only=True)
+    shop_name = serializers.CharField(source='current_shop.name', read_only=True)
+    zone_name = serializers.CharField(source='current_zone.name', read_only=True)
+    
+    class Meta:
+        model = CurrentUserLocation
+        fields = [
+            'user', 'market', 'market_name', 'latitude', 'longitude', 'accuracy_meters',
+            'indoor_x', 'indoor_y', 'floor_level', 'is_indoor',
+            'current_shop', 'shop_name', 'current_zone', 'zone_name', 'timestamp'
+        ]
+
+
 class NavigationSessionSerializer(serializers.ModelSerializer):
     """Serializer for NavigationSession model"""
     user_name = serializers.CharField(source='user.get_full_name', read_only=True)
@@ -116,6 +136,9 @@ class RouteCalculationSerializer(serializers.Serializer):
     def validate(self, data):
         if not data.get('destination_shop_id') and not (data.get('destination_latitude') and data.get('destination_longitude')):
             raise serializers.ValidationError("Either destination_shop_id or destination coordinates must be provided")
+        for field in ('start_latitude', 'start_longitude', 'destination_latitude', 'destination_longitude'):
+            if field in data and not math.isfinite(data[field]):
+                raise serializers.ValidationError({field: "Must be a finite number"})
         return data
 
 
@@ -133,6 +156,18 @@ class LocationUpdateSerializer(serializers.Serializer):
     market_id = serializers.UUIDField(required=False)
 
 
+class LocationFixSerializer(LocationUpdateSerializer):
+    """Serializer for one fix in a batched location upload"""
+    market_id = None
+    timestamp = serializers.DateTimeField(required=False)
+
+
+class LocationBatchSerializer(serializers.Serializer):
+    """Serializer for batched user location updates"""
+    locations = LocationFixSerializer(many=True, allow_empty=False, max_length=500)
+    market_id = serializers.UUIDField(required=False)
+
+
 class NearbyShopsSerializer(serializers.Serializer):
     """Serializer for nearby shops requests"""
     latitude = serializers.FloatField()
@@ -239,50 +274,51 @@ class OrderSerializer(serializers.ModelSerializer):
             'buyer_note', 'seller_note', 'created_at', 'updated_at',
             'items'
         ]
+        # Status changes go through the seller's update_order, which moves the reserved stock
+        read_only_fields = ['buyer', 'seller', 'status', 'total_amount', 'seller_note']
+
+
+class OrderItemInputSerializer(serializers.Serializer):
+    """One basket line when creating an order"""
+    product = serializers.UUIDField()
+    quantity = serializers.IntegerField(min_value=1)
 
 
 class OrderCreateSerializer(serializers.ModelSerializer):
     """Serializer for creating orders"""
-    items = serializers.ListField(write_only=True)
+    items = serializers.ListField(child=OrderItemInputSerializer(), write_only=True, allow_empty=False)
     
     class Meta:
         model = Order
         fields = ['buyer', 'seller', 'buyer_note', 'items']
     
     def create(self, validated_data):
-        items_data = validated_data.pop('items')
-        total_amount = 0
-        
-        # Create the order
-        order = Order.objects.create(
-            buyer=validated_data['buyer'],
-            seller=validated_data['seller'],
-            buyer_note=validated_data.get('buyer_note', ''),
-            total_amount=0  # Will update this after calculating
-        )
-        
-        # Create order items
-        for item_data in items_data:
-            product = Product.objects.get(id=item_data['product'])
-            price = product.price
-            quantity = item_data['quantity']
-            subtotal = price * quantity
-            total_amount += subtotal
-            
-            OrderItem.objects.create(
-                order=order,
-                product=product,
-                quantity=quantity,
-                price_at_time_of_order=price,
-                product_name=product.name,
-                product_description=product.description
-            )
-        
-        # Update the total amount
-        order.total_amount = total_amount
-        order.save()
-        
-        return order
+        # All basket lines go to the one seller given
+        return place_orders_or_raise(
+            validated_data['buyer'], validated_data['items'],
+            validated_data.get('buyer_note', ''), seller=validated_data['seller']
+        )[0]
+
+
+class CartCheckoutSerializer(serializers.Serializer):
+    """Serializer for checking out a basket across sellers; creates one order per seller"""
+    items = serializers.ListField(child=OrderItemInputSerializer(), allow_empty=False,
+                                  max_length=settings.CART_CHECKOUT_MAX_ITEMS)
+    buyer_note = serializers.CharField(required=False, allow_blank=True, default='')
+    
+    def create(self, validated_data):
+        return place_orders_or_raise(validated_data['buyer'], validated_data['items'], validated_data['buyer_note'])
+
+
+def place_orders_or_raise(buyer, items, buyer_note, seller=None):
+    """CheckoutService.place_orders with basket problems reported as validation errors"""
+    try:
+        return CheckoutService.place_orders(buyer, items, buyer_note, seller=seller)
+    except UnknownProducts as e:
+        raise serializers.ValidationError({'items': [str(e)]})
+    except InsufficientStock as e:
+        product = Product.objects.only('name').get(id=e.product_id)
+        raise serializers.ValidationError({'items': [f"Not enough stock for {product.name}"]})
 
 
 class SellerAnalyticsSerializer(serializers.ModelSerializer):
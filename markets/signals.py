@@ -0,0 +1,118 @@
+"""
+Signal handlers keeping the in-memory navigation caches in sync with the database
+"""
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from .geofence_engine import GeofenceRegistry, MarketBoundaryCache
+from .models import GeofenceZone, Market, Shop
+from .route_precompute import RouteRefreshWorker
+from .routing_engine import RoutingGraphRegistry
+from .spatial_index import ShopIndexRegistry
+
+# Fields that change where a shop sits on the walkway graph
+SHOP_POSITION_FIELDS = ('market_id', 'latitude', 'longitude', 'indoor_x', 'indoor_y', 'indoor_floor', 'is_active')
+
+# Fields that change where an entrance zone sits on the walkway graph
+ENTRANCE_POSITION_FIELDS = ('market_id', 'zone_type', 'center_latitude', 'center_longitude', 'floor_level')
+
+
+@receiver(pre_save, sender=Shop)
+def remember_shop_position(sender, instance, **kwargs):
+    """Stash the stored position so post_save can tell whether the shop moved"""
+    instance._previous_position = None
+    if instance._state.adding:
+        return
+    instance._previous_position = Shop.objects.filter(pk=instance.pk).values_list(*SHOP_POSITION_FIELDS).first()
+
+
+@receiver(post_save, sender=Shop)
+@receiver(post_delete, sender=Shop)
+def invalidate_shop_index(sender, instance, **kwargs):
+    """Drop the market's shop index whenever one of its shops changes"""
+    ShopIndexRegistry.invalidate(instance.market_id)
+
+    previous = getattr(instance, '_previous_position', None)
+    if previous and previous[0] != instance.market_id:
+        ShopIndexRegistry.invalidate(previous[0])
+
+
+@receiver(post_save, sender=Shop)
+def refresh_shop_routes(sender, instance, created, **kwargs):
+    """Queue an incremental route refresh when a shop is added or moves"""
+    previous = getattr(instance, '_previous_position', None)
+    current = tuple(getattr(instance, field) for field in SHOP_POSITION_FIELDS)
+    if not created and previous == current:
+        return
+
+    markets = {instance.market_id}
+    if previous:
+        markets.add(previous[0])
+    for market_id in markets:
+        transaction.on_commit(
+            lambda market_id=market_id: RouteRefreshWorker.schedule_shop_refresh(market_id, instance.id)
+        )
+
+
+@receiver(pre_save, sender=Market)
+def remember_market_map(sender, instance, **kwargs):
+    """Stash the stored map_data so post_save can tell whether the walkway graph changed"""
+    instance._previous_map_data = None
+    if not instance._state.adding:
+        instance._previous_map_data = Market.objects.filter(pk=instance.pk).values_list('map_data', flat=True).first()
+
+
+@receiver(post_save, sender=Market)
+def invalidate_routing_graph(sender, instance, **kwargs):
+    """Have workers re-check map_data; the graph is only recompiled if it actually changed"""
+    RoutingGraphRegistry.invalidate(instance.id)
+
+
+@receiver(post_save, sender=Market)
+def rebuild_market_routes(sender, instance, created, **kwargs):
+    """Queue a rebuild of the stored routes when the walkway graph changes"""
+    if created or getattr(instance, '_previous_map_data', None) == instance.map_data:
+        return
+    transaction.on_commit(lambda: RouteRefreshWorker.schedule_market_rebuild(instance.id))
+
+
+@receiver(post_save, sender=Market)
+@receiver(post_delete, sender=Market)
+def invalidate_market_boundary(sender, instance, **kwargs):
+    """Drop the cached boundary polygon so the next indoor check re-reads it"""
+    MarketBoundaryCache.invalidate(instance.id)
+
+
+@receiver(post_save, sender=GeofenceZone)
+@receiver(post_delete, sender=GeofenceZone)
+def invalidate_geofence_index(sender, instance, **kwargs):
+    """Drop the market's prepared zone polygons whenever one of its zones changes"""
+    GeofenceRegistry.invalidate(instance.market_id)
+
+
+@receiver(pre_save, sender=GeofenceZone)
+def remember_zone_position(sender, instance, **kwargs):
+    """Stash the stored position so post_save can tell whether an entrance moved"""
+    instance._previous_position = None
+    if not instance._state.adding:
+        instance._previous_position = GeofenceZone.objects.filter(
+            pk=instance.pk
+        ).values_list(*ENTRANCE_POSITION_FIELDS).first()
+
+
+@receiver(post_save, sender=GeofenceZone)
+@receiver(post_delete, sender=GeofenceZone)
+def rebuild_entrance_routes(sender, instance, **kwargs):
+    """Queue a rebuild of the stored routes when an entrance zone is added, moved or removed"""
+    previous = getattr(instance, '_previous_position', None)
+    current = tuple(getattr(instance, field) for field in ENTRANCE_POSITION_FIELDS)
+    if kwargs.get('signal') is post_save and previous == current:
+        return
+    if instance.zone_type != 'entrance' and not (previous and previous[1] == 'entrance'):
+        return
+
+    markets = {instance.market_id}
+    if previous:
+        markets.add(previous[0])
+    for market_id in markets:
+        transaction.on_commit(lambda market_id=market_id: RouteRefreshWorker.schedule_market_rebuild(market_id))
@@ -0,0 +1,173 @@
+"""
+In-memory spatial index for shop lookups within a market
+"""
+import heapq
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from .cache_versions import get_version, bump_version
+from .distance_engine import CoordinateArray, METERS_PER_DEGREE_LAT, bounding_box, haversine_meters
+from .models import Shop
+
+# ~55m per cell at the equator; a 100m radius search touches roughly 25 cells
+GRID_CELL_DEGREES = 0.0005
+# Rings searched around a point before nearest() falls back to scanning every occupied cell
+MAX_NEAREST_RINGS = 16
+
+VERSION_NAMESPACE = 'shop_index'
+# Markets whose index a worker keeps; market ids come from clients, so the cache is bounded
+SHOP_INDEX_CACHE_SIZE = 256
+
+
+class ShopSpatialIndex:
+    """Uniform grid of shop buckets answering radius and k-nearest queries for one market"""
+
+    def __init__(self, market_id: str, shops: List[Shop], cell_degrees: float = GRID_CELL_DEGREES):
+        self.market_id = market_id
+        self.cell_degrees = cell_degrees
+        self.cells: Dict[Tuple[int, int], List[Shop]] = {}
+        self.size = 0
+
+        for shop in shops:
+            self.cells.setdefault(self._cell(shop.latitude, shop.longitude), []).append(shop)
+            self.size += 1
+
+        if self.cells:
+            rows = [cell[0] for cell in self.cells]
+            cols = [cell[1] for cell in self.cells]
+            self._bounds = (min(rows), max(rows), min(cols), max(cols))
+        else:
+            self._bounds = None
+
+    def _cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return (int(math.floor(latitude / self.cell_degrees)),
+                int(math.floor(longitude / self.cell_degrees)))
+
+    def _min_cell_meters(self, latitude: float) -> float:
+        cos_lat = max(math.cos(math.radians(latitude)), 1e-6)
+        return self.cell_degrees * METERS_PER_DEGREE_LAT * cos_lat
+
+    def within_radius(self, latitude: float, longitude: float, radius_meters: float) -> List[Tuple[float, Shop]]:
+        """Return (distance, shop) pairs within the radius, nearest first"""
+        if not self.cells:
+            return []
+
+        min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_meters)
+        min_row, min_col = self._cell(min_lat, min_lon if min_lon is not None else -180.0)
+        max_row, max_col = self._cell(max_lat, max_lon if max_lon is not None else 180.0)
+
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self.cells):
+            # Radius covers more cells than are occupied; walk the occupied ones instead
+            buckets = [
+                shops for (r, c), shops in self.cells.items()
+                if min_row <= r <= max_row and min_col <= c <= max_col
+            ]
+        else:
+            buckets = [
+                self.cells[(r, c)]
+                for r in range(min_row, max_row + 1)
+                for c in range(min_col, max_col + 1)
+                if (r, c) in self.cells
+            ]
+
+        candidates = [shop for bucket in buckets for shop in bucket]
+        if not candidates:
+            return []
+
+        distances, order = CoordinateArray.from_objects(candidates).sorted_by_distance(
+            latitude, longitude, radius_meters
+        )
+        return [(distances[i], candidates[i]) for i in order]
+
+    def nearest(self, latitude: float, longitude: float, k: int = 1,
+                max_distance_meters: Optional[float] = None) -> List[Tuple[float, Shop]]:
+        """Return up to k (distance, shop) pairs nearest to the point, expanding ring by ring"""
+        if not self.cells or k <= 0:
+            return []
+
+        row, col = self._cell(latitude, longitude)
+        min_row, max_row, min_col, max_col = self._bounds
+        max_ring = max(abs(row - min_row), abs(row - max_row), abs(col - min_col), abs(col - max_col))
+        cell_meters = self._min_cell_meters(latitude)
+
+        # Max-heap of the best k candidates, keyed on negative distance
+        best: List[Tuple[float, int, Shop]] = []
+
+        def consider(shops):
+            for shop in shops:
+                distance = haversine_meters(latitude, longitude, shop.latitude, shop.longitude)
+                if max_distance_meters is not None and distance > max_distance_meters:
+                    continue
+                entry = (-distance, id(shop), shop)
+                if len(best) < k:
+                    heapq.heappush(best, entry)
+                elif distance < -best[0][0]:
+                    heapq.heapreplace(best, entry)
+
+        ring = 0
+        while ring <= max_ring:
+            # Anything in this ring or beyond is at least (ring - 1) cells away
+            lower_bound = max(ring - 1, 0) * cell_meters
+            if len(best) == k and lower_bound > -best[0][0]:
+                break
+            if max_distance_meters is not None and lower_bound > max_distance_meters:
+                break
+            if ring > MAX_NEAREST_RINGS:
+                # Far from the shops the rings are mostly empty; check the rest of the occupied cells
+                consider(shop for (r, c), shops in self.cells.items()
+                         if max(abs(r - row), abs(c - col)) >= ring for shop in shops)
+                break
+
+            for r, c in self._ring_cells(row, col, ring):
+                consider(self.cells.get((r, c), ()))
+            ring += 1
+
+        return sorted(((-neg_distance, shop) for neg_distance, _, shop in best), key=lambda item: item[0])
+
+    @staticmethod
+    def _ring_cells(row: int, col: int, ring: int):
+        if ring == 0:
+            yield row, col
+            return
+        for c in range(col - ring, col + ring + 1):
+            yield row - ring, c
+            yield row + ring, c
+        for r in range(row - ring + 1, row + ring):
+            yield r, col - ring
+            yield r, col + ring
+
+
+class ShopIndexRegistry:
+    """Process-local LRU of per-market shop indexes, invalidated through version tokens"""
+
+    _indexes: 'OrderedDict[str, Tuple[str, ShopSpatialIndex]]' = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def for_market(cls, market_id: str) -> ShopSpatialIndex:
+        market_id = str(market_id)
+        version = get_version(VERSION_NAMESPACE, market_id)
+
+        with cls._lock:
+            cached = cls._indexes.get(market_id)
+            if cached and cached[0] == version:
+                cls._indexes.move_to_end(market_id)
+                return cached[1]
+
+        shops = list(Shop.objects.filter(market_id=market_id, is_active=True, is_verified=True))
+        index = ShopSpatialIndex(market_id, shops)
+        with cls._lock:
+            cls._indexes[market_id] = (version, index)
+            cls._indexes.move_to_end(market_id)
+            while len(cls._indexes) > SHOP_INDEX_CACHE_SIZE:
+                cls._indexes.popitem(last=False)
+        return index
+
+    @classmethod
+    def invalidate(cls, market_id: str) -> None:
+        market_id = str(market_id)
+        with cls._lock:
+            cls._indexes.pop(market_id, None)
+        bump_version(VERSION_NAMESPACE, market_id)
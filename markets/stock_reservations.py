@@ -0,0 +1,130 @@
+"""
+Stock reservations: orders take stock from Product.stock_quantity when they are placed
+"""
+from collections import Counter
+from datetime import timedelta
+from typing import Dict, Iterable, List, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Order, OrderItem, Product, StockReservation
+
+# Order statuses that keep their stock for good, and the one that gives it back
+CONFIRMING_STATUSES = ('confirmed', 'processing', 'ready', 'completed')
+RELEASING_STATUSES = ('cancelled',)
+
+
+class InsufficientStock(Exception):
+    """A product does not have enough stock left for the quantity asked"""
+
+    def __init__(self, product_id, requested: int):
+        self.product_id = product_id
+        self.requested = requested
+        super().__init__(f"Not enough stock for product {product_id} (requested {requested})")
+
+
+class StockReservationService:
+    """
+    Every stock change is a single conditional UPDATE: taking stock only succeeds
+    `WHERE stock_quantity >= n`, and a reservation only changes status when it is still in
+    the status expected. Concurrent checkouts therefore never oversell or release twice,
+    and nothing is locked beyond the rows being updated.
+    """
+
+    @staticmethod
+    def take_stock(quantities: Dict) -> None:
+        """Decrement each product by its quantity, or raise InsufficientStock; call inside a transaction"""
+        # A fixed product order keeps concurrent multi-product checkouts from deadlocking
+        for product_id in sorted(quantities, key=str):
+            taken = Product.objects.filter(
+                id=product_id, stock_quantity__gte=quantities[product_id]
+            ).update(stock_quantity=F('stock_quantity') - quantities[product_id])
+            if not taken:
+                raise InsufficientStock(product_id, quantities[product_id])
+
+    @staticmethod
+    def return_stock(quantities: Dict) -> None:
+        for product_id in sorted(quantities, key=str):
+            Product.objects.filter(id=product_id).update(stock_quantity=F('stock_quantity') + quantities[product_id])
+
+    @staticmethod
+    def reserve(order: Order, items: Iterable[OrderItem]) -> List[StockReservation]:
+        """Take stock for an order's items and hold it for STOCK_RESERVATION_TTL_MINUTES"""
+        return StockReservationService.reserve_orders([(order, items)])
+
+    @staticmethod
+    def reserve_orders(orders_items: Iterable[Tuple[Order, Iterable[OrderItem]]]) -> List[StockReservation]:
+        """Take stock for several orders at once; either every order gets its stock or none does"""
+        per_order = []
+        totals = Counter()
+        for order, items in orders_items:
+            quantities = Counter()
+            for item in items:
+                quantities[item.product_id] += item.quantity
+            per_order.append((order, quantities))
+            totals.update(quantities)
+
+        expires_at = timezone.now() + timedelta(minutes=settings.STOCK_RESERVATION_TTL_MINUTES)
+        with transaction.atomic():
+            StockReservationService.take_stock(totals)
+            return StockReservation.objects.bulk_create([
+                StockReservation(order=order, product_id=product_id, quantity=quantity, expires_at=expires_at)
+                for order, quantities in per_order
+                for product_id, quantity in quantities.items()
+            ])
+
+    @staticmethod
+    def confirm(order: Order) -> None:
+        """Keep the order's stock for good; stock of expired or released reservations is taken again"""
+        with transaction.atomic():
+            StockReservation.objects.filter(order=order, status='held').update(status='confirmed')
+
+            # An order confirmed after it expired or was cancelled must win its stock back
+            quantities = Counter()
+            for reservation in StockReservation.objects.filter(order=order, status__in=['expired', 'released']):
+                # Only the caller that moves the reservation out of its status takes stock again
+                if StockReservation.objects.filter(
+                    id=reservation.id, status=reservation.status
+                ).update(status='confirmed'):
+                    quantities[reservation.product_id] += reservation.quantity
+            StockReservationService.take_stock(quantities)
+
+    @staticmethod
+    def release(order: Order) -> int:
+        """Return the stock of an order's held or confirmed reservations; returns units released"""
+        with transaction.atomic():
+            return StockReservationService._release(
+                StockReservation.objects.filter(order=order, status__in=['held', 'confirmed']), 'released'
+            )
+
+    @staticmethod
+    def release_expired(now=None, dry_run: bool = False) -> int:
+        """Return stock held past its expiry; returns units released"""
+        expired = StockReservation.objects.filter(status='held', expires_at__lte=now or timezone.now())
+        if dry_run:
+            return sum(expired.values_list('quantity', flat=True))
+        with transaction.atomic():
+            return StockReservationService._release(expired, 'expired')
+
+    @staticmethod
+    def _release(reservations, new_status: str) -> int:
+        quantities = Counter()
+        for reservation in reservations:
+            # Only the caller that moves the reservation out of its status returns its stock
+            if StockReservation.objects.filter(
+                id=reservation.id, status=reservation.status
+            ).update(status=new_status):
+                quantities[reservation.product_id] += reservation.quantity
+        StockReservationService.return_stock(quantities)
+        return sum(quantities.values())
+
+    @staticmethod
+    def apply_status_change(order: Order, new_status: str) -> None:
+        """Confirm or release the order's stock for an order status transition"""
+        if new_status in CONFIRMING_STATUSES:
+            StockReservationService.confirm(order)
+        elif new_status in RELEASING_STATUSES:
+            StockReservationService.release(order)
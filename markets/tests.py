@@ -1,3 +1,1025 @@
-from django.test import TestCase
+import io
+import math
+import random
+import signal
+import threading
+import time
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from channels.testing import ApplicationCommunicator, WebsocketCommunicator
+from django.core.management import call_command
+from django.db import connections
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users.models import User
+from . import spatial_index
+from .cache_versions import _token_timeout, bump_version, get_version
+from .checkout import CheckoutService
+from . import distance_engine
+from .distance_engine import METERS_PER_DEGREE_LAT, CoordinateArray, bounding_box, haversine_meters
+from .geofence_engine import GeofenceRegistry, MarketBoundaryCache
+from .location_history import LocationHistoryCompactor, douglas_peucker
+from .location_partitions import LocationPartitionManager, expired_days, partition_name
+from .location_writer import SHUTDOWN_SIGNALS, LocationWriteBuffer
+from .models import (
+    CurrentUserLocation, GeofenceZone, Market, NavigationRoute, NavigationSession, Order, OrderItem, Product, Shop,
+    StockReservation, UserLocation,
+)
+from .navigation_utils import NavigationService
+from .route_progress import OFF_ROUTE_METERS, RouteProgressRegistry, RouteProgressTracker
+from .route_precompute import RoutePrecomputer, RouteRefreshWorker
+from .routing_engine import MAX_SNAP_METERS, RoutingGraph
+from .spatial_index import ShopIndexRegistry, ShopSpatialIndex
+from .stock_reservations import InsufficientStock, StockReservationService
+
+
+def make_seller(name='seller'):
+    return User.objects.create_user(username=name, email=f'{name}@example.com', password='pass',
+                                    role=User.ROLE_SELLER, is_verified=True)
+
+
+def make_buyer(name='buyer'):
+    return User.objects.create_user(username=name, email=f'{name}@example.com', password='pass')
+
+
+WALKWAY_MAP = {
+    'walkways': [
+        {'id': 'aisle-a', 'name': 'Aisle A', 'type': 'aisle', 'floor': 0, 'points': [[0, 0], [0, 40], [30, 40]]},
+    ],
+}
+
+
+def make_market(name='Balogun', map_data=None):
+    return Market.objects.create(name=name, address='1 Market Road', city='Lagos', state='Lagos',
+                                 latitude=6.4525, longitude=3.3950, map_data=map_data)
+
+
+def make_shop(market, seller, x, y, name='Shop'):
+    return Shop.objects.create(market=market, seller=seller, name=name, latitude=6.4525, longitude=3.3950,
+                               indoor_x=x, indoor_y=y)
+
+
+def make_product(seller, stock, name='Rice'):
+    return Product.objects.create(seller=seller, name=name, description=name,
+                                  price=Decimal('10.00'), stock_quantity=stock)
+
+
+def square(south, west, size):
+    return [[south, west], [south, west + size], [south + size, west + size], [south + size, west], [south, west]]
+
+
+def make_zone(market, name, boundary, zone_type='section', floor_level=0, **fields):
+    return GeofenceZone.objects.create(market=market, name=name, zone_type=zone_type, boundary_coordinates=boundary,
+                                       center_latitude=fields.pop('center_latitude', 6.4525),
+                                       center_longitude=fields.pop('center_longitude', 3.3950),
+                                       floor_level=floor_level, **fields)
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        self.seller = make_seller()
+        self.buyer = make_buyer()
+        self.product = make_product(self.seller, stock=5)
+
+    def place(self, quantity=2):
+        return CheckoutService.place_orders(self.buyer, [{'product': self.product.id, 'quantity': quantity}])[0]
+
+    def assert_stock(self, stock, statuses):
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, stock)
+        self.assertEqual(sorted(StockReservation.objects.values_list('status', flat=True)), statuses)
+
+    def test_placing_holds_stock(self):
+        self.place()
+        self.assert_stock(3, ['held'])
+
+    def test_insufficient_stock_raises(self):
+        with self.assertRaises(InsufficientStock):
+            self.place(quantity=6)
+        self.assert_stock(5, [])
+
+    def test_confirm_keeps_stock(self):
+        order = self.place()
+        StockReservationService.confirm(order)
+        self.assert_stock(3, ['confirmed'])
+
+    def test_release_returns_stock_once(self):
+        order = self.place()
+        self.assertEqual(StockReservationService.release(order), 2)
+        self.assertEqual(StockReservationService.release(order), 0)
+        self.assert_stock(5, ['released'])
+
+    def test_release_expired(self):
+        self.place()
+        self.assertEqual(StockReservationService.release_expired(now=timezone.now() + timedelta(days=1)), 2)
+        self.assert_stock(5, ['expired'])
+
+    def test_confirm_after_expiry_takes_stock_again(self):
+        order = self.place()
+        StockReservationService.release_expired(now=timezone.now() + timedelta(days=1))
+        StockReservationService.confirm(order)
+        StockReservationService.confirm(order)
+        self.assert_stock(3, ['confirmed'])
+
+    def test_confirm_after_cancel_takes_stock_again(self):
+        order = self.place()
+        StockReservationService.release(order)
+        StockReservationService.confirm(order)
+        self.assert_stock(3, ['confirmed'])
+
+    def test_confirm_after_cancel_fails_when_sold_out(self):
+        order = self.place(quantity=3)
+        StockReservationService.release(order)
+        self.place(quantity=4)
+        with self.assertRaises(InsufficientStock):
+            StockReservationService.confirm(order)
+        self.assert_stock(1, ['held', 'released'])
+
+
+class OrderStockApiTests(TestCase):
+    def setUp(self):
+        self.seller = make_seller()
+        self.buyer = make_buyer()
+        self.product = make_product(self.seller, stock=5)
+        self.order = CheckoutService.place_orders(self.buyer, [{'product': self.product.id, 'quantity': 2}])[0]
+        self.client = APIClient()
+
+    def stock(self):
+        self.product.refresh_from_db()
+        return self.product.stock_quantity
+
+    def test_seller_cancel_then_confirm_takes_stock_again(self):
+        self.client.force_authenticate(self.seller)
+        url = f'/api/seller/{self.order.id}/update_order/'
+        self.assertEqual(self.client.put(url, {'status': 'cancelled'}).status_code, 200)
+        self.assertEqual(self.stock(), 5)
+        self.assertEqual(self.client.put(url, {'status': 'confirmed'}).status_code, 200)
+        self.assertEqual(self.stock(), 3)
+
+    def test_seller_confirm_conflicts_when_sold_out(self):
+        self.client.force_authenticate(self.seller)
+        url = f'/api/seller/{self.order.id}/update_order/'
+        self.client.put(url, {'status': 'cancelled'})
+        CheckoutService.place_orders(self.buyer, [{'product': self.product.id, 'quantity': 5}])
+        self.assertEqual(self.client.put(url, {'status': 'confirmed'}).status_code, 409)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'cancelled')
+
+    def test_buyer_cannot_change_status(self):
+        self.client.force_authenticate(self.buyer)
+        response = self.client.patch(f'/api/orders/{self.order.id}/', {'status': 'cancelled', 'buyer_note': 'x'})
+        self.assertEqual(response.status_code, 200)
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.status, self.order.buyer_note), ('pending', 'x'))
+        self.assertEqual(self.stock(), 3)
+
+    def test_buyer_delete_returns_stock(self):
+        self.client.force_authenticate(self.buyer)
+        self.assertEqual(self.client.delete(f'/api/orders/{self.order.id}/').status_code, 204)
+        self.assertEqual(self.stock(), 5)
+        self.assertFalse(StockReservation.objects.exists())
+
+
+class CartCheckoutTests(TestCase):
+    def setUp(self):
+        self.sellers = [make_seller('seller-a'), make_seller('seller-b')]
+        self.rice = make_product(self.sellers[0], 10, 'Rice')
+        self.beans = make_product(self.sellers[1], 3, 'Beans')
+        self.oil = make_product(self.sellers[0], 5, 'Oil')
+        self.client = APIClient()
+        self.client.force_authenticate(make_buyer())
+
+    def checkout(self, *lines):
+        return self.client.post('/api/orders/checkout/', {
+            'items': [{'product': str(product.id), 'quantity': quantity} for product, quantity in lines],
+        }, format='json')
+
+    def stock(self):
+        return [Product.objects.get(id=p.id).stock_quantity for p in (self.rice, self.beans, self.oil)]
+
+    def assertNothingOrdered(self):
+        self.assertEqual((Order.objects.count(), OrderItem.objects.count(), StockReservation.objects.count()),
+                         (0, 0, 0))
+        self.assertEqual(self.stock(), [10, 3, 5])
+
+    def test_one_order_per_seller_in_basket_order(self):
+        response = self.checkout((self.beans, 1), (self.rice, 2), (self.oil, 1))
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual([order['seller'] for order in response.data], [self.sellers[1].id, self.sellers[0].id])
+        self.assertEqual([len(order['items']) for order in response.data], [1, 2])
+        self.assertEqual([Decimal(order['total_amount']) for order in response.data], [Decimal('10'), Decimal('30')])
+        self.assertEqual(self.stock(), [8, 2, 4])
+        self.assertEqual(StockReservation.objects.filter(status='held').count(), 3)
+
+    def test_out_of_stock_line_rolls_back_every_seller(self):
+        response = self.checkout((self.rice, 2), (self.oil, 1), (self.beans, 4))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['items'], ['Not enough stock for Beans'])
+        self.assertNothingOrdered()
+
+    def test_unknown_product_rolls_back(self):
+        response = self.client.post('/api/orders/checkout/', {'items': [
+            {'product': str(self.rice.id), 'quantity': 1},
+            {'product': '00000000-0000-0000-0000-000000000000', 'quantity': 1},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Products not found', response.data['items'][0])
+        self.assertNothingOrdered()
+
+    def test_failure_after_orders_are_written_rolls_back(self):
+        with mock.patch.object(StockReservationService, 'reserve_orders', side_effect=InsufficientStock(self.oil.id, 1)):
+            response = self.checkout((self.rice, 1), (self.beans, 1))
+        self.assertEqual(response.status_code, 400)
+        self.assertNothingOrdered()
+
+
+class ConcurrentStockReservationTests(TransactionTestCase):
+    """Many threads check out the same products; stock is never oversold or returned twice"""
+    threads = 8
+    attempts = 60
+    initial_stock = 20
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if connections['default'].vendor == 'sqlite':
+            # Only for these threads: transactions take SQLite's write lock when they begin and
+            # wait for it, instead of failing as locked when a read later upgrades to a write
+            patcher = mock.patch.dict(connections['default'].settings_dict['OPTIONS'], transaction_mode='IMMEDIATE')
+            patcher.start()
+            cls.addClassCleanup(connections.close_all)
+            cls.addClassCleanup(patcher.stop)
+            connections.close_all()
+
+    def setUp(self):
+        self.seller = make_seller()
+        self.buyers = [make_buyer(f'buyer{i}') for i in range(self.threads)]
+        self.products = [make_product(self.seller, self.initial_stock, name=f'Item {i}') for i in range(3)]
+
+    def run_threads(self, target, args):
+        def run(arg):
+            try:
+                return target(arg)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            return list(pool.map(run, args))
+
+    def assert_balanced(self, expected_reserved):
+        for product in self.products:
+            product.refresh_from_db()
+            reserved = StockReservation.objects.filter(
+                product=product, status__in=['held', 'confirmed']
+            ).aggregate(total=Sum('quantity'))['total'] or 0
+            self.assertGreaterEqual(product.stock_quantity, 0)
+            self.assertEqual(reserved, expected_reserved)
+            self.assertEqual(product.stock_quantity + reserved, self.initial_stock)
+
+    def test_concurrent_checkouts_and_cancels(self):
+        lines = [{'product': product.id, 'quantity': 1} for product in self.products]
+        lock = threading.Lock()
+        outcomes = []
+
+        def checkout(attempt):
+            try:
+                CheckoutService.place_orders(self.buyers[attempt % self.threads], lines)
+                outcome = 'placed'
+            except InsufficientStock:
+                outcome = 'sold_out'
+            with lock:
+                outcomes.append(outcome)
+
+        self.run_threads(checkout, range(self.attempts))
+        self.assertEqual(outcomes.count('placed'), self.initial_stock)
+        self.assertEqual(outcomes.count('sold_out'), self.attempts - self.initial_stock)
+        self.assert_balanced(self.initial_stock)
+
+        # Cancel every order twice at once; each reservation is returned exactly once
+        orders = list(Order.objects.all())
+        self.run_threads(StockReservationService.release, orders + orders)
+        self.assert_balanced(0)
+
+
+class RoutePrecomputeTests(TestCase):
+    def setUp(self):
+        self.seller = make_seller()
+        self.market = make_market(map_data=WALKWAY_MAP)
+        self.shops = [make_shop(self.market, self.seller, x, y, name=f'Shop {i}')
+                      for i, (x, y) in enumerate([(1, 0), (1, 40), (30, 41)])]
+
+    def test_rebuild_stores_every_shop_pair(self):
+        self.assertEqual(RoutePrecomputer(self.market).rebuild_market(), 6)
+        route = NavigationRoute.objects.get(start_shop=self.shops[0], end_shop=self.shops[2])
+        self.assertAlmostEqual(route.distance_meters, 72, delta=1)
+
+    def test_refresh_shop_keeps_hand_authored_and_other_market_routes(self):
+        RoutePrecomputer(self.market).rebuild_market()
+        shop = self.shops[0]
+        generic = NavigationRoute.objects.create(market=self.market, end_shop=shop, route_coordinates=[],
+                                                 distance_meters=5, estimated_walk_time_seconds=4)
+        other_market = make_market('Other', map_data=WALKWAY_MAP)
+        elsewhere = NavigationRoute.objects.create(market=other_market, start_shop=shop, end_shop=self.shops[1],
+                                                   route_coordinates=[], distance_meters=5,
+                                                   estimated_walk_time_seconds=4)
+
+        self.assertEqual(RoutePrecomputer(self.market).refresh_shop(shop.id), 4)
+        self.assertEqual(NavigationRoute.objects.filter(id__in=[generic.id, elsewhere.id]).count(), 2)
+        self.assertEqual(NavigationRoute.objects.filter(market=self.market, start_shop__isnull=False).count(), 6)
+
+    def test_entrance_routes_come_from_the_cached_zone_index(self):
+        gate = make_zone(self.market, 'Gate', [], zone_type='entrance', center_latitude=6.4535, radius_meters=10)
+        route = NavigationRoute.objects.create(market=self.market, start_zone=gate, end_shop=self.shops[2],
+                                               route_coordinates=[], distance_meters=50,
+                                               estimated_walk_time_seconds=40)
+        NavigationService._find_precomputed_route(6.4535, 3.3950, self.shops[2], 'walking')
+
+        with self.assertNumQueries(1):
+            found, approach = NavigationService._find_precomputed_route(6.4535, 3.39501, self.shops[2], 'walking')
+        self.assertEqual(found, route)
+        self.assertLess(approach, 2)
+
+        gate.delete()
+        self.assertEqual(NavigationService._find_precomputed_route(6.4535, 3.3950, self.shops[2], 'walking'),
+                         (None, None))
+
+    def test_map_and_entrance_changes_queue_rebuild(self):
+        with mock.patch.object(RouteRefreshWorker, 'schedule_market_rebuild') as schedule:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.market.name = 'Renamed'
+                self.market.save()
+            schedule.assert_not_called()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.market.map_data = {'walkways': WALKWAY_MAP['walkways'] + [
+                    {'id': 'aisle-b', 'type': 'aisle', 'floor': 0, 'points': [[30, 40], [30, 0]]}
+                ]}
+                self.market.save()
+            schedule.assert_called_once_with(self.market.id)
+
+            schedule.reset_mock()
+            with self.captureOnCommitCallbacks(execute=True):
+                GeofenceZone.objects.create(market=self.market, name='Gate', zone_type='entrance',
+                                            boundary_coordinates=[], center_latitude=6.4525,
+                                            center_longitude=3.3950)
+            schedule.assert_called_once_with(self.market.id)
+
+
+def jittered_grid_map(size=8, spacing=20.0, seed=7, drop=0.15):
+    """A grid of walkway segments with jittered junctions and some segments removed"""
+    rng = random.Random(seed)
+    points = {
+        (row, col): [round(col * spacing + rng.uniform(-5, 5), 2), round(row * spacing + rng.uniform(-5, 5), 2)]
+        for row in range(size) for col in range(size)
+    }
+    walkways = []
+    for (row, col), point in points.items():
+        for neighbour in ((row + 1, col), (row, col + 1)):
+            if neighbour in points and rng.random() > drop:
+                walkways.append({'id': f'{row}-{col}-{neighbour}', 'type': 'walkway', 'floor': 0,
+                                 'points': [point, points[neighbour]]})
+    return {'walkways': walkways}
+
+
+class RoutingGraphTests(TestCase):
+    def setUp(self):
+        self.graph = RoutingGraph.compile(jittered_grid_map())
+
+    def test_astar_matches_dijkstra(self):
+        rng = random.Random(11)
+        for _ in range(50):
+            start = self.graph.snap(rng.uniform(0, 140), rng.uniform(0, 140), 0)
+            end = self.graph.snap(rng.uniform(0, 140), rng.uniform(0, 140), 0)
+            best, links = self.graph.dijkstra(start)
+            expected = self.graph.path_from_tree(start, end, best, links)
+            actual = self.graph.shortest_path(start, end)
+            if expected is None:
+                self.assertIsNone(actual)
+                continue
+            self.assertAlmostEqual(actual[0], expected[0], places=6)
+
+            # The reverse tree from the destination agrees as well
+            best, links = self.graph.dijkstra(end, reverse=True)
+            self.assertAlmostEqual(self.graph.path_from_tree(start, end, best, links, reverse=True)[0],
+                                   expected[0], places=6)
+
+    def test_snap_projects_onto_nearest_segment(self):
+        graph = RoutingGraph.compile(WALKWAY_MAP)
+        snap = graph.snap(5, 20, 0)
+        self.assertEqual(snap['point'], (0.0, 20.0, 0))
+        self.assertAlmostEqual(snap['offset'], 5)
+        self.assertEqual(sorted(distance for _, distance in snap['links']), [20.0, 20.0])
+
+    def test_snap_far_points_are_fast_and_rejected(self):
+        started = time.perf_counter()
+        self.assertIsNone(self.graph.snap(20000, 20000, 0))
+        self.assertIsNone(self.graph.snap(1e6, 0, 0))
+        self.assertLess(time.perf_counter() - started, 0.5)
+
+        just_outside = self.graph.snap(-MAX_SNAP_METERS / 2, 0, 0)
+        self.assertIsNotNone(just_outside)
+        self.assertIsNone(self.graph.route((-MAX_SNAP_METERS * 2, 0, 0), (0, 0, 0)))
+
+    def test_snap_rejects_non_finite_points(self):
+        self.assertIsNone(self.graph.snap(float('inf'), 0, 0))
+        self.assertIsNone(self.graph.snap(0, float('nan'), 0))
+
+    def test_indoor_route_rejects_non_finite_coordinates(self):
+        client = APIClient()
+        client.force_authenticate(make_buyer())
+        market = make_market(map_data=WALKWAY_MAP)
+        market.indoor_map_enabled = True
+        market.save()
+        data = {'start_x': 'inf', 'start_y': 0, 'end_x': 0, 'end_y': 40, 'floor': 0, 'market_id': str(market.id)}
+        self.assertEqual(client.post('/api/navigation/indoor_route/', data).status_code, 400)
+
+        data['start_x'] = 1e6
+        response = client.post('/api/navigation/indoor_route/', data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['route_points']), 2)
+
+
+class ShopSpatialIndexTests(SimpleTestCase):
+    def setUp(self):
+        rng = random.Random(3)
+        self.shops = [
+            Shop(name=f'Shop {i}', latitude=6.45 + rng.uniform(-0.01, 0.01), longitude=3.39 + rng.uniform(-0.01, 0.01))
+            for i in range(400)
+        ]
+        self.index = ShopSpatialIndex('market', self.shops)
+
+    def brute_force(self, latitude, longitude):
+        return sorted((haversine_meters(latitude, longitude, shop.latitude, shop.longitude), shop.name)
+                      for shop in self.shops)
+
+    def test_within_radius_matches_brute_force(self):
+        for latitude, longitude, radius in [(6.45, 3.39, 150), (6.452, 3.385, 400), (6.46, 3.40, 50)]:
+            expected = [(distance, name) for distance, name in self.brute_force(latitude, longitude)
+                        if distance <= radius]
+            actual = [(distance, shop.name) for distance, shop in self.index.within_radius(latitude, longitude, radius)]
+            self.assertEqual([name for _, name in actual], [name for _, name in expected])
+            for (distance, _), (expected_distance, _) in zip(actual, expected):
+                self.assertAlmostEqual(distance, expected_distance, places=3)
+
+    def test_nearest_matches_brute_force(self):
+        for latitude, longitude, k in [(6.45, 3.39, 1), (6.455, 3.395, 7), (6.3, 3.2, 3)]:
+            expected = [name for _, name in self.brute_force(latitude, longitude)[:k]]
+            self.assertEqual([shop.name for _, shop in self.index.nearest(latitude, longitude, k)], expected)
+
+    def test_nearest_respects_max_distance(self):
+        results = self.index.nearest(6.45, 3.39, k=50, max_distance_meters=100)
+        self.assertTrue(all(distance <= 100 for distance, _ in results))
+        self.assertEqual(len(results), sum(1 for distance, _ in self.brute_force(6.45, 3.39) if distance <= 100))
+
+    def test_nearest_far_away_is_fast(self):
+        started = time.perf_counter()
+        results = self.index.nearest(7.5, 4.5, k=2)
+        self.assertLess(time.perf_counter() - started, 0.5)
+        self.assertEqual([shop.name for _, shop in results],
+                         [name for _, name in self.brute_force(7.5, 4.5)[:2]])
+
+
+class NavigationCacheTests(TestCase):
+    def test_bump_changes_version(self):
+        version = get_version('test', 'market')
+        self.assertEqual(get_version('test', 'market'), version)
+        bump_version('test', 'market')
+        self.assertNotEqual(get_version('test', 'market'), version)
+
+    @override_settings(NAVIGATION_CACHE_LOCAL_TTL_SECONDS=7)
+    def test_process_local_tokens_expire(self):
+        self.assertEqual(_token_timeout(), 7)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                                           'LOCATION': 'redis://127.0.0.1:6379/1'}})
+    def test_shared_tokens_live_until_bumped(self):
+        self.assertIsNone(_token_timeout())
+
+    def test_shop_index_registry_is_bounded(self):
+        with mock.patch.object(spatial_index, 'SHOP_INDEX_CACHE_SIZE', 3):
+            market_ids = [make_market(f'Market {i}').id for i in range(5)]
+            for market_id in market_ids:
+                ShopIndexRegistry.for_market(market_id)
+            self.assertEqual(list(ShopIndexRegistry._indexes), [str(market_id) for market_id in market_ids[2:]])
+
+    def test_shop_index_registry_sees_new_shops(self):
+        market = make_market()
+        self.assertEqual(ShopIndexRegistry.for_market(market.id).size, 0)
+        Shop.objects.create(market=market, seller=make_seller(), name='New', latitude=6.4525, longitude=3.395,
+                            is_verified=True)
+        self.assertEqual(ShopIndexRegistry.for_market(market.id).size, 1)
+
+
+class GeofenceIndexTests(TestCase):
+    def setUp(self):
+        self.market = make_market()
+        self.hall = make_zone(self.market, 'Hall', square(6.450, 3.390, 0.010))
+        self.food_court = make_zone(self.market, 'Food court', square(6.452, 3.394, 0.002), zone_type='food_court')
+        self.upstairs = make_zone(self.market, 'Upstairs', square(6.452, 3.394, 0.002), floor_level=1)
+
+    def zones_at(self, latitude, longitude, floor_level=None):
+        return NavigationService.detect_user_zones(latitude, longitude, str(self.market.id), floor_level)
+
+    def test_point_inside_and_outside_a_polygon(self):
+        self.assertEqual(self.zones_at(6.451, 3.391), [self.hall])
+        self.assertEqual(self.zones_at(6.449, 3.391), [])
+        self.assertEqual(self.zones_at(6.451, 3.4001), [])
+
+    def test_floor_filter(self):
+        self.assertEqual(self.zones_at(6.453, 3.395, floor_level=1), [self.upstairs])
+        self.assertEqual(self.zones_at(6.453, 3.395, floor_level=0), [self.food_court, self.hall])
+        self.assertEqual(self.zones_at(6.453, 3.395, floor_level=2), [])
+
+    def test_overlapping_zones_smallest_first(self):
+        self.assertEqual(self.zones_at(6.453, 3.395)[-1], self.hall)
+        self.assertEqual(set(self.zones_at(6.453, 3.395)[:2]), {self.food_court, self.upstairs})
+        self.assertEqual(NavigationService.detect_user_zone(6.453, 3.395, str(self.market.id), 0), self.food_court)
+
+    def test_zone_without_polygon_uses_its_radius(self):
+        stall = make_zone(self.market, 'Stall', [], center_latitude=6.4580, center_longitude=3.3980,
+                          radius_meters=20)
+        self.assertEqual(self.zones_at(6.4581, 3.3980, floor_level=0), [stall, self.hall])
+        self.assertEqual(self.zones_at(6.4590, 3.3980, floor_level=0), [self.hall])
+
+    def test_index_is_dropped_when_a_zone_is_saved_or_deleted(self):
+        index = GeofenceRegistry.for_market(self.market.id)
+        with self.assertNumQueries(0):
+            self.assertIs(GeofenceRegistry.for_market(self.market.id), index)
+
+        self.food_court.boundary_coordinates = square(6.456, 3.396, 0.002)
+        self.food_court.save()
+        self.assertIsNot(GeofenceRegistry.for_market(self.market.id), index)
+        self.assertEqual(self.zones_at(6.453, 3.395, floor_level=0), [self.hall])
+        self.assertEqual(self.zones_at(6.457, 3.397, floor_level=0), [self.food_court, self.hall])
+
+        self.hall.delete()
+        self.assertEqual(self.zones_at(6.451, 3.391), [])
+
+
+class MarketBoundaryCacheTests(TestCase):
+    def setUp(self):
+        self.market = make_market()
+        self.market.boundary_coordinates = square(6.450, 3.390, 0.010)
+        self.market.save()
+
+    def is_indoor(self, latitude, longitude):
+        return NavigationService.is_indoor_location(latitude, longitude, str(self.market.id))
+
+    def test_boundary_is_parsed_once(self):
+        self.assertTrue(self.is_indoor(6.455, 3.395))
+        with self.assertNumQueries(0):
+            self.assertFalse(self.is_indoor(6.465, 3.395))
+
+    def test_boundary_change_is_seen(self):
+        self.assertFalse(self.is_indoor(6.465, 3.395))
+        self.market.boundary_coordinates = square(6.460, 3.390, 0.010)
+        self.market.save()
+        self.assertTrue(self.is_indoor(6.465, 3.395))
+        self.assertFalse(self.is_indoor(6.455, 3.395))
+
+    def test_coordinate_change_drops_the_cached_boundary(self):
+        boundary = MarketBoundaryCache.for_market(self.market.id)
+        self.market.latitude = 6.4600
+        self.market.longitude = 3.4000
+        self.market.save()
+        with self.assertNumQueries(1):
+            self.assertIsNot(MarketBoundaryCache.for_market(self.market.id), boundary)
+
+        market_id = self.market.id
+        self.market.delete()
+        self.assertIsNone(MarketBoundaryCache.for_market(market_id))
+
+
+def navigation_socket(session_id, user=None):
+    from iMarket.asgi import application
+
+    query = f'?token={AccessToken.for_user(user)}' if user is not None else ''
+    return WebsocketCommunicator(application, f'/ws/navigation/{session_id}/{query}')
+
+
+class NavigationConsumerTests(TransactionTestCase):
+    # About 222 m due north
+    ROUTE = [[3.3950, 6.4500], [3.3950, 6.4520]]
+
+    def setUp(self):
+        self.user = make_buyer()
+        self.session = NavigationSession.objects.create(
+            user=self.user, market=make_market(), route_coordinates=self.ROUTE,
+            start_latitude=6.4500, start_longitude=3.3950
+        )
+
+    async def assert_rejected(self, session_id, user, code):
+        communicator = navigation_socket(session_id, user)
+        connected, close_code = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(close_code, code)
+
+    async def test_rejects_anonymous_sockets(self):
+        await self.assert_rejected(self.session.id, None, 4401)
+
+    async def test_rejects_malformed_and_foreign_session_ids(self):
+        await self.assert_rejected('not-a-uuid', self.user, 4404)
+        other = await database_sync_to_async(make_buyer)('other')
+        await self.assert_rejected(self.session.id, other, 4404)
+
+    async def test_streams_progress_and_completes(self):
+        communicator = navigation_socket(self.session.id, self.user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({'type': 'location_update', 'latitude': 6.4510, 'longitude': 3.3950})
+        progress = await communicator.receive_json_from()
+        self.assertEqual(progress['type'], 'progress')
+        self.assertAlmostEqual(progress['distance_remaining_meters'], 111, delta=2)
+        self.assertFalse(progress['off_route'])
+
+        await communicator.send_json_to({'type': 'location_update', 'latitude': 6.4520, 'longitude': 3.3950})
+        self.assertTrue((await communicator.receive_json_from())['arrived'])
+        self.assertEqual(await communicator.receive_json_from(), {
+            'type': 'status', 'status': 'completed', 'completed_at': mock.ANY
+        })
+        await communicator.disconnect()
+
+        session = await NavigationSession.objects.aget(id=self.session.id)
+        self.assertEqual(session.status, 'completed')
+
+
+class CurrentLocationTests(TestCase):
+    def setUp(self):
+        self.user = make_buyer()
+        self.now = timezone.now()
+
+    def record(self, latitude, seconds_ago):
+        NavigationService._record_current_location(UserLocation(
+            user=self.user, latitude=latitude, longitude=3.39, timestamp=self.now - timedelta(seconds=seconds_ago)
+        ))
+        return CurrentUserLocation.objects.get(user=self.user)
+
+    def test_first_fix_inserts(self):
+        self.assertEqual(self.record(6.1, 10).latitude, 6.1)
+
+    def test_newer_fix_replaces(self):
+        self.record(6.1, 10)
+        self.assertEqual(self.record(6.2, 5).latitude, 6.2)
+
+    def test_older_fix_is_ignored(self):
+        self.record(6.2, 5)
+        current = self.record(6.1, 10)
+        self.assertEqual((current.latitude, current.timestamp), (6.2, self.now - timedelta(seconds=5)))
+
+    def test_late_batch_keeps_newer_position(self):
+        self.record(6.3, 0)
+        NavigationService.update_user_locations_batch(str(self.user.id), [
+            {'latitude': 6.1, 'longitude': 3.39, 'timestamp': self.now - timedelta(seconds=30)},
+            {'latitude': 6.2, 'longitude': 3.39, 'timestamp': self.now - timedelta(seconds=20)},
+        ])
+        self.assertEqual(CurrentUserLocation.objects.get(user=self.user).latitude, 6.3)
+
+
+class LocationWriteBufferTests(TestCase):
+    def test_bad_row_does_not_drop_the_batch(self):
+        user = make_buyer()
+        rows = [UserLocation(user=user, latitude=float(i), longitude=3.39) for i in range(5)]
+        rows[2].latitude = None
+        # The flush thread owns its connection; here it is the test's, which must stay open
+        with mock.patch('markets.location_writer.close_old_connections'), \
+                self.assertLogs('markets.location_writer', 'WARNING') as logs:
+            LocationWriteBuffer._write(rows)
+        self.assertEqual(
+            sorted(UserLocation.objects.filter(user=user).values_list('latitude', flat=True)),
+            [0.0, 1.0, 3.0, 4.0],
+        )
+        self.assertIn('Dropped 1 of 5', logs.output[-1])
+
+    def test_stop_signals_flush_then_reach_the_previous_handler(self):
+        for signum in SHUTDOWN_SIGNALS:
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+        received = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: received.append(signum))
+
+        with mock.patch.object(LocationWriteBuffer, 'shutdown') as shutdown:
+            LocationWriteBuffer.install_signal_handlers()
+            handler = signal.getsignal(signal.SIGTERM)
+            LocationWriteBuffer.install_signal_handlers()
+            self.assertIs(signal.getsignal(signal.SIGTERM), handler)
+
+            handler(signal.SIGTERM, None)
+        shutdown.assert_called_once_with()
+        self.assertEqual(received, [signal.SIGTERM])
+
+    async def test_asgi_shutdown_flushes(self):
+        from iMarket.asgi import application
+
+        with mock.patch.object(LocationWriteBuffer, 'shutdown') as shutdown:
+            server = ApplicationCommunicator(application, {'type': 'lifespan'})
+            await server.send_input({'type': 'lifespan.startup'})
+            self.assertEqual(await server.receive_output(), {'type': 'lifespan.startup.complete'})
+            shutdown.assert_not_called()
+            await server.send_input({'type': 'lifespan.shutdown'})
+            self.assertEqual(await server.receive_output(), {'type': 'lifespan.shutdown.complete'})
+        shutdown.assert_called_once_with()
+
+
+class LocationPartitionTests(TestCase):
+    def test_only_days_ending_by_the_cutoff_expire(self):
+        days = [date(2026, 10, 1) + timedelta(days=i) for i in range(5)]
+        cutoff = datetime(2026, 10, 3, 12, tzinfo=dt_timezone.utc)
+        self.assertEqual(expired_days(days, cutoff), days[:2])
+        self.assertEqual(partition_name('markets_userlocation', days[0]), 'markets_userlocation_p20261001')
+
+    def test_missing_daily_partitions_are_created(self):
+        manager = LocationPartitionManager()
+        today = timezone.now().astimezone(dt_timezone.utc).date()
+        cursor = mock.MagicMock()
+        with mock.patch.object(manager, 'partition_days', return_value=[today]), \
+                mock.patch.object(manager.connection, 'cursor', return_value=cursor):
+            self.assertEqual(manager.ensure_partitions(2), 2)
+        statements = [call.args[0] for call in cursor.__enter__.return_value.execute.call_args_list]
+        tomorrow = today + timedelta(days=1)
+        self.assertIn(f'"markets_userlocation_p{tomorrow:%Y%m%d}" PARTITION OF "markets_userlocation"', statements[0])
+        self.assertIn(f"FROM ('{tomorrow.isoformat()}T00:00:00+00:00')", statements[0])
+
+    def test_sqlite_keeps_one_table(self):
+        manager = LocationPartitionManager()
+        self.assertFalse(manager.supported())
+        self.assertFalse(manager.is_partitioned())
+        with self.assertRaises(NotImplementedError):
+            manager.convert(7)
+        out = io.StringIO()
+        call_command('partition_locations', stdout=out)
+        self.assertIn('batched deletes', out.getvalue())
+
+
+class DouglasPeuckerTests(SimpleTestCase):
+    def test_short_lines_are_kept(self):
+        self.assertEqual(douglas_peucker([], 1.0), [])
+        self.assertEqual(douglas_peucker([(0, 0), (5, 5)], 1.0), [0, 1])
+
+    def test_straight_line_keeps_its_ends(self):
+        points = [(x, 0.1 * (x % 2)) for x in range(10)]
+        self.assertEqual(douglas_peucker(points, 0.5), [0, 9])
+
+    def test_corners_are_kept(self):
+        points = [(0, 0), (1, 0), (2, 0), (2, 1), (2, 2), (1, 2.05), (0, 2)]
+        self.assertEqual(douglas_peucker(points, 0.5), [0, 2, 4, 6])
+
+    def test_repeated_point_loop_is_kept(self):
+        # Start and end coincide, so distances fall back to the distance from that point
+        self.assertEqual(douglas_peucker([(0, 0), (3, 0), (3, 3), (0, 0)], 1.0), [0, 1, 2, 3])
+
+
+class LocationHistoryCompactorTests(TestCase):
+    def setUp(self):
+        self.user = make_buyer()
+        self.start = timezone.now() - timedelta(days=2)
+
+    def walk(self, count, seconds=0, floor=None, step=0.00001):
+        """A straight walk north, one fix per second from start + seconds"""
+        UserLocation.objects.bulk_create([
+            UserLocation(user=self.user, latitude=6.45 + i * step, longitude=3.39, floor_level=floor,
+                         timestamp=self.start + timedelta(seconds=seconds + i))
+            for i in range(count)
+        ])
+
+    def remaining(self):
+        return list(UserLocation.objects.order_by('timestamp').values_list('latitude', flat=True))
+
+    def test_straight_walk_is_reduced_to_its_ends(self):
+        self.walk(20)
+        examined, removed = LocationHistoryCompactor(2.0).compact(timezone.now())
+        self.assertEqual((examined, removed), (20, 18))
+        self.assertEqual(len(self.remaining()), 2)
+
+    def test_floor_changes_and_pauses_split_tracks(self):
+        self.walk(5, floor=0)
+        self.walk(5, seconds=5, floor=1)
+        self.walk(5, seconds=10 + 600, floor=1)
+        self.assertEqual(LocationHistoryCompactor(2.0).compact(timezone.now()), (15, 9))
+        self.assertEqual(UserLocation.objects.count(), 6)
+
+    def test_dry_run_and_window_leave_rows_alone(self):
+        self.walk(10)
+        self.assertEqual(LocationHistoryCompactor(2.0, dry_run=True).compact(timezone.now()), (10, 8))
+        self.assertEqual(LocationHistoryCompactor(2.0).compact(self.start), (0, 0))
+        self.assertEqual(UserLocation.objects.count(), 10)
+
+    def test_retention_deletes_older_rows(self):
+        self.walk(5)
+        self.walk(5, seconds=3600)
+        cutoff = self.start + timedelta(minutes=30)
+        self.assertEqual(LocationHistoryCompactor(2.0, dry_run=True).apply_retention(cutoff), 5)
+        self.assertEqual(LocationHistoryCompactor(2.0).apply_retention(cutoff), 5)
+        self.assertFalse(UserLocation.objects.filter(timestamp__lt=cutoff).exists())
+        self.assertEqual(UserLocation.objects.count(), 5)
+
+
+ORIGIN = (6.4525, 3.3950)
+
+
+def route_point(east, north):
+    """[longitude, latitude] of a point east/north meters from ORIGIN"""
+    lon_scale = METERS_PER_DEGREE_LAT * math.cos(math.radians(ORIGIN[0]))
+    return [ORIGIN[1] + east / lon_scale, ORIGIN[0] + north / METERS_PER_DEGREE_LAT]
+
+
+class RouteProgressTests(SimpleTestCase):
+    def setUp(self):
+        # 100 m north then 100 m east, with a vertex every 10 m
+        self.route = [route_point(0, n) for n in range(0, 100, 10)] + [route_point(e, 100) for e in range(0, 101, 10)]
+        instructions = [{'coordinates': route_point(0, 0)}, {'coordinates': route_point(0, 100)}]
+        self.tracker = RouteProgressTracker(self.route, instructions=instructions)
+
+    def fix(self, east, north):
+        longitude, latitude = route_point(east, north)
+        return self.tracker.update(latitude, longitude)
+
+    def test_walking_the_route(self):
+        self.assertAlmostEqual(self.tracker.total_length, 200.0, delta=0.5)
+        progress = self.fix(2, 30)
+        self.assertAlmostEqual(progress['distance_remaining_meters'], 170.0, delta=0.5)
+        self.assertAlmostEqual(progress['distance_from_route_meters'], 2.0, delta=0.1)
+        self.assertEqual((progress['current_step_index'], progress['off_route'], progress['arrived']), (0, False, False))
+
+        progress = self.fix(40, 99)
+        self.assertAlmostEqual(progress['distance_remaining_meters'], 60.0, delta=0.5)
+        self.assertEqual(progress['current_step_index'], 1)
+        self.assertEqual(progress['estimated_time_remaining_seconds'], int(progress['distance_remaining_meters'] / 1.4))
+
+        self.assertTrue(self.fix(95, 100)['arrived'])
+
+    def test_jump_beyond_the_lookahead_is_found(self):
+        self.fix(0, 5)
+        progress = self.fix(80, 100)
+        self.assertAlmostEqual(progress['distance_remaining_meters'], 20.0, delta=0.5)
+        self.assertFalse(progress['off_route'])
+
+    def test_off_route_needs_consecutive_far_fixes(self):
+        self.fix(0, 20)
+        far = OFF_ROUTE_METERS + 15
+        progress = self.fix(-far, 20)
+        self.assertFalse(progress['off_route'])
+        # Off the route, the walk back to it is counted as well
+        self.assertAlmostEqual(progress['distance_remaining_meters'], 180.0 + far, delta=0.5)
+        self.assertTrue(self.fix(-far, 25)['off_route'])
+        self.assertFalse(self.fix(0, 30)['off_route'])
+
+    def test_without_a_route_the_destination_is_used(self):
+        longitude, latitude = route_point(30, 40)
+        tracker = RouteProgressTracker(None, destination=(latitude, longitude))
+        progress = tracker.update(ORIGIN[0], ORIGIN[1])
+        self.assertAlmostEqual(progress['distance_remaining_meters'], 50.0, delta=0.5)
+        self.assertFalse(progress['arrived'])
+        self.assertTrue(tracker.update(latitude, longitude)['arrived'])
+
+    def test_registry_reuses_trackers_until_the_route_changes(self):
+        session = SimpleNamespace(id='session-1', route_coordinates=self.route, destination_latitude=None,
+                                  destination_longitude=None, selected_route_id=None)
+        self.addCleanup(RouteProgressRegistry.discard, session.id)
+        tracker = RouteProgressRegistry.for_session(session)
+        self.assertIs(RouteProgressRegistry.for_session(session), tracker)
+
+        session.route_coordinates = self.route[:5]
+        rerouted = RouteProgressRegistry.for_session(session)
+        self.assertIsNot(rerouted, tracker)
+        RouteProgressRegistry.discard(session.id)
+        self.assertIsNot(RouteProgressRegistry.for_session(session), rerouted)
+
+
+class DistanceEngineTests(SimpleTestCase):
+    def setUp(self):
+        self.shops = [(6.4525 + i * 0.0003, 3.3950 - i * 0.0002) for i in range(20)]
+
+    def test_haversine(self):
+        self.assertAlmostEqual(haversine_meters(0, 0, 1, 0), METERS_PER_DEGREE_LAT, places=3)
+        self.assertAlmostEqual(haversine_meters(6.45, 3.39, 6.45, 3.39), 0.0)
+        self.assertAlmostEqual(haversine_meters(0, 179.9, 0, -179.9), 0.2 * METERS_PER_DEGREE_LAT, delta=1)
+
+    def test_bounding_box_encloses_the_radius(self):
+        min_lat, max_lat, min_lon, max_lon = bounding_box(6.4525, 3.3950, 500)
+        for latitude, longitude in self.shops:
+            inside = min_lat <= latitude <= max_lat and min_lon <= longitude <= max_lon
+            if haversine_meters(6.4525, 3.3950, latitude, longitude) <= 500:
+                self.assertTrue(inside)
+        self.assertEqual(bounding_box(89.999, 0, 500)[2:], (None, None))
+        self.assertEqual(bounding_box(0, 179.999, 500)[2:], (None, None))
+
+    def test_array_matches_haversine_with_and_without_numpy(self):
+        expected = [haversine_meters(6.4530, 3.3945, lat, lon) for lat, lon in self.shops]
+        expected_order = sorted(range(len(expected)), key=expected.__getitem__)
+        for numpy_module in (distance_engine.np, None):
+            with mock.patch.object(distance_engine, 'np', numpy_module):
+                coordinates = CoordinateArray.from_pairs(self.shops)
+                distances, order = coordinates.sorted_by_distance(6.4530, 3.3945)
+                for distance, want in zip(distances, expected):
+                    self.assertAlmostEqual(distance, want, places=6)
+                self.assertEqual(order, expected_order)
+
+                _, capped = coordinates.sorted_by_distance(6.4530, 3.3945, max_distance_meters=100)
+                self.assertEqual(capped, [i for i in expected_order if expected[i] <= 100])
+                self.assertEqual(coordinates.nearest(6.4530, 3.3945)[0], expected_order[0])
+                self.assertEqual(CoordinateArray([], []).nearest(0, 0), (None, float('inf')))
+
+    def test_mismatched_lengths_are_rejected(self):
+        with self.assertRaises(ValueError):
+            CoordinateArray([1.0, 2.0], [1.0])
+
+
+class PinSearchTests(TestCase):
+    """Markets come from the bounding-box prefilter, then the exact 5km distance check"""
+    ORIGIN = (6.4525, 3.3950)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='admin', email='admin@example.com',
+                                                                password='pass', is_staff=True))
+
+    def market_at(self, name, latitude, longitude):
+        return Market.objects.create(name=name, address='1 Market Road', city='Lagos', state='Lagos',
+                                     latitude=latitude, longitude=longitude)
+
+    def north_of_origin(self, name, meters):
+        return self.market_at(name, self.ORIGIN[0] + meters / METERS_PER_DEGREE_LAT, self.ORIGIN[1])
+
+    def pin_search(self, latitude, longitude):
+        return self.client.get('/api/markets/pin_search/', {'lat': latitude, 'lng': longitude})
+
+    def test_markets_just_inside_and_outside_five_km(self):
+        inside = self.north_of_origin('Inside', 4990)
+        self.north_of_origin('Outside', 5010)
+        self.market_at('East', self.ORIGIN[0], self.ORIGIN[1] + 5300 / METERS_PER_DEGREE_LAT)
+
+        nearby = Market.objects.within_bounding_box(*self.ORIGIN, 5000)
+        self.assertEqual(sorted(nearby.values_list('name', flat=True)), ['Inside', 'Outside'])
+
+        response = self.pin_search(*self.ORIGIN)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], str(inside.id))
+        self.assertEqual(response.data['distance'], 4990)
+
+        inside.delete()
+        self.assertEqual(self.pin_search(*self.ORIGIN).status_code, 404)
+
+    def test_search_across_the_antimeridian_and_near_a_pole(self):
+        date_line = self.market_at('Date line', -16.5, 179.99)
+        response = self.pin_search(-16.5, -179.99)
+        self.assertEqual(response.data['id'], str(date_line.id))
+        self.assertAlmostEqual(response.data['distance'], haversine_meters(-16.5, 179.99, -16.5, -179.99), delta=1)
+
+        polar = self.market_at('Polar', 89.99, 0)
+        response = self.pin_search(89.99, 120)
+        self.assertEqual(response.data['id'], str(polar.id))
+        self.assertLess(response.data['distance'], 5000)
+
+    def test_no_candidates_is_a_404(self):
+        self.north_of_origin('Far', 50000)
+        with self.assertNumQueries(1):
+            response = self.pin_search(*self.ORIGIN)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.pin_search(6.45, 'east').status_code, 400)
+
+
+class LocationBatchApiTests(TestCase):
+    def setUp(self):
+        self.user = make_buyer()
+        self.market = make_market()
+        self.shop = make_shop(self.market, make_seller(), 10, 10)
+        Shop.objects.filter(id=self.shop.id).update(is_verified=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.now = timezone.now().replace(microsecond=0)
+
+    def post(self, locations, **extra):
+        return self.client.post('/api/navigation/update_locations_batch/',
+                                {'locations': locations, **extra}, format='json')
+
+    def test_fixes_are_stored_with_their_own_times(self):
+        far = {'latitude': 6.4600, 'longitude': 3.4000}
+        at_shop = {'latitude': self.shop.latitude, 'longitude': self.shop.longitude}
+        response = self.post([
+            {**at_shop, 'timestamp': self.now.isoformat()},
+            {**far, 'timestamp': (self.now - timedelta(seconds=20)).isoformat()},
+            {**far, 'timestamp': (self.now - timedelta(seconds=10)).isoformat()},
+        ], market_id=str(self.market.id))
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['count'], 3)
+
+        stored = list(UserLocation.objects.filter(user=self.user).order_by('timestamp'))
+        self.assertEqual([location.timestamp for location in stored],
+                         [self.now - timedelta(seconds=20), self.now - timedelta(seconds=10), self.now])
+        self.assertEqual([location.current_shop_id for location in stored], [None, None, self.shop.id])
+        self.assertEqual({location.market_id for location in stored}, {self.market.id})
+        self.assertEqual(CurrentUserLocation.objects.get(user=self.user).timestamp, self.now)
+
+    def test_empty_and_oversized_batches_are_rejected(self):
+        self.assertEqual(self.post([]).status_code, 400)
+        self.assertEqual(self.post([{'latitude': 6.45, 'longitude': 3.39}] * 501).status_code, 400)
+        self.assertFalse(UserLocation.objects.exists())
@@ -1,7 +1,10 @@
+import math
+
 from rest_framework import viewsets, permissions, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
+from django.db import transaction
 from django.db.models import Q, Count
 from .models import (
     Market, Shop, NavigationRoute, GeofenceZone, UserLocation, NavigationSession,
@@ -10,15 +13,18 @@ from .models import (
 )
 from .serializers import (
     MarketSerializer, MarketDetailSerializer, ShopSerializer, ShopDetailSerializer,
-    NavigationRouteSerializer, GeofenceZoneSerializer, UserLocationSerializer,
-    NavigationSessionSerializer, RouteCalculationSerializer, LocationUpdateSerializer,
+    NavigationRouteSerializer, GeofenceZoneSerializer, UserLocationSerializer, CurrentUserLocationSerializer,
+    NavigationSessionSerializer, RouteCalculationSerializer, LocationUpdateSerializer, LocationBatchSerializer,
     NearbyShopsSerializer, NavigationStatusSerializer, CategorySerializer,
     ProductSerializer, ProductDetailSerializer, ProductImageSerializer,
-    OrderSerializer, OrderCreateSerializer, OrderItemSerializer,
+    OrderSerializer, OrderCreateSerializer, CartCheckoutSerializer, OrderItemSerializer,
     SellerAnalyticsSerializer, SellerWalletSerializer, WalletTransactionSerializer,
     WithdrawRequestSerializer
 )
 from .navigation_utils import NavigationService, ExternalNavigationService, IndoorNavigationService
+from .distance_engine import CoordinateArray
+from .route_progress import RouteProgressRegistry
+from .stock_reservations import InsufficientStock, StockReservationService
 from users.models import User
 from django.utils import timezone
 
@@ -102,36 +108,16 @@ class MarketViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Simple proximity search - in a real app, you'd want to use GeoDjango
-        # or a more sophisticated spatial search algorithm
-        # This is a very basic approximation
-        from math import radians, cos, sin, asin, sqrt
-        
-        def haversine(lon1, lat1, lon2, lat2):
-            # Convert decimal degrees to radians
-            lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-            # Haversine formula
-            dlon = lon2 - lon1
-            dlat = lat2 - lat1
-            a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-            c = 2 * asin(sqrt(a))
-            r = 6371  # Radius of earth in kilometers
-            return c * r * 1000  # Convert to meters
-        
-        # Find closest market
-        closest_market = None
-        min_distance = float('inf')
-        
-        for market in Market.objects.all():
-            distance = haversine(lng, lat, market.longitude, market.latitude)
-            if distance < min_distance:
-                min_distance = distance
-                closest_market = market
+        # Only markets inside the 5km bounding box are fetched; exact distances run on those
+        search_radius_meters = 5000
+        candidates = list(Market.objects.within_bounding_box(lat, lng, search_radius_meters))
+        index, min_distance = CoordinateArray.from_objects(candidates).nearest(lat, lng)
         
         # If no market is found or closest is more than 5km away
-        if not closest_market or min_distance > 5000:
+        if index is None or min_distance > search_radius_meters:
             return Response({"message": "No markets found near this location"}, status=status.HTTP_404_NOT_FOUND)
         
+        closest_market = candidates[index]
         serializer = self.get_serializer(closest_market)
         data = serializer.data
         data['distance'] = round(min_distance)  # Distance in meters
@@ -152,17 +138,13 @@ class MarketViewSet(viewsets.ModelViewSet):
                 user_lat = float(user_lat)
                 user_lon = float(user_lon)
                 
-                shops_with_distance = []
-                for shop in shops:
-                    distance = NavigationService.calculate_distance(
-                        user_lat, user_lon, shop.latitude, shop.longitude
-                    )
+                shops = list(shops)
+                distances, order = CoordinateArray.from_objects(shops).sorted_by_distance(user_lat, user_lon)
+                for shop, distance in zip(shops, distances):
                     shop.distance_meters = distance
-                    shops_with_distance.append(shop)
                 
                 # Sort by distance
-                shops_with_distance.sort(key=lambda x: x.distance_meters)
-                shops = shops_with_distance
+                shops = [shops[i] for i in order]
             except (ValueError, TypeError):
                 pass  # Invalid coordinates, continue without distance
         
@@ -216,8 +198,10 @@ class MarketViewSet(viewsets.ModelViewSet):
             )
             
             # Detect current zone
+            floor_level = data.get('floor_level')
             current_zone = NavigationService.detect_user_zone(
-                latitude, longitude, str(market.id)
+                latitude, longitude, str(market.id),
+                int(floor_level) if floor_level is not None else None
             )
             
             response_data = {
@@ -381,8 +365,17 @@ class SellerDashboardViewSet(viewsets.ViewSet):
         
         if 'seller_note' in request.data:
             order.seller_note = request.data['seller_note']
-            
-        order.save()
+        
+        # Confirming keeps the reserved stock, cancelling returns it
+        try:
+            with transaction.atomic():
+                StockReservationService.apply_status_change(order, new_status)
+                order.save()
+        except InsufficientStock:
+            return Response(
+                {"error": "Not enough stock left to confirm this order"},
+                status=status.HTTP_409_CONFLICT
+            )
         
         serializer = OrderSerializer(order)
         return Response(serializer.data)
@@ -502,6 +495,27 @@ class UserOrderViewSet(viewsets.ModelViewSet):
     
     def perform_create(self, serializer):
         serializer.save(buyer=self.request.user)
+    
+    def perform_destroy(self, instance):
+        # Deleting cascades the reservations, so their stock goes back to the products first
+        with transaction.atomic():
+            StockReservationService.release(instance)
+            instance.delete()
+    
+    @action(detail=False, methods=['post'])
+    def checkout(self, request):
+        """Place orders for a basket spanning several sellers, one order per seller, in one request"""
+        serializer = CartCheckoutSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        orders = serializer.save(buyer=request.user)
+        
+        # Reload with items in two queries, keeping the order sellers appeared in the basket
+        position = {order.id: index for index, order in enumerate(orders)}
+        orders = sorted(
+            Order.objects.filter(id__in=position).prefetch_related('items'),
+            key=lambda order: position[order.id]
+        )
+        return Response(OrderSerializer(orders, many=True).data, status=status.HTTP_201_CREATED)
 
 
 class HomeViewSet(viewsets.ViewSet):
@@ -735,6 +749,7 @@ class NavigationViewSet(viewsets.ViewSet):
                 'destination_longitude': data.get('destination_longitude'),
                 'destination_name': destination_name,
                 'route_coordinates': route_data.get('coordinates'),
+                'selected_route_id': route_data.get('route_id'),
                 'start_latitude': data['start_latitude'],
                 'start_longitude': data['start_longitude'],
                 'navigation_mode': data['navigation_mode'],
@@ -780,6 +795,42 @@ class NavigationViewSet(viewsets.ViewSet):
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
+    @action(detail=False, methods=['get'])
+    def current_location(self, request):
+        """Get the user's latest known location"""
+        location = NavigationService.get_current_location(str(request.user.id))
+        
+        if location is None:
+            return Response({'error': 'No location recorded yet'}, status=status.HTTP_404_NOT_FOUND)
+        
+        return Response(CurrentUserLocationSerializer(location).data)
+    
+    @action(detail=False, methods=['post'])
+    def update_locations_batch(self, request):
+        """Store several timestamped location fixes and return the latest derived context"""
+        serializer = LocationBatchSerializer(data=request.data)
+        
+        if serializer.is_valid():
+            data = serializer.validated_data
+            
+            try:
+                location = NavigationService.update_user_locations_batch(
+                    user_id=str(request.user.id),
+                    fixes=data['locations'],
+                    market_id=str(data['market_id']) if data.get('market_id') else None
+                )
+                
+                location_serializer = UserLocationSerializer(location)
+                return Response({
+                    'count': len(data['locations']),
+                    'latest': location_serializer.data
+                })
+                
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
     @action(detail=False, methods=['post'])
     def update_navigation_status(self, request):
         """Update navigation session status"""
@@ -789,31 +840,36 @@ class NavigationViewSet(viewsets.ViewSet):
             data = serializer.validated_data
             
             try:
-                session = NavigationSession.objects.get(
+                session = NavigationSession.objects.select_related('selected_route').get(
                     id=data['session_id'],
                     user=request.user
                 )
                 
                 # Update session status
-                session.current_step_index = data['current_step_index']
                 session.status = data['status']
                 
                 if data['status'] == 'completed':
                     session.completed_at = timezone.now()
                 
-                # Calculate remaining distance
-                if session.destination_latitude and session.destination_longitude:
-                    remaining_distance = NavigationService.calculate_distance(
-                        data['current_latitude'], data['current_longitude'],
-                        session.destination_latitude, session.destination_longitude
-                    )
-                    session.distance_remaining_meters = remaining_distance
-                    session.estimated_time_remaining_seconds = int(remaining_distance / 1.4)  # walking speed
+                # Match the fix against the route instead of trusting the client's step
+                tracker = RouteProgressRegistry.for_session(session)
+                progress = tracker.update(data['current_latitude'], data['current_longitude'])
+                session.current_step_index = (
+                    progress['current_step_index'] if len(tracker.points) >= 2 else data['current_step_index']
+                )
+                session.distance_remaining_meters = progress['distance_remaining_meters']
+                session.estimated_time_remaining_seconds = progress['estimated_time_remaining_seconds']
+                
+                if session.status != 'active':
+                    RouteProgressRegistry.discard(session.id)
                 
                 session.save()
                 
                 session_serializer = NavigationSessionSerializer(session)
-                return Response(session_serializer.data)
+                response_data = session_serializer.data
+                response_data['off_route'] = progress['off_route']
+                response_data['distance_from_route_meters'] = progress['distance_from_route_meters']
+                return Response(response_data)
                 
             except NavigationSession.DoesNotExist:
                 return Response({'error': 'Navigation session not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -846,13 +902,16 @@ class NavigationViewSet(viewsets.ViewSet):
             }, status=status.HTTP_400_BAD_REQUEST)
         
         try:
+            points = {field: float(data[field]) for field in ('start_x', 'start_y', 'end_x', 'end_y')}
+            if not all(math.isfinite(value) for value in points.values()):
+                raise ValueError("coordinates must be finite numbers")
+            
             route_data = IndoorNavigationService.calculate_indoor_route(
-                start_x=float(data['start_x']),
-                start_y=float(data['start_y']),
-                end_x=float(data['end_x']),
-                end_y=float(data['end_y']),
+                **points,
                 floor=int(data['floor']),
-                market_id=str(data['market_id'])
+                market_id=str(data['market_id']),
+                end_floor=int(data['end_floor']) if data.get('end_floor') is not None else None,
+                accessible_only=str(data.get('accessible_only', '')).lower() in ('true', '1')
             )
             
             if 'error' in route_data:
@@ -895,21 +954,25 @@ class GeofenceViewSet(viewsets.ModelViewSet):
             }, status=status.HTTP_400_BAD_REQUEST)
         
         try:
-            zone = NavigationService.detect_user_zone(
+            floor_level = data.get('floor_level')
+            zones = NavigationService.detect_user_zones(
                 latitude=float(data['latitude']),
                 longitude=float(data['longitude']),
-                market_id=str(data['market_id'])
+                market_id=str(data['market_id']),
+                floor_level=int(floor_level) if floor_level is not None else None
             )
             
-            if zone:
-                serializer = GeofenceZoneSerializer(zone)
+            if zones:
+                serializer = GeofenceZoneSerializer(zones, many=True)
                 return Response({
-                    'zone': serializer.data,
+                    'zone': serializer.data[0],
+                    'zones': serializer.data,
                     'in_zone': True
                 })
             else:
                 return Response({
                     'zone': None,
+                    'zones': [],
                     'in_zone': False
                 })
                 
@@ -0,0 +1,38 @@
+"""
+JWT authentication for WebSocket connections
+"""
+from urllib.parse import parse_qs
+
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import User
+
+
+@database_sync_to_async
+def get_user_for_token(raw_token: str):
+    try:
+        token = AccessToken(raw_token)
+        return User.objects.get(id=token['user_id'], is_active=True)
+    except (TokenError, KeyError, User.DoesNotExist):
+        return AnonymousUser()
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """Authenticate sockets from a ?token=<access token> query parameter, as mobile clients connect"""
+
+    async def __call__(self, scope, receive, send):
+        query = parse_qs(scope.get('query_string', b'').decode())
+        token = query.get('token')
+        if token:
+            scope = dict(scope, user=await get_user_for_token(token[0]))
+        return await super().__call__(scope, receive, send)
+
+
+def JWTAuthMiddlewareStack(inner):
+    """Session authentication with a JWT query parameter taking precedence when present"""
+    return AuthMiddlewareStack(JWTAuthMiddleware(inner))